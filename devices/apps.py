@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class DevicesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'devices'
+
+    def ready(self):
+        # 注册可见性缓存的失效信号
+        from . import visibility  # noqa: F401
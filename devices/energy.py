@@ -130,7 +130,7 @@ def _device_energy_in_range(device: Device, start, end):
     """
     prev = (
         DeviceData.objects.filter(device=device, timestamp__lt=start)
-        .order_by("-timestamp")
+        .order_by("-timestamp", "-id")
         .values("timestamp", "data")
         .first()
     )
@@ -146,9 +146,10 @@ def _device_energy_in_range(device: Device, start, end):
         current_state = {}
         current_power = 0.0
 
+    # 批量补传的读数可能乱序到达：按设备侧时间戳排序，同一时刻按写入顺序（id）稳定合并。
     points = list(
         DeviceData.objects.filter(device=device, timestamp__gte=start, timestamp__lte=end)
-        .order_by("timestamp")
+        .order_by("timestamp", "id")
         .values("timestamp", "data")
     )
 
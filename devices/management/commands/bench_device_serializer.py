@@ -0,0 +1,100 @@
+"""
+对比设备列表的两种序列化方式：DeviceSerializer（ModelSerializer，实例化模型）与 serialize_devices（.values() 快速路径）。
+用法：
+    python3 manage.py bench_device_serializer                 # 默认 1000 与 10000 台设备
+    python3 manage.py bench_device_serializer --sizes 500,5000 --repeat 5
+在事务中批量创建临时设备，测完回滚，不影响现有数据；每种规模先校验两者 JSON 输出一致再计时（取最优值）。
+"""
+
+import json
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from devices.constants import DeviceType
+from devices.models import Device
+from devices.serializers import DeviceSerializer, serialize_devices
+
+
+class _Rollback(Exception):
+    pass
+
+
+def _sample_state(device_type: str, rng: random.Random) -> dict:
+    if device_type == DeviceType.AC_SWITCH:
+        return {"on": rng.random() < 0.5, "temp": rng.randint(16, 30), "power_w": round(rng.uniform(0, 900), 1)}
+    if device_type == DeviceType.FAN_SWITCH:
+        return {"on": rng.random() < 0.5, "speed": rng.randint(1, 3)}
+    if device_type == DeviceType.LAMP_SWITCH:
+        return {"on": rng.random() < 0.5}
+    return {"temp": round(rng.uniform(15, 35), 1), "humi": round(rng.uniform(20, 90), 1)}
+
+
+class Command(BaseCommand):
+    help = "设备列表序列化基准：ModelSerializer 与 .values() 快速路径"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="1000,10000", help="设备数量，逗号分隔（默认 1000,10000）")
+        parser.add_argument("--repeat", type=int, default=3, help="每种方式重复次数，取最优（默认 3）")
+        parser.add_argument("--seed", type=int, default=42)
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(item) for item in options["sizes"].split(",") if item.strip()]
+        except ValueError:
+            raise CommandError("--sizes 必须是逗号分隔的整数")
+        if not sizes or min(sizes) <= 0:
+            raise CommandError("--sizes 必须为正整数")
+        repeat = max(1, options["repeat"])
+        rng = random.Random(options["seed"])
+        renderer = JSONRenderer()
+
+        self.stdout.write(f"{'设备数':>8} {'ModelSerializer(ms)':>20} {'values()(ms)':>14} {'加速':>7}")
+        try:
+            with transaction.atomic():
+                baseline_ids = set(Device.objects.values_list("id", flat=True))
+                types = [value for value, _ in DeviceType.choices]
+                created = 0
+                for size in sorted(sizes):
+                    Device.objects.bulk_create(
+                        [
+                            Device(
+                                name=f"bench-{index}",
+                                type=types[index % len(types)],
+                                location=f"房间{index % 50}",
+                                is_online=index % 3 != 0,
+                                is_public=index % 5 == 0,
+                                current_state=_sample_state(types[index % len(types)], rng),
+                            )
+                            for index in range(created, size)
+                        ],
+                        batch_size=1000,
+                    )
+                    created = max(created, size)
+                    qs = Device.objects.exclude(id__in=baseline_ids).order_by("id")[:size]
+
+                    slow = renderer.render(DeviceSerializer(qs, many=True).data)
+                    fast = renderer.render(serialize_devices(qs))
+                    if json.loads(slow) != json.loads(fast) or slow != fast:
+                        raise CommandError(f"{size} 台设备时两种序列化输出不一致")
+
+                    slow_ms = self._best_ms(lambda: renderer.render(DeviceSerializer(qs, many=True).data), repeat)
+                    fast_ms = self._best_ms(lambda: renderer.render(serialize_devices(qs)), repeat)
+                    self.stdout.write(
+                        f"{size:>8} {slow_ms:>20.1f} {fast_ms:>14.1f} {slow_ms / max(fast_ms, 1e-6):>6.1f}x"
+                    )
+                raise _Rollback
+        except _Rollback:
+            pass
+
+    @staticmethod
+    def _best_ms(func, repeat: int) -> float:
+        best = float("inf")
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - started)
+        return best * 1000
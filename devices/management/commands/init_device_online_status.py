@@ -11,7 +11,7 @@ class Command(BaseCommand):
     help = "将所有设备的 is_online 字段初始化为 False（离线状态）"
 
     def handle(self, *args, **options):
-        count = Device.objects.update(is_online=False)
+        count = Device.objects.touch(is_online=False)
         self.stdout.write(
             self.style.SUCCESS(f"已将 {count} 个设备的在线状态设置为离线")
         )
@@ -0,0 +1,291 @@
+"""
+批量生成合成历史数据（DeviceData），用于能耗分析、历史曲线与数据保留逻辑的规模化测试。
+用法：
+    python3 manage.py seed_history --devices 20 --days 30 --rate 60 --seed 42
+    python3 manage.py seed_history --device-ids 1,2,6 --days 7 --rate 10
+    python3 manage.py seed_history --devices 200 --days 90 --method load-data   # 仅 MySQL
+数值模型与 simulate_devices/ 下各模拟脚本一致（读取同名 SIM_* 环境变量），
+随机数由 --seed 固定，同一参数多次运行生成的数据完全相同。
+"""
+
+import json
+import os
+import random
+import tempfile
+from datetime import timedelta
+from typing import Optional
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from devices.constants import DeviceType
+from devices.models import Device, DeviceData
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return float(default)
+
+
+SWITCH_TYPES = {DeviceType.LAMP_SWITCH, DeviceType.AC_SWITCH, DeviceType.FAN_SWITCH}
+
+
+class SimParams:
+    """SIM_* 环境变量（与模拟脚本同名），命令启动时读取一次，生成循环中只访问属性。"""
+
+    def __init__(self):
+        self.power_jitter_pct = _env_float("SIM_POWER_JITTER_PCT", 0.05)
+        self.ac_initial_temp = int(_env_float("SIM_AC_INITIAL_TEMP", 26))
+        self.fan_initial_speed = int(_env_float("SIM_FAN_INITIAL_SPEED", 1))
+        self.lamp_on_w = _env_float("SIM_LAMP_ON_W", 9)
+        self.fan_speed_w = {
+            1: _env_float("SIM_FAN_SPEED_1_W", 30),
+            2: _env_float("SIM_FAN_SPEED_2_W", 45),
+            3: _env_float("SIM_FAN_SPEED_3_W", 60),
+        }
+        self.ac_base_w = _env_float("SIM_AC_BASE_W", 500)
+        self.ac_temp_step_w = _env_float("SIM_AC_TEMP_STEP_W", 25)
+        self.ac_min_w = _env_float("SIM_AC_MIN_W", 100)
+        self.ac_max_w = _env_float("SIM_AC_MAX_W", 1000)
+        self.ac_temp_min = int(_env_float("SIM_AC_TEMP_MIN", 16))
+        self.ac_temp_max = int(_env_float("SIM_AC_TEMP_MAX", 30))
+        self.temp_range = (_env_float("SIM_TEMP_MIN", 18.0), _env_float("SIM_TEMP_MAX", 32.0))
+        self.humi_range = (_env_float("SIM_HUMI_MIN", 40.0), _env_float("SIM_HUMI_MAX", 95.0))
+        self.light_range = (_env_float("SIM_LIGHT_MIN", 2.0), _env_float("SIM_LIGHT_MAX", 2000.0))
+        self.pressure_range = (_env_float("SIM_PRESSURE_MIN", 1000.0), _env_float("SIM_PRESSURE_MAX", 1025.0))
+        self.pir_prob_detected = _env_float("SIM_PIR_PROB_DETECTED", 0.3)
+
+
+class DevicePhysics:
+    """
+    单设备的数值模型：每个采样时刻产出 0~N 条上报（与模拟脚本发布的 state/power payload 相同）。
+    开关类设备：状态变化时上报 state，每个采样点上报 power（含累计电量）；
+    传感器：每个采样点上报一条 state。
+    """
+
+    def __init__(self, device_type: str, rng: random.Random, toggle_prob: float, smoke_prob: float,
+                 params: Optional[SimParams] = None):
+        self.type = device_type
+        self.rng = rng
+        self.toggle_prob = toggle_prob
+        self.smoke_prob = smoke_prob
+        self.params = params = params or SimParams()
+        self.jitter = params.power_jitter_pct
+        self.energy_wh_total = 0.0
+        self.smoke = False
+        if device_type == DeviceType.AC_SWITCH:
+            self.state = {"on": False, "temp": params.ac_initial_temp}
+        elif device_type == DeviceType.FAN_SWITCH:
+            self.state = {"on": False, "speed": params.fan_initial_speed}
+        elif device_type == DeviceType.LAMP_SWITCH:
+            self.state = {"on": False}
+        else:
+            self.state = {}
+
+    def _power_w(self) -> float:
+        if not self.state.get("on"):
+            return 0.0
+        params = self.params
+        if self.type == DeviceType.LAMP_SWITCH:
+            base = params.lamp_on_w
+        elif self.type == DeviceType.FAN_SWITCH:
+            speed = int(self.state.get("speed", 1))
+            base = params.fan_speed_w[1 if speed <= 1 else min(speed, 3)]
+        else:
+            temp = float(self.state.get("temp", 26))
+            base = params.ac_base_w + (26.0 - temp) * params.ac_temp_step_w
+            base = max(params.ac_min_w, min(params.ac_max_w, base))
+        factor = 1.0 + self.rng.uniform(-self.jitter, self.jitter)
+        return max(0.0, base * factor)
+
+    def _switch_step(self, dt_seconds: float) -> list[dict]:
+        rng = self.rng
+        out = []
+        # 能耗按上一段状态累计，与模拟脚本 publish_power_snapshot 一致
+        power_w = self._power_w()
+        self.energy_wh_total += power_w * dt_seconds / 3600.0
+        if rng.random() < self.toggle_prob:
+            self.state["on"] = not self.state.get("on", False)
+            if self.state["on"] and self.type == DeviceType.AC_SWITCH:
+                self.state["temp"] = rng.randint(self.params.ac_temp_min, self.params.ac_temp_max)
+            elif self.state["on"] and self.type == DeviceType.FAN_SWITCH:
+                self.state["speed"] = rng.randint(1, 3)
+            out.append(dict(self.state))
+            power_w = self._power_w()
+        out.append(
+            {
+                "power_w": round(power_w, 3),
+                "energy_wh_total": round(self.energy_wh_total, 3),
+            }
+        )
+        return out
+
+    def step(self, dt_seconds: float) -> list[dict]:
+        rng = self.rng
+        params = self.params
+        if self.type in SWITCH_TYPES:
+            return self._switch_step(dt_seconds)
+        if self.type == DeviceType.TEMPERATURE_HUMIDITY:
+            payload = {
+                "temp": round(rng.uniform(*params.temp_range), 1),
+                "humi": round(rng.uniform(*params.humi_range), 1),
+            }
+        elif self.type == DeviceType.LIGHT:
+            payload = {"light": round(rng.uniform(*params.light_range), 1)}
+        elif self.type == DeviceType.PRESSURE:
+            payload = {"pressure": round(rng.uniform(*params.pressure_range), 1)}
+        elif self.type == DeviceType.PIR:
+            detected = rng.random() < params.pir_prob_detected
+            payload = {"motion": detected, "value": 1 if detected else 0}
+        elif self.type == DeviceType.SMOKE:
+            # 烟雾：大部分时间正常，偶发告警并在下一个采样点恢复
+            self.smoke = (not self.smoke) and rng.random() < self.smoke_prob
+            payload = {"smoke": self.smoke, "alarm": self.smoke, "value": 1 if self.smoke else 0}
+        else:
+            return []
+        self.state = payload
+        return [payload]
+
+
+class Command(BaseCommand):
+    help = "批量生成合成设备历史数据（DeviceData），用于规模化性能测试"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--devices", type=int, default=0, help="新建 N 个合成设备（按设备类型轮询）")
+        parser.add_argument("--device-ids", type=str, default="", help="为已有设备生成数据，逗号分隔 ID")
+        parser.add_argument("--days", type=float, default=7.0, help="生成最近 D 天的数据")
+        parser.add_argument("--rate", type=float, default=60.0, help="每台设备的采样间隔（秒）")
+        parser.add_argument("--seed", type=int, default=0, help="随机种子（同参数同种子结果可复现）")
+        parser.add_argument("--toggle-prob", type=float, default=0.02, help="开关类设备每个采样点的切换概率")
+        parser.add_argument("--smoke-prob", type=float, default=0.001, help="烟雾设备每个采样点的告警概率")
+        parser.add_argument("--batch-size", type=int, default=5000, help="bulk_create 每批行数")
+        parser.add_argument(
+            "--method",
+            choices=("bulk", "load-data"),
+            default="bulk",
+            help="写入方式：bulk=分批 bulk_create；load-data=MySQL LOAD DATA LOCAL INFILE",
+        )
+
+    def handle(self, *args, **options):
+        days = options["days"]
+        rate = options["rate"]
+        batch_size = max(1, options["batch_size"])
+        if days <= 0 or rate <= 0:
+            raise CommandError("--days 与 --rate 必须为正数")
+        if options["method"] == "load-data" and connection.vendor != "mysql":
+            raise CommandError("--method load-data 仅支持 MySQL/MariaDB 数据库")
+
+        devices = self._resolve_devices(options)
+        if not devices:
+            raise CommandError("请通过 --devices 或 --device-ids 指定至少一个设备")
+
+        end = timezone.now().replace(microsecond=0)
+        start = end - timedelta(days=days)
+        steps = int((end - start).total_seconds() // rate)
+        self.stdout.write(
+            f"开始生成：{len(devices)} 个设备 × {steps} 个采样点，区间 {start} ~ {end}，方式 {options['method']}"
+        )
+
+        if options["method"] == "load-data":
+            total = self._write_load_data(devices, start, rate, steps, options)
+        else:
+            total = self._write_bulk(devices, start, rate, steps, batch_size, options)
+
+        self.stdout.write(self.style.SUCCESS(f"已写入 {total} 条历史数据"))
+
+    def _resolve_devices(self, options) -> list[Device]:
+        raw_ids = [p.strip() for p in (options.get("device_ids") or "").split(",") if p.strip()]
+        devices: list[Device] = []
+        if raw_ids:
+            try:
+                ids = [int(p) for p in raw_ids]
+            except ValueError:
+                raise CommandError(f"--device-ids 格式错误: {options['device_ids']}")
+            devices.extend(Device.objects.filter(pk__in=ids).order_by("id"))
+            missing = set(ids) - {d.id for d in devices}
+            if missing:
+                raise CommandError(f"设备不存在: {sorted(missing)}")
+
+        count = max(0, options.get("devices") or 0)
+        if count:
+            types = list(DeviceType)
+            new_devices = [
+                Device(
+                    name=f"合成设备-{types[i % len(types)].value}-{i + 1}",
+                    type=types[i % len(types)],
+                    location="合成数据",
+                    is_public=True,
+                )
+                for i in range(count)
+            ]
+            Device.objects.bulk_create(new_devices, batch_size=1000)
+            # 部分数据库 bulk_create 不回填主键，这里按名称重新取回
+            devices.extend(
+                Device.objects.filter(location="合成数据", name__in=[d.name for d in new_devices]).order_by("-id")[:count]
+            )
+        return devices
+
+    def _iter_rows(self, devices, start, rate, steps, options):
+        """
+        逐设备生成 (device_id, timestamp, data)；同一设备的随机序列只由 seed 与设备 ID 决定。
+        """
+        step_delta = timedelta(seconds=rate)
+        params = SimParams()
+        for device in devices:
+            rng = random.Random(f"{options['seed']}:{device.id}")
+            physics = DevicePhysics(device.type, rng, options["toggle_prob"], options["smoke_prob"], params)
+            ts = start
+            for _ in range(steps):
+                ts = ts + step_delta
+                for payload in physics.step(rate):
+                    yield device, ts, payload
+            if physics.state:
+                Device.objects.filter(pk=device.pk).replace_state(physics.state)
+
+    def _write_bulk(self, devices, start, rate, steps, batch_size, options) -> int:
+        total = 0
+        batch: list[DeviceData] = []
+        for device, ts, payload in self._iter_rows(devices, start, rate, steps, options):
+            batch.append(DeviceData(device_id=device.id, timestamp=ts, data=payload))
+            if len(batch) >= batch_size:
+                with transaction.atomic():
+                    DeviceData.objects.bulk_create(batch, batch_size=batch_size)
+                total += len(batch)
+                batch = []
+                if total % (batch_size * 100) == 0:
+                    self.stdout.write(f"  已写入 {total} 条…")
+        if batch:
+            with transaction.atomic():
+                DeviceData.objects.bulk_create(batch, batch_size=batch_size)
+            total += len(batch)
+        return total
+
+    def _write_load_data(self, devices, start, rate, steps, options) -> int:
+        """
+        先写入临时 TSV，再通过 LOAD DATA LOCAL INFILE 导入，绕过逐行 INSERT 的解析开销。
+        需要数据库 OPTIONS 中开启 local_infile，且服务端 local_infile=ON。
+        """
+        table = DeviceData._meta.db_table
+        total = 0
+        with tempfile.NamedTemporaryFile("w", suffix=".tsv", delete=False, encoding="utf-8") as fp:
+            path = fp.name
+            for device, ts, payload in self._iter_rows(devices, start, rate, steps, options):
+                data = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+                fp.write(f"{device.id}\t{ts:%Y-%m-%d %H:%M:%S}\t{data}\n")
+                total += 1
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"LOAD DATA LOCAL INFILE %s INTO TABLE `{table}` "
+                    "CHARACTER SET utf8mb4 FIELDS TERMINATED BY '\\t' ESCAPED BY '' "
+                    "LINES TERMINATED BY '\\n' (device_id, timestamp, data)",
+                    [path],
+                )
+        except Exception as e:
+            raise CommandError(f"LOAD DATA 执行失败（请确认已开启 local_infile）: {e}")
+        finally:
+            os.unlink(path)
+        return total
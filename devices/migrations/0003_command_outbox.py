@@ -0,0 +1,28 @@
+# Generated by Django 5.2.11 on 2026-10-20 03:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devices', '0002_device_is_public'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommandOutbox',
+            fields=[
+                ('device', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='command_outbox', serialize=False, to='devices.device')),
+                ('payload', models.JSONField(default=dict, verbose_name='合并后的命令')),
+                ('command_count', models.PositiveIntegerField(default=0, verbose_name='合并的命令数')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name': '离线命令队列',
+                'verbose_name_plural': '离线命令队列',
+            },
+        ),
+    ]
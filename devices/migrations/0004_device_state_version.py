@@ -0,0 +1,18 @@
+# Generated by Django 5.2.11 on 2026-10-20 04:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devices', '0003_command_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='state_version',
+            field=models.PositiveBigIntegerField(default=0, verbose_name='状态版本'),
+        ),
+    ]
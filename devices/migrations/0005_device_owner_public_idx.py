@@ -0,0 +1,19 @@
+# Generated by Django 5.2.11 on 2026-10-20 04:08
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devices', '0004_device_state_version'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='device',
+            index=models.Index(fields=['owner', 'is_public'], name='device_owner_public_idx'),
+        ),
+    ]
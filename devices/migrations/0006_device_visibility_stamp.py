@@ -0,0 +1,29 @@
+# Generated by Django 5.2.11 on 2026-10-21 09:12
+
+from django.db import migrations, models
+
+
+def create_stamp(apps, schema_editor):
+    apps.get_model('devices', 'DeviceVisibilityStamp').objects.get_or_create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devices', '0005_device_owner_public_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceVisibilityStamp',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveBigIntegerField(default=1, verbose_name='代数')),
+            ],
+            options={
+                'verbose_name': '设备可见性代数',
+                'verbose_name_plural': '设备可见性代数',
+            },
+        ),
+        migrations.RunPython(create_stamp, migrations.RunPython.noop),
+    ]
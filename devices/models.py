@@ -1,11 +1,65 @@
+import json
+from typing import Optional
+
 from django.conf import settings
 from django.db import models
+from django.db.models import F, Value
 from django.utils import timezone     # <--- 新增
 from datetime import timedelta        # <--- 新增
 
 from .constants import DeviceType
 
 
+class JSONMergePatch(models.Func):
+    """
+    在数据库内合并 JSON 对象（RFC 7396）：patch 中的键覆盖原值，值为 null 的键被删除。
+    MySQL / MariaDB 使用 JSON_MERGE_PATCH，SQLite 使用 json_patch，PostgreSQL 使用 jsonb 的 || 运算。
+    """
+
+    function = "JSON_MERGE_PATCH"
+    output_field = models.JSONField()
+
+    def __init__(self, expression, patch: dict, **extra):
+        super().__init__(expression, Value(json.dumps(patch, ensure_ascii=False)), **extra)
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, function="json_patch", **extra_context)
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return self.as_sql(
+            compiler, connection, template="(%(expressions)s::jsonb)", arg_joiner=" || ", **extra_context
+        )
+
+
+class DeviceQuerySet(models.QuerySet):
+    def patch_state(self, patch: dict, expected_version: Optional[int] = None, **fields) -> int:
+        """
+        原子地把 patch 合并进 current_state（一条 UPDATE，只传输变化的键），并递增 state_version。
+        expected_version 不为空时仅更新版本号一致的行（乐观锁）；返回更新行数。
+        fields 为同时更新的其他字段（如 is_online）。
+        """
+        qs = self if expected_version is None else self.filter(state_version=expected_version)
+        return qs.update(
+            current_state=JSONMergePatch("current_state", patch),
+            state_version=F("state_version") + 1,
+            updated_at=timezone.now(),
+            **fields,
+        )
+
+    def touch(self, **fields) -> int:
+        """更新 current_state 以外的字段（如 is_online）并递增 state_version。"""
+        return self.update(state_version=F("state_version") + 1, updated_at=timezone.now(), **fields)
+
+    def replace_state(self, state: dict, **fields) -> int:
+        """整体替换 current_state（设备完整状态上报）并递增 state_version。"""
+        return self.update(
+            current_state=state,
+            state_version=F("state_version") + 1,
+            updated_at=timezone.now(),
+            **fields,
+        )
+
+
 class Device(models.Model):
     """
     设备基础信息和当前状态。
@@ -20,6 +74,8 @@ class Device(models.Model):
     is_public = models.BooleanField("是否为公共设备", default=False)
     # 当前状态：传感器或开关的最新值，JSON 结构由前端和模拟设备约定
     current_state = models.JSONField("当前状态", default=dict, blank=True)
+    # 每次写入设备（current_state 或其他字段）时递增，用于乐观锁与序列化缓存失效
+    state_version = models.PositiveBigIntegerField("状态版本", default=0)
 
     # 可选：设备归属用户（普通用户只看/控自己名下设备）
     owner = models.ForeignKey(
@@ -34,13 +90,57 @@ class Device(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = DeviceQuerySet.as_manager()
+
     class Meta:
         verbose_name = "设备"
         verbose_name_plural = "设备"
+        indexes = [
+            # 可见性查询：owner = 当前用户 OR is_public
+            models.Index(fields=["owner", "is_public"], name="device_owner_public_idx"),
+        ]
 
     def __str__(self) -> str:
         return f"{self.name} ({self.get_type_display()})"
 
+    def save(self, *args, **kwargs):
+        """
+        更新已有设备时在数据库内递增 state_version（管理后台、API 编辑、网关在线状态写入都经过这里）。
+        保存后 state_version 变为延迟字段，只有读取时才从数据库取回，网关的在线状态写入不再多一次查询。
+        """
+        if self._state.adding or self.pk is None:
+            return super().save(*args, **kwargs)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None:
+            kwargs["update_fields"] = {*update_fields, "state_version"}
+        self.state_version = F("state_version") + 1
+        super().save(*args, **kwargs)
+        del self.__dict__["state_version"]
+
+    def patch_state(self, patch: dict, expected_version: Optional[int] = None, refresh: bool = True,
+                    **fields) -> bool:
+        """
+        原子地合并 current_state 的部分字段；版本号不一致时返回 False。
+        refresh=True 时从数据库读回合并结果（含其他进程的并发写入），否则只在内存中按同样规则合并。
+        """
+        updated = Device.objects.filter(pk=self.pk).patch_state(patch, expected_version, **fields)
+        if not updated:
+            return False
+        for name, value in fields.items():
+            setattr(self, name, value)
+        if refresh:
+            self.refresh_from_db(fields=["current_state", "state_version", "updated_at"])
+        else:
+            state = dict(self.current_state or {})
+            for key, value in patch.items():
+                if value is None:
+                    state.pop(key, None)
+                else:
+                    state[key] = value
+            self.current_state = state
+            self.state_version += 1
+        return True
+
     # 在线状态统一由 MQTT/LWT 与设备上报维护，
     # 这里提供一个别名属性，兼容旧代码，不再基于时间推算。
     @property
@@ -67,3 +167,41 @@ class DeviceData(models.Model):
     def __str__(self) -> str:
         return f"{self.device_id} @ {self.timestamp}"
 
+
+
+class CommandOutbox(models.Model):
+    """
+    离线设备的待下发命令：每台设备一行，多条命令合并为最终期望状态（同名字段后者覆盖），
+    网关收到设备 LWT 上线后整体下发并删除。
+    """
+
+    device = models.OneToOneField(
+        Device, on_delete=models.CASCADE, primary_key=True, related_name="command_outbox"
+    )
+    payload = models.JSONField("合并后的命令", default=dict)
+    command_count = models.PositiveIntegerField("合并的命令数", default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = "离线命令队列"
+        verbose_name_plural = "离线命令队列"
+
+    def __str__(self) -> str:
+        return f"{self.device_id}: {self.payload}"
+
+
+class DeviceVisibilityStamp(models.Model):
+    """
+    设备可见性的全局代数（单行）：设备新增 / 删除、owner 或 is_public 变化时递增。
+    存在数据库中，所有 API 进程与 SSE 推送共享，用于让各进程缓存的可见设备集合立即失效。
+    """
+
+    version = models.PositiveBigIntegerField("代数", default=1)
+
+    class Meta:
+        verbose_name = "设备可见性代数"
+        verbose_name_plural = "设备可见性代数"
+
+    def __str__(self) -> str:
+        return str(self.version)
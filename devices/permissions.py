@@ -1,5 +1,7 @@
 from rest_framework.permissions import BasePermission
 
+from .visibility import can_view
+
 
 class IsDeviceOwnerOrAdmin(BasePermission):
     """
@@ -10,10 +12,5 @@ class IsDeviceOwnerOrAdmin(BasePermission):
         user = request.user
         if not user or not user.is_authenticated:
             return False
-        if user.is_staff or user.is_superuser:
-            return True
         # 公共设备：所有已登录用户可访问
-        if getattr(obj, "is_public", False):
-            return True
-        return obj.owner_id == user.id
-
+        return can_view(user, obj)
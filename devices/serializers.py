@@ -1,5 +1,7 @@
+from django.core.cache import caches
 from django.utils import timezone
 from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
 
 from .constants import DeviceType
 from .models import Device, DeviceData
@@ -25,12 +27,96 @@ class DeviceSerializer(serializers.ModelSerializer):
             "is_online",
             "is_public",
             "current_state",
+            "state_version",
             "owner",
             "created_at",
             "updated_at",
         ]
         # [新增] 只读字段
-        read_only_fields = ["id", "created_at", "updated_at", "is_online"]
+        read_only_fields = ["id", "created_at", "updated_at", "is_online", "state_version"]
+
+
+# 快速序列化：设备列表等批量读取路径不实例化模型，直接基于 .values() 行构造，输出与 DeviceSerializer 完全一致
+DEVICE_TYPE_LABELS = {value: str(label) for value, label in DeviceType.choices}
+DEVICE_VALUE_FIELDS = (
+    "id",
+    "name",
+    "type",
+    "location",
+    "is_online",
+    "is_public",
+    "current_state",
+    "state_version",
+    "owner_id",
+    "created_at",
+    "updated_at",
+)
+_datetime_field = serializers.DateTimeField()
+
+
+def device_row_to_dict(row: dict) -> dict:
+    """把一行 .values(*DEVICE_VALUE_FIELDS) 转为与 DeviceSerializer(device).data 相同的字典。"""
+    created_at = row["created_at"]
+    updated_at = row["updated_at"]
+    return {
+        "id": row["id"],
+        "name": row["name"],
+        "type": row["type"],
+        "type_display": DEVICE_TYPE_LABELS.get(row["type"], row["type"]),
+        "location": row["location"],
+        "is_online": row["is_online"],
+        "is_public": row["is_public"],
+        "current_state": row["current_state"],
+        "state_version": row["state_version"],
+        "owner": row["owner_id"],
+        "created_at": _datetime_field.to_representation(created_at) if created_at else None,
+        "updated_at": _datetime_field.to_representation(updated_at) if updated_at else None,
+    }
+
+
+def serialize_devices(queryset) -> list[dict]:
+    """批量序列化设备查询集（保留其过滤与排序）。"""
+    return [device_row_to_dict(row) for row in queryset.values(*DEVICE_VALUE_FIELDS)]
+
+
+# 设备 JSON 片段缓存：键为 (设备 ID, state_version)，设备的任何写入都会递增版本号，旧键自然失效
+DEVICE_BLOB_CACHE_ALIAS = "device_blobs"
+_json_renderer = JSONRenderer()
+
+
+def _blob_key(device_id: int, version: int) -> str:
+    return f"device:{device_id}:{version}"
+
+
+def render_devices_json(queryset) -> bytes:
+    """
+    输出与 JSONRenderer().render(serialize_devices(queryset)) 相同的 JSON 数组（bytes）。
+    先只查询 (id, state_version)，命中缓存的设备直接拼接，只有版本变化的设备才重新查询与序列化。
+    """
+    blob_cache = caches[DEVICE_BLOB_CACHE_ALIAS]
+    stamps = list(queryset.values_list("id", "state_version"))
+    keys = [_blob_key(device_id, version) for device_id, version in stamps]
+    blobs = blob_cache.get_many(keys)
+
+    missing = [device_id for (device_id, _), key in zip(stamps, keys) if key not in blobs]
+    fresh = {}
+    if missing:
+        rows = Device.objects.filter(pk__in=missing).values(*DEVICE_VALUE_FIELDS)
+        new_blobs = {}
+        for row in rows:
+            blob = _json_renderer.render(device_row_to_dict(row))
+            # 按读到的行自身的版本号缓存（可能比 stamps 中的更新）
+            new_blobs[_blob_key(row["id"], row["state_version"])] = blob
+            fresh[row["id"]] = blob
+        blob_cache.set_many(new_blobs)
+
+    parts = []
+    for (device_id, _), key in zip(stamps, keys):
+        blob = blobs.get(key) or fresh.get(device_id)
+        if blob is not None:
+            # 两次查询之间被删除的设备直接跳过
+            parts.append(blob)
+    return b"[" + b",".join(parts) + b"]"
 
 
 class DeviceHistoryPointSerializer(serializers.ModelSerializer):
@@ -104,3 +190,38 @@ class EnergyAnalysisQuerySerializer(serializers.Serializer):
         choices=RANGE_CHOICES, default=RANGE_24H, required=False
     )
     device_id = serializers.IntegerField(required=False, min_value=1)
+
+
+# 各类执行设备可接受的控制字段（与 toggle / set_temp / set_fan_speed 一致）
+COMMAND_FIELDS = {
+    DeviceType.LAMP_SWITCH: ("on",),
+    DeviceType.AC_SWITCH: ("on", "temp"),
+    DeviceType.FAN_SWITCH: ("on", "speed"),
+}
+
+
+class DeviceCommandPayloadSerializer(serializers.Serializer):
+    on = serializers.BooleanField(required=False)
+    temp = serializers.FloatField(required=False, min_value=0, max_value=50)
+    speed = serializers.IntegerField(required=False, min_value=1, max_value=3)
+
+    def validate(self, attrs):
+        if not attrs:
+            raise serializers.ValidationError("payload 至少包含 on / temp / speed 之一")
+        return attrs
+
+
+class BulkCommandSerializer(serializers.Serializer):
+    """
+    校验 POST /api/devices/bulk_command/ 的请求体：设备选择条件（ids / location / type，可组合）与命令 payload。
+    """
+
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), required=False, allow_empty=False)
+    location = serializers.CharField(required=False)
+    type = serializers.ChoiceField(choices=DeviceType.choices, required=False)
+    payload = DeviceCommandPayloadSerializer()
+
+    def validate(self, attrs):
+        if not any(key in attrs for key in ("ids", "location", "type")):
+            raise serializers.ValidationError("至少需要 ids、location、type 之一作为设备选择条件")
+        return attrs
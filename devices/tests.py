@@ -1,11 +1,21 @@
 from datetime import datetime
+from io import StringIO
+from unittest.mock import patch
 
 from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.db.models import F
 from django.test import TestCase
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
 
 from .constants import DeviceType
 from .energy import _device_energy_in_range, _monthly_estimate
-from .models import Device, DeviceData
+from .models import CommandOutbox, Device, DeviceData, DeviceVisibilityStamp
+from .serializers import DEVICE_BLOB_CACHE_ALIAS, DeviceSerializer, render_devices_json, serialize_devices
+from .visibility import visible_device_ids, visible_devices
 
 
 class EnergyEstimateRegressionTests(TestCase):
@@ -165,3 +175,303 @@ class EnergyEstimateRegressionTests(TestCase):
         self.assertAlmostEqual(result["energy_kwh"], 0.9, places=3)
         series_map = {ts: p for ts, p in result["series"]}
         self.assertEqual(series_map.get(datetime(2026, 2, 10, 9, 0, 0)), 0.0)
+
+
+class SeedHistoryCommandTests(TestCase):
+    def test_seed_history_is_reproducible_with_same_seed(self):
+        """
+        相同 seed 生成的历史数据应完全一致，便于基准测试复现。
+        """
+        device = Device.objects.create(name="客厅空调", type=DeviceType.AC_SWITCH)
+        sensor = Device.objects.create(name="客厅温湿度", type=DeviceType.TEMPERATURE_HUMIDITY)
+        ids = f"{device.id},{sensor.id}"
+
+        call_command("seed_history", device_ids=ids, days=1, rate=600, seed=7, stdout=StringIO())
+        first = list(DeviceData.objects.order_by("device_id", "timestamp", "id").values_list("device_id", "data"))
+        DeviceData.objects.all().delete()
+        call_command("seed_history", device_ids=ids, days=1, rate=600, seed=7, stdout=StringIO())
+        second = list(DeviceData.objects.order_by("device_id", "timestamp", "id").values_list("device_id", "data"))
+
+        self.assertEqual(first, second)
+        # 温湿度每个采样点一条；空调每个采样点至少一条 power 上报
+        self.assertEqual(DeviceData.objects.filter(device=sensor).count(), 144)
+        self.assertGreaterEqual(DeviceData.objects.filter(device=device).count(), 144)
+
+    def test_seed_history_creates_synthetic_devices(self):
+        call_command("seed_history", devices=3, days=0.5, rate=3600, stdout=StringIO())
+        created = Device.objects.filter(location="合成数据")
+        self.assertEqual(created.count(), 3)
+        for device in created:
+            self.assertGreaterEqual(device.data_points.count(), 12)
+
+
+class BulkCommandTests(TestCase):
+    def setUp(self):
+        user_model = get_user_model()
+        self.user = user_model.objects.create_user(username="bulk_owner", password="pass123456")
+        other = user_model.objects.create_user(username="bulk_other", password="pass123456")
+        self.lamp = Device.objects.create(
+            name="客厅灯", type=DeviceType.LAMP_SWITCH, location="客厅", owner=self.user, is_online=True,
+            current_state={"on": True},
+        )
+        self.ac = Device.objects.create(
+            name="客厅空调", type=DeviceType.AC_SWITCH, location="客厅", owner=self.user, is_online=True,
+            current_state={"on": False, "temp": 26},
+        )
+        self.sensor = Device.objects.create(
+            name="客厅温湿度", type=DeviceType.TEMPERATURE_HUMIDITY, location="客厅", owner=self.user
+        )
+        self.foreign = Device.objects.create(
+            name="别人的灯", type=DeviceType.LAMP_SWITCH, location="客厅", owner=other, is_online=True,
+            current_state={"on": True},
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = "/api/devices/bulk_command/"
+
+    def test_location_selector_updates_visible_actuators(self):
+        with patch("mqtt_gateway.utils.publish_device_command", return_value=None) as publish_mock:
+            res = self.client.post(self.url, {"location": "客厅", "payload": {"on": False}}, format="json")
+
+        self.assertEqual(res.status_code, 200)
+        statuses = {item["device_id"]: item["status"] for item in res.data["results"]}
+        self.assertEqual(statuses, {self.lamp.id: "sent", self.ac.id: "sent", self.sensor.id: "unsupported"})
+        self.assertEqual(publish_mock.call_count, 2)
+        self.lamp.refresh_from_db()
+        self.ac.refresh_from_db()
+        self.foreign.refresh_from_db()
+        self.assertEqual(self.lamp.current_state, {"on": False})
+        self.assertEqual(self.ac.current_state, {"on": False, "temp": 26})
+        self.assertEqual(self.foreign.current_state, {"on": True})
+
+    def test_ids_selector_filters_fields_and_reports_invisible_devices(self):
+        with patch("mqtt_gateway.utils.publish_device_command", return_value=None) as publish_mock:
+            res = self.client.post(
+                self.url,
+                {"ids": [self.lamp.id, self.ac.id, self.foreign.id], "payload": {"temp": 24}},
+                format="json",
+            )
+
+        results = {item["device_id"]: item for item in res.data["results"]}
+        self.assertEqual(results[self.lamp.id]["status"], "unsupported")
+        self.assertEqual(results[self.ac.id]["payload"], {"temp": 24.0, "on": True})
+        self.assertEqual(results[self.foreign.id]["status"], "not_found")
+        publish_mock.assert_called_once_with(device_id=self.ac.id, payload={"temp": 24.0, "on": True})
+
+    def test_requires_selector_and_payload(self):
+        self.assertEqual(self.client.post(self.url, {"payload": {"on": True}}, format="json").status_code, 400)
+        self.assertEqual(self.client.post(self.url, {"location": "客厅", "payload": {}}, format="json").status_code, 400)
+
+    def test_offline_devices_are_queued_and_coalesced(self):
+        Device.objects.filter(pk=self.ac.pk).update(is_online=False)
+        with patch("mqtt_gateway.utils.publish_device_command", return_value=None) as publish_mock:
+            self.client.post(self.url, {"ids": [self.ac.id], "payload": {"temp": 22}}, format="json")
+            res = self.client.post(self.url, {"ids": [self.ac.id], "payload": {"on": False}}, format="json")
+            toggled = self.client.post(f"/api/devices/{self.ac.id}/toggle/", {}, format="json")
+
+        publish_mock.assert_not_called()
+        self.assertEqual(res.data["results"][0]["status"], "queued")
+        self.assertEqual(toggled.status_code, 202)
+        # 离线队列中为 on=False，toggle 以其为基准取反
+        row = CommandOutbox.objects.get(device=self.ac)
+        self.assertEqual(row.payload, {"temp": 22.0, "on": True})
+        self.assertEqual(row.command_count, 3)
+        self.ac.refresh_from_db()
+        self.assertEqual(self.ac.current_state, {"on": False, "temp": 26})
+
+
+class DeviceStatePatchTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="patch_owner", password="pass123456")
+        self.ac = Device.objects.create(
+            name="卧室空调", type=DeviceType.AC_SWITCH, owner=self.user, is_online=True,
+            current_state={"on": False, "temp": 26},
+        )
+
+    def test_patches_merge_in_database_without_losing_concurrent_writes(self):
+        stale = Device.objects.get(pk=self.ac.pk)
+        # 另一进程（网关电参上报）先写入
+        Device.objects.filter(pk=self.ac.pk).patch_state({"power_w": 850.0})
+        self.assertTrue(stale.patch_state({"on": True}))
+
+        self.assertEqual(stale.current_state, {"on": True, "temp": 26, "power_w": 850.0})
+        self.assertEqual(stale.state_version, 2)
+        self.assertTrue(stale.patch_state({"power_w": None}, refresh=False))
+        self.assertEqual(stale.current_state, {"on": True, "temp": 26})
+
+    def test_expected_version_guards_api_writes(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        url = f"/api/devices/{self.ac.id}/set_temp/"
+        with patch("mqtt_gateway.utils.publish_device_command", return_value=None) as publish_mock:
+            ok = client.post(url, {"temp": 24, "expected_version": 0}, format="json")
+            stale = client.post(url, {"temp": 22, "expected_version": 0}, format="json")
+
+        self.assertEqual(ok.status_code, 200)
+        self.assertEqual(ok.data["state_version"], 1)
+        self.assertEqual(stale.status_code, 409)
+        self.assertEqual(stale.data["current_state"], {"on": True, "temp": 24.0})
+        publish_mock.assert_called_once_with(device_id=self.ac.id, payload={"temp": 24.0, "on": True})
+
+
+class DeviceVisibilityCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        user_model = get_user_model()
+        self.user = user_model.objects.create_user(username="vis_user", password="pass123456")
+        self.other = user_model.objects.create_user(username="vis_other", password="pass123456")
+        self.own = Device.objects.create(name="我的灯", type=DeviceType.LAMP_SWITCH, owner=self.user)
+        self.public = Device.objects.create(name="走廊灯", type=DeviceType.LAMP_SWITCH, is_public=True)
+        self.private = Device.objects.create(name="别人的灯", type=DeviceType.LAMP_SWITCH, owner=self.other)
+
+    def test_visible_ids_are_cached(self):
+        self.assertEqual(visible_device_ids(self.user), {self.own.id, self.public.id})
+        # 命中缓存时只按主键读取一次全局代数
+        with self.assertNumQueries(1):
+            self.assertEqual(visible_device_ids(self.user), {self.own.id, self.public.id})
+        # 状态写入不影响可见性，缓存保持有效
+        self.private.current_state = {"on": True}
+        self.private.save(update_fields=["current_state"])
+        with self.assertNumQueries(1):
+            visible_device_ids(self.user)
+
+    def test_invalidation_from_another_process_is_seen_immediately(self):
+        visible_device_ids(self.user)
+        # 模拟其他工作进程：修改可见性并递增数据库中的代数，本进程的进程内缓存未被清理
+        Device.objects.filter(pk=self.public.pk).update(is_public=False)
+        DeviceVisibilityStamp.objects.update(version=F("version") + 1)
+        self.assertEqual(visible_device_ids(self.user), {self.own.id})
+
+    def test_ownership_and_visibility_changes_invalidate(self):
+        visible_device_ids(self.user)
+        self.private.is_public = True
+        self.private.save()
+        self.assertIn(self.private.id, visible_device_ids(self.user))
+
+        self.own.owner = self.other
+        self.own.save(update_fields=["owner"])
+        self.assertNotIn(self.own.id, visible_device_ids(self.user))
+
+        self.public.delete()
+        self.assertEqual(set(visible_devices(self.user)), {self.private})
+
+    def test_commands_authorize_against_database_not_cached_set(self):
+        visible_device_ids(self.user)
+        # 模拟其他工作进程修改：本进程缓存未失效
+        Device.objects.filter(pk=self.public.pk).update(is_public=False)
+        self.assertIn(self.public.id, visible_device_ids(self.user))
+
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with patch("mqtt_gateway.utils.publish_device_command", return_value=None) as publish_mock:
+            toggle = client.post(f"/api/devices/{self.public.id}/toggle/", {}, format="json")
+            bulk = client.post("/api/devices/bulk_command/", {"ids": [self.public.id], "payload": {"on": True}},
+                               format="json")
+        self.assertEqual(toggle.status_code, 404)
+        self.assertEqual([item["status"] for item in bulk.data["results"]], ["not_found"])
+        publish_mock.assert_not_called()
+
+    def test_list_endpoint_uses_visible_set(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        res = client.get("/api/devices/")
+        ids = [item["id"] for item in res.json()]
+        self.assertEqual(ids, [self.own.id, self.public.id])
+        self.assertEqual(client.get(f"/api/devices/{self.private.id}/").status_code, 404)
+
+
+class FastDeviceSerializerTests(TestCase):
+    def test_values_path_matches_model_serializer(self):
+        owner = get_user_model().objects.create_user(username="fast_owner", password="pass123456")
+        Device.objects.create(name="空调", type=DeviceType.AC_SWITCH, owner=owner, current_state={"on": True, "temp": 24})
+        Device.objects.create(name="烟雾", type=DeviceType.SMOKE, is_public=True, is_online=True)
+        Device.objects.filter(name="烟雾").patch_state({"smoke": False})
+        qs = Device.objects.order_by("id")
+
+        self.assertEqual(serialize_devices(qs), DeviceSerializer(qs, many=True).data)
+        with self.assertNumQueries(1):
+            serialize_devices(qs)
+
+    def test_benchmark_command_rolls_back(self):
+        out = StringIO()
+        call_command("bench_device_serializer", sizes="20,50", repeat=1, stdout=out)
+        self.assertEqual(len(out.getvalue().strip().splitlines()), 3)
+        self.assertFalse(Device.objects.exists())
+
+
+class DeviceBlobCacheTests(TestCase):
+    def setUp(self):
+        caches[DEVICE_BLOB_CACHE_ALIAS].clear()
+        self.lamp = Device.objects.create(name="台灯", type=DeviceType.LAMP_SWITCH, current_state={"on": False})
+        self.fan = Device.objects.create(name="风扇", type=DeviceType.FAN_SWITCH, current_state={"on": False, "speed": 1})
+        self.qs = Device.objects.order_by("id")
+
+    def assertMatchesSerializer(self, rendered: bytes):
+        self.assertEqual(rendered, JSONRenderer().render(DeviceSerializer(self.qs.all(), many=True).data))
+
+    def test_only_changed_devices_are_reserialized(self):
+        self.assertMatchesSerializer(render_devices_json(self.qs))
+        with self.assertNumQueries(1):
+            render_devices_json(self.qs)
+
+        Device.objects.filter(pk=self.fan.pk).patch_state({"speed": 3})
+        with self.assertNumQueries(2):
+            rendered = render_devices_json(self.qs)
+        self.assertMatchesSerializer(rendered)
+
+    def test_full_save_bumps_version(self):
+        render_devices_json(self.qs)
+        version = self.lamp.state_version
+        self.lamp.name = "床头灯"
+        self.lamp.save()
+        self.assertEqual(self.lamp.state_version, version + 1)
+        self.lamp.is_online = True
+        # 保存只执行 UPDATE，版本号在读取时才取回
+        with self.assertNumQueries(1):
+            self.lamp.save(update_fields=["is_online", "updated_at"])
+        with self.assertNumQueries(1):
+            self.assertEqual(self.lamp.state_version, version + 2)
+        self.assertMatchesSerializer(render_devices_json(self.qs))
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        caches[DEVICE_BLOB_CACHE_ALIAS].clear()
+        cache.clear()
+        self.user = get_user_model().objects.create_user(username="etag_user", password="pass123456")
+        self.lamp = Device.objects.create(name="台灯", type=DeviceType.LAMP_SWITCH, owner=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_device_list_revalidates_with_etag(self):
+        first = self.client.get("/api/devices/")
+        etag = first["ETag"]
+        self.assertEqual(self.client.get("/api/devices/", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        Device.objects.filter(pk=self.lamp.pk).patch_state({"on": True})
+        changed = self.client.get("/api/devices/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed["ETag"], etag)
+
+    def test_history_and_logs_etags_follow_last_id(self):
+        from logs_app.models import SystemLog
+
+        url = f"/api/devices/{self.lamp.id}/history/?range=6h"
+        etag = self.client.get(url)["ETag"]
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        DeviceData.objects.create(device=self.lamp, timestamp=datetime.now(), data={"on": True})
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        SystemLog.objects.create(source="TEST", level=SystemLog.LEVEL_INFO, message="a")
+        etag = self.client.get("/api/logs/system/")["ETag"]
+        self.assertEqual(self.client.get("/api/logs/system/", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        SystemLog.objects.create(source="TEST", level=SystemLog.LEVEL_INFO, message="b")
+        self.assertEqual(self.client.get("/api/logs/system/", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_large_json_is_gzipped(self):
+        Device.objects.bulk_create(
+            [Device(name=f"灯{i}", type=DeviceType.LAMP_SWITCH, owner=self.user) for i in range(30)]
+        )
+        res = self.client.get("/api/devices/", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(res["Content-Encoding"], "gzip")
+        self.assertTrue(res["ETag"].startswith('W/"'))
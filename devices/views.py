@@ -2,6 +2,8 @@ import csv
 import io
 from urllib.parse import quote
 
+from django.conf import settings
+from django.db.models import Count, Max, Sum
 from django.http import HttpResponse
 from django.utils import timezone
 from rest_framework import mixins, status, viewsets
@@ -11,16 +13,27 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from accounts.permissions import IsAdminUserRole
+from smart_home_backend.conditional import etag_response, time_bucket
 from .constants import DeviceType
-from .models import Device, DeviceData
+from .models import CommandOutbox, Device, DeviceData
 from .permissions import IsDeviceOwnerOrAdmin
 from .serializers import (
+    COMMAND_FIELDS,
+    BulkCommandSerializer,
     DeviceHistoryPointSerializer,
     DeviceHistoryQuerySerializer,
     EnergyAnalysisQuerySerializer,
     DeviceSerializer,
+    render_devices_json,
 )
 from .energy import build_energy_analysis
+from .visibility import visible_devices
+
+
+def _devices_stamp(queryset) -> tuple:
+    """设备集合的版本片段：数量、最近更新时间与 state_version 之和（任何设备写入都会改变）。"""
+    agg = queryset.aggregate(count=Count("id"), updated=Max("updated_at"), versions=Sum("state_version"))
+    return agg["count"], agg["updated"], agg["versions"]
 
 
 class DeviceViewSet(viewsets.ModelViewSet):
@@ -35,13 +48,21 @@ class DeviceViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        user = self.request.user
-        qs = super().get_queryset()
-        if user.is_staff or user.is_superuser:
-            # 管理员可以看到所有设备（包括公共和私人）
-            return qs
-        # 普通用户：自己名下的设备 + 公共设备
-        return qs.filter(owner=user) | qs.filter(is_public=True)
+        # 管理员可以看到所有设备；普通用户：自己名下的设备 + 公共设备。
+        # 只有列表使用缓存的可见集合，详情与控制操作按数据库当前状态鉴权
+        return visible_devices(self.request.user, super().get_queryset(), for_write=self.action != "list")
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.get_serializer(page, many=True).data)
+        # 拼接每台设备缓存的 JSON 片段，只重新序列化版本号变化的设备
+        return etag_response(
+            request,
+            _devices_stamp(queryset),
+            lambda: HttpResponse(render_devices_json(queryset), content_type="application/json"),
+        )
 
     def get_permissions(self):
         # 写操作（POST/PUT/PATCH/DELETE）只允许管理员
@@ -55,6 +76,66 @@ class DeviceViewSet(viewsets.ModelViewSet):
         # 管理员创建设备时可选指定 owner
         serializer.save()
 
+    def _command_response(self, device: Device, command):
+        """
+        控制接口的响应：current_state 与命令确认状态。
+        ?wait=秒 时在确认、失败或超时前阻塞（上限 MQTT_COMMAND_ACK['MAX_WAIT_SECONDS']）。
+        """
+        from mqtt_gateway import acks
+
+        body = {"current_state": device.current_state, "state_version": device.state_version}
+        if command is not None:
+            wait_seconds = acks.parse_wait_seconds(self.request.query_params.get("wait"))
+            if wait_seconds > 0 and command.status == acks.STATUS_PENDING:
+                command.wait(wait_seconds)
+            body["command"] = command.to_dict()
+        return Response(body)
+
+    def _queue_if_offline(self, device: Device, payload: dict):
+        """设备离线时命令写入离线队列（上线后由网关合并下发），不修改 current_state；在线时返回 None。"""
+        from mqtt_gateway import outbox
+
+        if device.is_online or not outbox.enabled():
+            return None
+        merged = outbox.enqueue(device.id, payload)
+        return Response(
+            {"current_state": device.current_state, "command": outbox.queued_command(merged)},
+            status=status.HTTP_202_ACCEPTED,
+        )
+
+    def _send_command(self, device: Device, payload: dict):
+        """
+        控制接口的公共流程：离线设备写入离线队列；在线设备在数据库内原子合并 current_state 后发布命令。
+        请求体带 expected_version 时作为乐观锁：与设备当前 state_version 不一致返回 409。
+        """
+        data = self.request.data if isinstance(self.request.data, dict) else {}
+        expected_version = data.get("expected_version")
+        if expected_version is not None:
+            try:
+                expected_version = int(expected_version)
+            except (TypeError, ValueError):
+                return Response({"error": "expected_version 必须是整数"}, status=status.HTTP_400_BAD_REQUEST)
+
+        queued = self._queue_if_offline(device, payload)
+        if queued is not None:
+            return queued
+
+        if not device.patch_state(payload, expected_version=expected_version):
+            device.refresh_from_db(fields=["current_state", "state_version"])
+            return Response(
+                {
+                    "error": "设备状态已被其他操作修改，请刷新后重试",
+                    "current_state": device.current_state,
+                    "state_version": device.state_version,
+                },
+                status=status.HTTP_409_CONFLICT,
+            )
+
+        from mqtt_gateway.utils import publish_device_command
+        command = publish_device_command(device_id=device.id, payload=payload)
+
+        return self._command_response(device, command)
+
     @action(detail=True, methods=["post"])
     def toggle(self, request, pk=None):
         """
@@ -66,22 +147,108 @@ class DeviceViewSet(viewsets.ModelViewSet):
         desired_state = payload.get("state")
 
         if desired_state is None:
-            # 简单 toggle：如果 current_state 有 on 字段则取反
-            current = bool(device.current_state.get("on"))
+            # 简单 toggle：如果 current_state 有 on 字段则取反（离线时以离线队列中的期望状态为准）
+            current_state = device.current_state
+            if not device.is_online:
+                pending = CommandOutbox.objects.filter(device=device).values_list("payload", flat=True).first()
+                current_state = {**current_state, **(pending or {})}
+            current = bool(current_state.get("on"))
             desired_state = {"on": not current}
         elif isinstance(desired_state, bool):
             desired_state = {"on": desired_state}
 
-        # 更新 current_state
-        state = device.current_state.copy()
-        state.update(desired_state)
-        device.current_state = state
-        device.save(update_fields=["current_state", "updated_at"])
+        return self._send_command(device, desired_state)
 
+    @action(detail=False, methods=["post"], url_path="bulk_command")
+    def bulk_command(self, request):
+        """
+        批量控制：POST /api/devices/bulk_command/
+        {"ids": [1, 2], "location": "客厅", "type": "LAMP_SWITCH", "payload": {"on": false}}
+        - 选择条件可组合，只命中当前用户可访问的设备（一次查询完成权限过滤）
+        - 每台设备只下发其类型支持的字段；设置 temp / speed 且未指定 on 时自动开启（与单设备接口一致）
+        - 设备状态在数据库内原子合并（相同 payload 一条 UPDATE），命令随后连续发布；?wait=秒 时等待全部确认
+        - 离线设备的命令写入离线队列，设备上线后由网关下发
+        返回每台设备的结果：sent / queued / unsupported / not_found。
+        """
+        serializer = BulkCommandSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+        payload = params["payload"]
+
+        qs = self.get_queryset()
+        if "ids" in params:
+            qs = qs.filter(pk__in=params["ids"])
+        if "location" in params:
+            qs = qs.filter(location=params["location"])
+        if "type" in params:
+            qs = qs.filter(type=params["type"])
+        max_devices = getattr(settings, "DEVICE_BULK_COMMAND", {}).get("MAX_DEVICES", 500)
+        devices = list(qs.order_by("id")[: max_devices + 1])
+        if len(devices) > max_devices:
+            return Response(
+                {"error": f"命中设备超过上限 {max_devices}，请缩小选择范围"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        from mqtt_gateway import acks, outbox
         from mqtt_gateway.utils import publish_device_command
-        publish_device_command(device_id=device.id, payload=desired_state)
 
-        return Response({"current_state": device.current_state})
+        results = []
+        targets = []
+        use_outbox = outbox.enabled()
+        for device in devices:
+            allowed = COMMAND_FIELDS.get(device.type, ())
+            command_payload = {key: value for key, value in payload.items() if key in allowed}
+            if not command_payload:
+                results.append({"device_id": device.id, "status": "unsupported"})
+                continue
+            if "on" not in command_payload and ("temp" in command_payload or "speed" in command_payload):
+                command_payload["on"] = True
+            if use_outbox and not device.is_online:
+                results.append({
+                    "device_id": device.id,
+                    "status": "queued",
+                    "payload": command_payload,
+                    "command": outbox.queued_command(outbox.enqueue(device.id, command_payload)),
+                })
+                continue
+            targets.append((device, command_payload))
+
+        # 相同 payload 的设备一条 UPDATE 在数据库内合并（按设备类型通常只有 1~3 组），再一次读回合并结果
+        by_payload: dict[tuple, list[int]] = {}
+        for device, command_payload in targets:
+            by_payload.setdefault(tuple(sorted(command_payload.items())), []).append(device.id)
+        for items, device_ids in by_payload.items():
+            Device.objects.filter(pk__in=device_ids).patch_state(dict(items))
+        if targets:
+            states = dict(
+                Device.objects.filter(pk__in=[device.id for device, _ in targets]).values_list("id", "current_state")
+            )
+            for device, _ in targets:
+                device.current_state = states.get(device.id, device.current_state)
+
+        # paho 的 publish 只入队、不等待 broker 回执，连续发布即为流水线
+        commands = [publish_device_command(device_id=device.id, payload=command_payload)
+                    for device, command_payload in targets]
+        wait_seconds = acks.parse_wait_seconds(request.query_params.get("wait"))
+        if wait_seconds > 0:
+            acks.wait_all([command for command in commands if command is not None], wait_seconds)
+        for (device, command_payload), command in zip(targets, commands):
+            results.append({
+                "device_id": device.id,
+                "status": "sent",
+                "payload": command_payload,
+                "current_state": device.current_state,
+                "command": command.to_dict() if command is not None else None,
+            })
+
+        found = {device.id for device in devices}
+        results.extend(
+            {"device_id": device_id, "status": "not_found"}
+            for device_id in params.get("ids", ()) if device_id not in found
+        )
+        results.sort(key=lambda item: item["device_id"])
+        return Response({"count": len(targets), "results": results})
 
     @action(detail=True, methods=["post"])
     def set_temp(self, request, pk=None):
@@ -107,17 +274,7 @@ class DeviceViewSet(viewsets.ModelViewSet):
                 {"error": "温度值必须是数字"}, status=status.HTTP_400_BAD_REQUEST
             )
 
-        # 更新 current_state
-        state = device.current_state.copy()
-        state["temp"] = temp
-        state["on"] = True  # 设置温度时自动开启
-        device.current_state = state
-        device.save(update_fields=["current_state", "updated_at"])
-
-        from mqtt_gateway.utils import publish_device_command
-        publish_device_command(device_id=device.id, payload={"temp": temp, "on": True})
-
-        return Response({"current_state": device.current_state})
+        return self._send_command(device, {"temp": temp, "on": True})
 
     @action(detail=True, methods=["post"])
     def set_fan_speed(self, request, pk=None):
@@ -145,17 +302,7 @@ class DeviceViewSet(viewsets.ModelViewSet):
                 {"error": "档位必须是 1、2 或 3"}, status=status.HTTP_400_BAD_REQUEST
             )
 
-        # 更新 current_state
-        state = device.current_state.copy()
-        state["speed"] = speed
-        state["on"] = True  # 设置档位时自动开启
-        device.current_state = state
-        device.save(update_fields=["current_state", "updated_at"])
-
-        from mqtt_gateway.utils import publish_device_command
-        publish_device_command(device_id=device.id, payload={"speed": speed, "on": True})
-
-        return Response({"current_state": device.current_state})
+        return self._send_command(device, {"speed": speed, "on": True})
 
 
 class DeviceHistoryView(APIView):
@@ -179,12 +326,18 @@ class DeviceHistoryView(APIView):
         query_serializer.is_valid(raise_exception=True)
         start, end = query_serializer.get_time_range()
 
-        qs = (
-            DeviceData.objects.filter(device=device, timestamp__gte=start, timestamp__lte=end)
-            .order_by("timestamp")
-        )
-        data = DeviceHistoryPointSerializer(qs, many=True).data
-        return Response({"device_id": device.id, "range": query_serializer.validated_data.get("range", "24h"), "points": data})
+        def build():
+            qs = (
+                DeviceData.objects.filter(device=device, timestamp__gte=start, timestamp__lte=end)
+                .order_by("timestamp")
+            )
+            data = DeviceHistoryPointSerializer(qs, many=True).data
+            return Response(
+                {"device_id": device.id, "range": query_serializer.validated_data.get("range", "24h"), "points": data}
+            )
+
+        last_data_id = DeviceData.objects.filter(device=device).aggregate(last=Max("id"))["last"]
+        return etag_response(request, (last_data_id, time_bucket()), build)
         
 
 class EnergyAnalysisView(APIView):
@@ -196,11 +349,7 @@ class EnergyAnalysisView(APIView):
     permission_classes = [IsAuthenticated]
 
     def _get_accessible_devices(self, request):
-        user = request.user
-        qs = Device.objects.all().order_by("id")
-        if user.is_staff or user.is_superuser:
-            return qs
-        return (qs.filter(owner=user) | qs.filter(is_public=True)).distinct()
+        return visible_devices(request.user, Device.objects.order_by("id"))
 
     def get(self, request):
         query_serializer = EnergyAnalysisQuerySerializer(data=request.query_params)
@@ -211,22 +360,25 @@ class EnergyAnalysisView(APIView):
 
         qs = self._get_accessible_devices(request)
         if device_id is not None:
-            try:
-                devices = [qs.get(pk=device_id)]
-            except Device.DoesNotExist:
-                return Response(
-                    {"detail": "设备不存在或无权限访问。"},
-                    status=status.HTTP_404_NOT_FOUND,
-                )
-        else:
+            qs = qs.filter(pk=device_id)
+        stamp = _devices_stamp(qs)
+        if device_id is not None and not stamp[0]:
+            return Response(
+                {"detail": "设备不存在或无权限访问。"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        last_data_id = DeviceData.objects.filter(device__in=qs.values("id")).aggregate(last=Max("id"))["last"]
+
+        def build():
             devices = list(qs)
+            analysis = build_energy_analysis(devices=devices, range_value=range_value)
+            analysis["scope"] = {
+                "device_id": device_id,
+                "device_count": len(devices),
+            }
+            return Response(analysis)
 
-        analysis = build_energy_analysis(devices=devices, range_value=range_value)
-        analysis["scope"] = {
-            "device_id": device_id,
-            "device_count": len(devices),
-        }
-        return Response(analysis)
+        return etag_response(request, (*stamp, last_data_id, time_bucket()), build)
 
 
 class EnergyAnalysisExportCsvView(APIView):
@@ -238,11 +390,7 @@ class EnergyAnalysisExportCsvView(APIView):
     permission_classes = [IsAuthenticated]
 
     def _get_accessible_devices(self, request):
-        user = request.user
-        qs = Device.objects.all().order_by("id")
-        if user.is_staff or user.is_superuser:
-            return qs
-        return (qs.filter(owner=user) | qs.filter(is_public=True)).distinct()
+        return visible_devices(request.user, Device.objects.order_by("id"))
 
     def get(self, request):
         query_serializer = EnergyAnalysisQuerySerializer(data=request.query_params)
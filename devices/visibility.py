@@ -0,0 +1,111 @@
+"""
+设备可见性：普通用户可见「自己名下的设备 + 公共设备」，管理员可见全部。
+
+- 设备列表、能耗分析、实时推送（SSE）等只读批量路径通过 visible_devices() 取设备，不再各自拼 OR 查询；
+  每个用户的可见设备 ID 集合缓存在 Django cache 中（TTL_SECONDS），缓存键包含全局代数（generation）
+- 设备新增 / 删除、owner 或 is_public 变化时递增代数；代数保存在数据库（DeviceVisibilityStamp 单行），
+  每次读取可见集合时按主键查询一次，因此其他工作进程与 SSE 推送在下一次请求 / 轮询时即失效
+- 控制 / 修改设备的鉴权（for_write=True）不使用缓存，直接在 SQL 中过滤（走 (owner, is_public) 复合索引）
+- 绕过信号的批量 QuerySet.update(owner=..., is_public=...) 需自行调用 invalidate()
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, Q
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .models import Device, DeviceVisibilityStamp
+
+CACHE_PREFIX = "devices:visible:"
+STAMP_PK = 1
+
+# 影响可见性的字段
+VISIBILITY_FIELDS = ("owner", "owner_id", "is_public")
+
+
+def visibility_config() -> dict:
+    return getattr(settings, "DEVICE_VISIBILITY_CACHE", {})
+
+
+def is_admin(user) -> bool:
+    return bool(user.is_staff or user.is_superuser)
+
+
+def _generation() -> int:
+    version = DeviceVisibilityStamp.objects.filter(pk=STAMP_PK).values_list("version", flat=True).first()
+    return version or 1
+
+
+def invalidate() -> None:
+    """设备归属或公开状态变化后调用：让所有进程、所有用户的可见集合失效。"""
+    if not DeviceVisibilityStamp.objects.filter(pk=STAMP_PK).update(version=F("version") + 1):
+        # 代数行缺失（如被手工清理）：重新创建，版本号与缺失时读到的默认值不同即等同于失效
+        DeviceVisibilityStamp.objects.get_or_create(pk=STAMP_PK, defaults={"version": 2})
+
+
+def visible_q(user) -> Q:
+    return Q(owner=user) | Q(is_public=True)
+
+
+def visible_device_ids(user) -> frozenset:
+    """普通用户可见的设备 ID 集合（带缓存，可能滞后最多 TTL_SECONDS，仅用于只读展示）。"""
+    key = f"{CACHE_PREFIX}{_generation()}:{user.pk}"
+    ids = cache.get(key)
+    if ids is None:
+        ids = list(Device.objects.filter(visible_q(user)).values_list("id", flat=True))
+        cache.set(key, ids, timeout=visibility_config().get("TTL_SECONDS", 300))
+    return frozenset(ids)
+
+
+def visible_devices(user, queryset=None, for_write: bool = False):
+    """
+    按可见性过滤设备；queryset 为空时从全部设备开始，保留调用方的排序。
+    for_write=True（控制、修改等需要鉴权的操作）时不使用缓存，直接按当前数据库状态过滤。
+    """
+    qs = Device.objects.all() if queryset is None else queryset
+    if is_admin(user):
+        return qs
+    if for_write:
+        return qs.filter(visible_q(user))
+    ids = visible_device_ids(user)
+    if not ids:
+        return qs.none()
+    return qs.filter(pk__in=ids)
+
+
+def can_view(user, device: Device) -> bool:
+    return is_admin(user) or device.is_public or device.owner_id == user.pk
+
+
+# ==== 失效 ====
+
+
+def _touches_visibility(update_fields) -> bool:
+    return update_fields is None or bool(set(update_fields) & set(VISIBILITY_FIELDS))
+
+
+@receiver(pre_save, sender=Device)
+def _compare_visibility(sender, instance, update_fields=None, **kwargs):
+    # 只在可能修改 owner / is_public 的保存中读取旧值（网关的状态写入带 update_fields，不产生查询）
+    instance._visibility_changed = False
+    if instance._state.adding or instance.pk is None or not _touches_visibility(update_fields):
+        return
+    previous = Device.objects.filter(pk=instance.pk).values_list("owner_id", "is_public").first()
+    instance._visibility_changed = previous != (instance.owner_id, instance.is_public)
+
+
+@receiver(post_save, sender=Device)
+def _invalidate_on_save(sender, instance, created, update_fields=None, **kwargs):
+    if created:
+        # 新设备只有公开或有归属时才会出现在某个用户的可见集合中
+        changed = instance.is_public or instance.owner_id is not None
+    else:
+        changed = getattr(instance, "_visibility_changed", False)
+    if changed:
+        invalidate()
+
+
+@receiver(post_delete, sender=Device)
+def _invalidate_on_delete(sender, instance, **kwargs):
+    invalidate()
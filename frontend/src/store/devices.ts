@@ -20,6 +20,7 @@ export interface Device {
   is_online: boolean;
   is_public: boolean;
   current_state: Record<string, any>;
+  state_version?: number;
   owner: number | null;
   created_at?: string;
   updated_at?: string;
@@ -11,13 +11,16 @@ export interface SystemLog {
   created_at: string;
 }
 
+// 页面上最多保留的日志条数
+const MAX_LOGS = 200;
+
 export const useLogsStore = defineStore("logs", {
   state: () => ({
     list: [] as SystemLog[],
     loading: false,
   }),
   actions: {
-    async fetchLogs(params?: { limit?: number; source?: string; level?: string }) {
+    async fetchLogs(params?: { limit?: number; source?: string; level?: string; before_id?: number }) {
       this.loading = true;
       try {
         const res = await api.get<SystemLog[]>("/api/logs/system/", { params });
@@ -26,5 +29,17 @@ export const useLogsStore = defineStore("logs", {
         this.loading = false;
       }
     },
+    // 增量轮询：只拉取比当前最新一条更新的日志（since_id 模式按 id 正序返回）
+    async fetchNewLogs() {
+      if (!this.list.length) {
+        return this.fetchLogs({ limit: MAX_LOGS });
+      }
+      const res = await api.get<SystemLog[]>("/api/logs/system/", {
+        params: { since_id: this.list[0].id, limit: MAX_LOGS },
+      });
+      if (res.data.length) {
+        this.list = [...res.data.reverse(), ...this.list].slice(0, MAX_LOGS);
+      }
+    },
   },
 });
@@ -7,7 +7,7 @@ export interface SceneRule {
   enabled: boolean;
   owner: number;
   owner_username: string;
-  trigger_type: "THRESHOLD_ABOVE" | "THRESHOLD_BELOW" | "RANGE_OUT" | "TIME_STATE";
+  trigger_type: "THRESHOLD_ABOVE" | "THRESHOLD_BELOW" | "RANGE_OUT" | "TIME_STATE" | "COMPOSITE";
   trigger_device: number;
   trigger_device_detail?: any;
   trigger_field: string;
@@ -17,11 +17,14 @@ export interface SceneRule {
   trigger_state_device: number | null;
   trigger_state_device_detail?: any;
   trigger_state_value: Record<string, any> | null;
+  conditions?: Record<string, any> | null;
   action_device: number;
   action_device_detail?: any;
   action_type: "TOGGLE" | "SET_TEMP" | "SET_FAN_SPEED" | "TURN_ON" | "TURN_OFF";
   action_value: number | { temp?: number; speed?: number } | null;
   debounce_seconds: number;
+  trigger_mode: "LEVEL" | "EDGE";
+  hysteresis: number;
   created_at: string;
   updated_at: string;
   last_triggered_at: string | null;
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.11 on 2026-10-20 04:18
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('logs_app', '0002_emailalertrule'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='systemlog',
+            index=models.Index(fields=['user', 'id'], name='systemlog_user_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='systemlog',
+            index=models.Index(fields=['source', 'id'], name='systemlog_source_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='systemlog',
+            index=models.Index(fields=['level', 'id'], name='systemlog_level_id_idx'),
+        ),
+    ]
@@ -2,6 +2,14 @@ from django.conf import settings
 from django.db import models
 
 
+class SystemLogQuerySet(models.QuerySet):
+    def visible_to(self, user):
+        """管理员可见全部；普通用户可见与自己相关或无 user 关联的日志（单列 OR，可走 (user, id) 索引）。"""
+        if user.is_staff or user.is_superuser:
+            return self
+        return self.filter(models.Q(user__isnull=True) | models.Q(user=user))
+
+
 class SystemLog(models.Model):
     """
     系统/调试日志，用于“调试信息”页面展示。
@@ -32,10 +40,18 @@ class SystemLog(models.Model):
 
     created_at = models.DateTimeField(auto_now_add=True, db_index=True)
 
+    objects = SystemLogQuerySet.as_manager()
+
     class Meta:
         verbose_name = "系统日志"
         verbose_name_plural = "系统日志"
         ordering = ["-created_at"]
+        indexes = [
+            # 日志列表按 id 做键集分页（before_id / since_id），常用过滤条件与 id 组成复合索引
+            models.Index(fields=["user", "id"], name="systemlog_user_id_idx"),
+            models.Index(fields=["source", "id"], name="systemlog_source_id_idx"),
+            models.Index(fields=["level", "id"], name="systemlog_level_id_idx"),
+        ]
 
     def __str__(self) -> str:
         return f"[{self.level}] {self.source}: {self.message[:40]}"
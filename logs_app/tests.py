@@ -1,3 +1,36 @@
+from django.contrib.auth import get_user_model
 from django.test import TestCase
+from rest_framework.test import APIClient
 
-# Create your tests here.
+from .models import SystemLog
+
+
+class SystemLogKeysetTests(TestCase):
+    def setUp(self):
+        user_model = get_user_model()
+        self.user = user_model.objects.create_user(username="log_user", password="pass123456")
+        other = user_model.objects.create_user(username="log_other", password="pass123456")
+        self.logs = [
+            SystemLog.objects.create(source="MQTT_GATEWAY", message=f"公共 {i}") for i in range(5)
+        ]
+        self.logs.append(SystemLog.objects.create(source="SCENE_RULE", message="自己的", user=self.user))
+        SystemLog.objects.create(source="SCENE_RULE", message="别人的", user=other)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.url = "/api/logs/system/"
+
+    def ids(self, **params):
+        return [item["id"] for item in self.client.get(self.url, params).json()]
+
+    def test_before_id_pages_backwards(self):
+        expected = [log.id for log in reversed(self.logs)]
+        first = self.ids(limit=4)
+        self.assertEqual(first, expected[:4])
+        self.assertEqual(self.ids(limit=4, before_id=first[-1]), expected[4:])
+
+    def test_since_id_returns_only_new_rows_in_order(self):
+        last_id = self.logs[-1].id
+        self.assertEqual(self.ids(since_id=last_id), [])
+        new = SystemLog.objects.create(source="MQTT_GATEWAY", message="新日志")
+        self.assertEqual(self.ids(since_id=last_id), [new.id])
+        self.assertEqual(self.ids(since_id=self.logs[2].id, source="MQTT_GATEWAY"), [self.logs[3].id, self.logs[4].id, new.id])
@@ -1,9 +1,13 @@
-from rest_framework import mixins, viewsets
+from django.conf import settings
+from django.db.models import Max, Min
+from rest_framework import mixins, status, viewsets
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 
 from accounts.permissions import IsAdminUserRole
+from scenes.backtest import backtest_email_rule, parse_range
+from smart_home_backend.conditional import etag_response
 from .models import EmailAlertRule, SystemLog
 from .serializers import EmailAlertRuleSerializer, SystemLogSerializer
 
@@ -13,14 +17,22 @@ class SystemLogViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
     系统日志列表：
     - 管理员：查看所有日志
     - 普通用户：仅查看与自己相关或无 user 关联的日志
+    按 id 键集分页（单次最多 limit 条，默认 SYSTEM_LOG_LIST['DEFAULT_LIMIT']）：
+    - 默认 / ?before_id=N：id 小于 N 的最新日志，按 id 倒序（翻看更早的日志）
+    - ?since_id=N：id 大于 N 的新日志，按 id 正序；轮询时传入已有的最大 id，只取新增行
     """
 
     serializer_class = SystemLogSerializer
     permission_classes = [IsAuthenticated]
 
-    def get_queryset(self):
-        user = self.request.user
-        qs = SystemLog.objects.all()
+    def _int_param(self, name: str):
+        try:
+            return int(self.request.query_params[name])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def _filtered_queryset(self):
+        qs = SystemLog.objects.visible_to(self.request.user)
 
         level = self.request.query_params.get("level")
         if level:
@@ -31,21 +43,29 @@ class SystemLogViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
                 qs = qs.filter(source__in=["ALERT", "EMAIL_ALERT"])
             else:
                 qs = qs.filter(source=source)
-
-        if user.is_staff or user.is_superuser:
-            pass
-        else:
-            qs = qs.filter(user__isnull=True) | qs.filter(user=user)
-
-        limit = self.request.query_params.get("limit")
-        if limit is not None:
-            try:
-                n = min(int(limit), 500)
-                qs = qs[:n]
-            except ValueError:
-                pass
         return qs
 
+    def get_queryset(self):
+        config = getattr(settings, "SYSTEM_LOG_LIST", {})
+        limit = self._int_param("limit") or config.get("DEFAULT_LIMIT", 200)
+        limit = min(max(1, limit), config.get("MAX_LIMIT", 500))
+
+        qs = self._filtered_queryset()
+        since_id = self._int_param("since_id")
+        if since_id is not None:
+            return qs.filter(id__gt=since_id).order_by("id")[:limit]
+        before_id = self._int_param("before_id")
+        if before_id is not None:
+            qs = qs.filter(id__lt=before_id)
+        return qs.order_by("-id")[:limit]
+
+    def list(self, request, *args, **kwargs):
+        # 最大 / 最小 ID 覆盖新增日志与保留期清理，不变时返回 304
+        agg = self._filtered_queryset().aggregate(last=Max("id"), first=Min("id"))
+        return etag_response(
+            request, (agg["last"], agg["first"]), lambda: super(SystemLogViewSet, self).list(request, *args, **kwargs)
+        )
+
 
 class EmailAlertRuleViewSet(viewsets.ModelViewSet):
     """邮件告警规则 CRUD，仅管理员。"""
@@ -54,6 +74,18 @@ class EmailAlertRuleViewSet(viewsets.ModelViewSet):
     serializer_class = EmailAlertRuleSerializer
     permission_classes = [IsAuthenticated, IsAdminUserRole]
 
+    @action(detail=True, methods=["get"])
+    def backtest(self, request, pk=None):
+        """回测：GET /api/alerts/email-rules/{id}/backtest/?range=7d，统计历史数据中会触发告警的次数与时间。"""
+        rule = self.get_object()
+        try:
+            start, end = parse_range(request.query_params.get("range"))
+            result = backtest_email_rule(rule, start, end)
+        except ValueError as e:
+            # 包括 BacktestTooLarge：区间内数据过多
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({"rule_id": rule.id, "range": request.query_params.get("range") or "7d", **result})
+
     @action(detail=True, methods=["post"])
     def toggle_enabled(self, request, pk=None):
         rule = self.get_object()
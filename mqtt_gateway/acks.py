@@ -0,0 +1,214 @@
+"""
+设备命令确认（cmd → ack）跟踪。
+
+- publish_device_command 为每条命令分配 cmd_id（写入 payload），并登记到进程内的待确认表
+- 确认来源：
+    1. 设备发布 home/{id}/ack：{"cmd_id": "...", "ok": true | false, "error": "..."}
+    2. 设备回显 home/{id}/state：payload 带同一 cmd_id（推荐）；
+       不回显 cmd_id 的设备，仅当上报包含命令的全部字段与取值、且这些字段相对命令登记时
+       最后一次上报的状态确实发生了变化时才视为确认——否则命令前已是同样状态的周期性上报
+       会把设备从未收到的命令误判为已确认；登记时尚无该设备的上报则只能通过 cmd_id 确认
+  网关同时订阅 cmd / state / ack，是唯一能看到状态回显的进程；由状态回显确认的命令，
+  网关会补发一条 ack（via=state），API 进程只需订阅 ack 即可唤醒等待中的请求
+- 超过 TIMEOUT_SECONDS 未确认的命令记为超时；过期在每次访问待确认表时顺带清理
+- 指标：确认耗时直方图、按结果统计的命令数、待确认命令数
+"""
+
+import heapq
+import threading
+import time
+import uuid
+from typing import Optional
+
+from django.conf import settings
+
+from mqtt_gateway import metrics
+
+STATUS_PENDING = "pending"
+STATUS_ACKED = "acked"
+STATUS_FAILED = "failed"
+STATUS_TIMEOUT = "timeout"
+
+# 不参与状态回显比较的命令字段
+META_KEYS = ("cmd_id", "trace_id")
+
+
+def ack_config() -> dict:
+    return getattr(settings, "MQTT_COMMAND_ACK", {})
+
+
+def new_command_id() -> str:
+    return uuid.uuid4().hex[:12]
+
+
+class PendingCommand:
+    __slots__ = ("cmd_id", "device_id", "payload", "baseline", "sent_at", "deadline", "status", "via", "error",
+                 "latency", "_event")
+
+    def __init__(self, cmd_id: str, device_id: int, payload: dict, timeout: float, baseline: Optional[dict] = None):
+        self.cmd_id = cmd_id
+        self.device_id = device_id
+        self.payload = {k: v for k, v in (payload or {}).items() if k not in META_KEYS}
+        # 登记命令时该设备最后一次上报的状态（未知时为 None）
+        self.baseline = baseline
+        self.sent_at = time.monotonic()
+        self.deadline = self.sent_at + timeout
+        self.status = STATUS_PENDING
+        self.via = None
+        self.error = None
+        self.latency: Optional[float] = None
+        self._event = threading.Event()
+
+    def matches_state(self, state: dict) -> bool:
+        if state.get("cmd_id") == self.cmd_id:
+            return True
+        # 无 cmd_id 回显：字段全部一致，且至少一个字段相对命令前的状态发生了变化
+        if not self.payload or self.baseline is None:
+            return False
+        if not all(key in state and state[key] == value for key, value in self.payload.items()):
+            return False
+        return any(self.baseline.get(key) != value for key, value in self.payload.items())
+
+    def wait(self, timeout: float) -> str:
+        """阻塞至确认 / 失败或 timeout 秒（线程事件，不轮询数据库）。"""
+        self._event.wait(max(0.0, timeout))
+        return self.status
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.cmd_id,
+            "status": self.status,
+            "via": self.via,
+            "error": self.error,
+            "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+        }
+
+
+class CommandTracker:
+    """线程安全的待确认命令表：cmd_id -> PendingCommand，并按设备保存发送顺序。"""
+
+    def __init__(self, timeout_seconds: float = 10.0, max_pending: int = 10000):
+        self.timeout_seconds = float(timeout_seconds)
+        self.max_pending = max(1, int(max_pending))
+        self._pending: dict[str, PendingCommand] = {}
+        self._by_device: dict[int, list[str]] = {}
+        self._deadlines: list[tuple[float, str]] = []
+        # 每台设备最后一次上报的状态，作为新命令的基线
+        self._last_state: dict[int, dict] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def get(self, cmd_id: str) -> Optional[PendingCommand]:
+        return self._pending.get(cmd_id)
+
+    def register(self, device_id: int, payload: dict, cmd_id: Optional[str] = None,
+                 timeout: Optional[float] = None) -> PendingCommand:
+        """登记一条已（将要）发布的命令；同一 cmd_id 已登记时返回原记录。"""
+        cmd_id = cmd_id or new_command_id()
+        with self._lock:
+            self._expire_locked(time.monotonic())
+            existing = self._pending.get(cmd_id)
+            if existing is not None:
+                return existing
+            while len(self._pending) >= self.max_pending:
+                _, oldest = heapq.heappop(self._deadlines)
+                if oldest in self._pending:
+                    self._finish_locked(self._pending[oldest], STATUS_TIMEOUT, error="evicted")
+            command = PendingCommand(
+                cmd_id, device_id, payload, self.timeout_seconds if timeout is None else timeout,
+                baseline=self._last_state.get(device_id),
+            )
+            self._pending[cmd_id] = command
+            self._by_device.setdefault(device_id, []).append(cmd_id)
+            heapq.heappush(self._deadlines, (command.deadline, cmd_id))
+            metrics.commands_pending.set(len(self._pending))
+        return command
+
+    def ack(self, cmd_id: str, ok: bool = True, error: Optional[str] = None,
+            via: str = "ack") -> Optional[PendingCommand]:
+        """处理设备 / 网关发来的 ack；未知或已结束的 cmd_id 返回 None。"""
+        with self._lock:
+            self._expire_locked(time.monotonic())
+            command = self._pending.get(cmd_id)
+            if command is None:
+                return None
+            self._finish_locked(command, STATUS_ACKED if ok else STATUS_FAILED, via=via, error=error)
+        return command
+
+    def match_state(self, device_id: int, state: dict) -> list[PendingCommand]:
+        """用设备状态回显确认该设备的待确认命令，返回被确认的命令（按发送顺序）；同时记录为该设备的最新状态。"""
+        if not isinstance(state, dict):
+            return []
+        with self._lock:
+            self._expire_locked(time.monotonic())
+            last = self._last_state.get(device_id, {})
+            self._last_state[device_id] = {**last, **{k: v for k, v in state.items() if k not in META_KEYS}}
+            confirmed = [
+                self._pending[cmd_id]
+                for cmd_id in self._by_device.get(device_id, ())
+                if self._pending[cmd_id].matches_state(state)
+            ]
+            for command in confirmed:
+                self._finish_locked(command, STATUS_ACKED, via="state")
+        return confirmed
+
+    def expire(self, now: Optional[float] = None) -> int:
+        with self._lock:
+            return self._expire_locked(time.monotonic() if now is None else now)
+
+    def _expire_locked(self, now: float) -> int:
+        expired = 0
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, cmd_id = heapq.heappop(self._deadlines)
+            command = self._pending.get(cmd_id)
+            if command is not None:
+                self._finish_locked(command, STATUS_TIMEOUT)
+                expired += 1
+        return expired
+
+    def _finish_locked(self, command: PendingCommand, status: str, via: Optional[str] = None,
+                       error: Optional[str] = None) -> None:
+        command.status = status
+        command.via = via
+        command.error = error
+        self._pending.pop(command.cmd_id, None)
+        device_queue = self._by_device.get(command.device_id)
+        if device_queue is not None:
+            device_queue.remove(command.cmd_id)
+            if not device_queue:
+                del self._by_device[command.device_id]
+        if status == STATUS_ACKED:
+            command.latency = time.monotonic() - command.sent_at
+            metrics.command_ack_seconds.observe(command.latency, via=via or "ack")
+        metrics.commands_total.inc(result=status)
+        metrics.commands_pending.set(len(self._pending))
+        command._event.set()
+
+
+tracker = CommandTracker(
+    timeout_seconds=ack_config().get("TIMEOUT_SECONDS", 10),
+    max_pending=ack_config().get("MAX_PENDING", 10000),
+)
+
+
+def enabled() -> bool:
+    return bool(ack_config().get("ENABLED", True))
+
+
+def wait_all(commands, timeout: float) -> None:
+    """等待一批命令确认，共用同一个截止时间（总耗时不超过 timeout）。"""
+    deadline = time.monotonic() + timeout
+    for command in commands:
+        if command.status == STATUS_PENDING:
+            command.wait(deadline - time.monotonic())
+
+
+def parse_wait_seconds(value) -> float:
+    """API 的 ?wait= 参数：非法值按 0 处理，上限为 MAX_WAIT_SECONDS。"""
+    try:
+        seconds = float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+    return max(0.0, min(seconds, float(ack_config().get("MAX_WAIT_SECONDS", 5))))
@@ -1,6 +1,34 @@
+import os
+import sys
+
 from django.apps import AppConfig
+from django.conf import settings
+
+# 服务入口（smart_home_backend/asgi.py、wsgi.py）在加载应用前设置该环境变量，
+# 只有处理请求的进程才预先连接 broker；管理命令、测试、网关进程都不会设置
+PREWARM_ENV = "MQTT_PUBLISHER_PREWARM"
+
+
+def _is_runserver_child() -> bool:
+    # runserver 在 ready() 之后才加载 WSGI 入口，单独识别；自动重载的父进程不处理请求
+    if len(sys.argv) < 2 or os.path.basename(sys.argv[0]) != "manage.py" or sys.argv[1] != "runserver":
+        return False
+    return os.environ.get("RUN_MAIN") == "true" or "--noreload" in sys.argv
+
+
+def _should_prewarm() -> bool:
+    if not getattr(settings, "MQTT_PUBLISHER", {}).get("AUTOSTART", True):
+        return False
+    return os.environ.get(PREWARM_ENV) == "1" or _is_runserver_child()
 
 
 class MqttGatewayConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'mqtt_gateway'
+
+    def ready(self):
+        # 预先启动本进程的 MQTT 发布服务，首个请求无需等待连接
+        if _should_prewarm():
+            from mqtt_gateway.utils import get_publisher
+
+            get_publisher()
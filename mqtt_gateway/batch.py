@@ -0,0 +1,114 @@
+"""
+批量上报 home/{id}/batch 的解析：设备断网期间缓存的读数带设备侧时间戳一次性上传。
+
+payload 为 JSON 数组（或 {"readings": [...]}），每项形如 {"ts": <时间>, "data": {...}}：
+  - ts 支持 Unix 秒 / 毫秒时间戳，或 ISO 8601 字符串（带时区时转换为本地时间）
+  - 整个 payload 可选用 gzip 或 zlib 压缩，按魔数自动识别
+  - 解压后的内容按 mqtt_gateway.codec 解码，可以是 JSON / CBOR / MessagePack
+"""
+
+import zlib
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from mqtt_gateway.codec import CodecError, decode_payload
+
+GZIP_MAGIC = b"\x1f\x8b"
+# zlib 头第一个字节固定为 0x78（deflate, 32K 窗口），第二个字节随压缩级别变化
+ZLIB_HEADERS = (b"\x78\x01", b"\x78\x5e", b"\x78\x9c", b"\x78\xda")
+
+
+class BatchPayloadError(ValueError):
+    """批量 payload 整体无法解析。"""
+
+
+def _batch_config() -> dict:
+    return getattr(settings, "MQTT_GATEWAY_BATCH", {})
+
+
+def decompress_payload(raw: bytes) -> bytes:
+    """按魔数识别 gzip / zlib 压缩并解压，未压缩时原样返回；限制解压后大小，防止压缩炸弹。"""
+    if raw[:2] == GZIP_MAGIC:
+        wbits = 16 + zlib.MAX_WBITS
+    elif raw[:2] in ZLIB_HEADERS:
+        wbits = zlib.MAX_WBITS
+    else:
+        return raw
+    max_bytes = int(_batch_config().get("MAX_DECOMPRESSED_BYTES", 16 * 1024 * 1024))
+    decompressor = zlib.decompressobj(wbits)
+    try:
+        data = decompressor.decompress(raw, max_bytes + 1)
+    except zlib.error as e:
+        raise BatchPayloadError(f"解压失败: {e}")
+    if len(data) > max_bytes or decompressor.unconsumed_tail:
+        raise BatchPayloadError(f"解压后大小超过上限 {max_bytes}")
+    return data
+
+
+def parse_timestamp(value):
+    """将设备侧时间戳转换为与 DeviceData.timestamp 一致的时间（USE_TZ=False 时为本地 naive 时间）。"""
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, (int, float)):
+        seconds = float(value)
+        # 大于 1e11 视为毫秒时间戳
+        if seconds > 1e11:
+            seconds /= 1000.0
+        try:
+            dt = datetime.fromtimestamp(seconds, tz=timezone.get_current_timezone())
+        except (OverflowError, OSError, ValueError):
+            return None
+    elif isinstance(value, str):
+        try:
+            dt = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+        except ValueError:
+            return None
+        if timezone.is_naive(dt):
+            dt = timezone.make_aware(dt)
+    else:
+        return None
+    if not settings.USE_TZ:
+        dt = timezone.make_naive(dt)
+    return dt
+
+
+def parse_batch_payload(raw: bytes, now=None, codec_name=None) -> tuple[list[tuple[datetime, dict]], int]:
+    """
+    解析批量 payload，返回 (按时间升序的 [(timestamp, data)], 被丢弃的条目数)。
+    丢弃：时间戳无法解析、data 非 JSON 对象、时间戳超前服务器时间超过允许偏差的条目。
+    codec_name 为主题中显式指定的编解码器，为空时按内容标记与默认配置选择。
+    """
+    config = _batch_config()
+    max_items = int(config.get("MAX_ITEMS", 5000))
+    max_future = timedelta(seconds=int(config.get("MAX_FUTURE_SKEW_SECONDS", 300)))
+    now = now or timezone.now()
+
+    data = decompress_payload(raw if isinstance(raw, (bytes, bytearray)) else str(raw).encode())
+    try:
+        body = decode_payload(data, codec_name)
+    except CodecError as e:
+        raise BatchPayloadError(str(e))
+    if isinstance(body, dict):
+        body = body.get("readings")
+    if not isinstance(body, list):
+        raise BatchPayloadError("批量 payload 必须是数组或 {\"readings\": [...]}")
+    if len(body) > max_items:
+        raise BatchPayloadError(f"批量条目数 {len(body)} 超过上限 {max_items}")
+
+    readings = []
+    rejected = 0
+    for item in body:
+        if not isinstance(item, dict):
+            rejected += 1
+            continue
+        ts = parse_timestamp(item.get("ts"))
+        reading = item.get("data")
+        if ts is None or not isinstance(reading, dict) or ts > now + max_future:
+            rejected += 1
+            continue
+        readings.append((ts, reading))
+    # 稳定排序：同一时间戳保持设备上传顺序
+    readings.sort(key=lambda r: r[0])
+    return readings, rejected
@@ -0,0 +1,163 @@
+"""
+MQTT payload 编解码层：JSON（优先使用 orjson）、CBOR、MessagePack。
+
+解码时的编解码器选择顺序：
+  1. 主题第 4 段显式指定：home/{id}/state/cbor、home/{id}/power/msgpack
+  2. 内容标记：以 CBOR 自描述标签（0xd9d9f7）开头的 payload 按 CBOR 解码
+  3. 否则使用 settings.MQTT_GATEWAY_CODECS['DEFAULT']（默认 json）
+
+CBOR / MessagePack 解码结果会转换为 JSON 兼容结构（键转为字符串、bytes 转为 base64 字符串），
+保证写入 DeviceData.data 的格式与 JSON 上报一致。
+cbor2 / msgpack 为可选依赖，未安装时对应编解码器不可用。
+"""
+
+import base64
+import json
+from datetime import date, datetime
+from typing import Optional
+
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:  # 未安装时退回标准库 json
+    orjson = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+CODEC_JSON = "json"
+CODEC_CBOR = "cbor"
+CODEC_MSGPACK = "msgpack"
+
+# RFC 8949 3.4.6：自描述 CBOR 标签 55799 的编码，设备可用它标记 payload 为 CBOR
+CBOR_SELF_DESCRIBE = b"\xd9\xd9\xf7"
+
+
+class CodecError(ValueError):
+    """payload 无法按指定编解码器编解码，或编解码器不可用。"""
+
+
+class JsonCodec:
+    name = CODEC_JSON
+
+    def available(self) -> bool:
+        return True
+
+    def decode(self, raw: bytes):
+        if orjson is not None:
+            try:
+                return orjson.loads(raw)
+            except orjson.JSONDecodeError as e:
+                raise CodecError(f"JSON 解析失败: {e}")
+        try:
+            return json.loads(raw)
+        except ValueError as e:
+            raise CodecError(f"JSON 解析失败: {e}")
+
+    def encode(self, obj) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(obj).encode()
+
+
+class CborCodec:
+    name = CODEC_CBOR
+
+    def available(self) -> bool:
+        return cbor2 is not None
+
+    def decode(self, raw: bytes):
+        try:
+            # cbor2 会自动剥离自描述标签 55799
+            return cbor2.loads(raw)
+        except Exception as e:
+            raise CodecError(f"CBOR 解析失败: {e}")
+
+    def encode(self, obj) -> bytes:
+        return cbor2.dumps(obj)
+
+
+class MsgPackCodec:
+    name = CODEC_MSGPACK
+
+    def available(self) -> bool:
+        return msgpack is not None
+
+    def decode(self, raw: bytes):
+        try:
+            return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+        except Exception as e:
+            raise CodecError(f"MessagePack 解析失败: {e}")
+
+    def encode(self, obj) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True)
+
+
+_CODECS = {codec.name: codec for codec in (JsonCodec(), CborCodec(), MsgPackCodec())}
+
+
+def _codec_config() -> dict:
+    return getattr(settings, "MQTT_GATEWAY_CODECS", {})
+
+
+def get_codec(name: str):
+    codec = _CODECS.get((name or "").lower())
+    if codec is None:
+        raise CodecError(f"未知编解码器: {name}")
+    if not codec.available():
+        raise CodecError(f"编解码器 {codec.name} 不可用（未安装对应依赖）")
+    return codec
+
+
+def select_codec(raw: bytes, topic_codec: Optional[str] = None) -> str:
+    """按主题显式指定 > 内容标记 > 默认配置的顺序确定编解码器名称。"""
+    if topic_codec:
+        return topic_codec.lower()
+    if raw[:3] == CBOR_SELF_DESCRIBE:
+        return CODEC_CBOR
+    return str(_codec_config().get("DEFAULT", CODEC_JSON)).lower()
+
+
+def to_jsonable(value):
+    """将 CBOR / MessagePack 解码结果转换为可直接存入 JSONField 的结构。"""
+    if isinstance(value, dict):
+        return {str(k): to_jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_jsonable(v) for v in value]
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(bytes(value)).decode("ascii")
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+def decode_payload(raw, codec_name: Optional[str] = None):
+    """解码 payload；codec_name 为空时按内容标记与默认配置选择。失败时抛出 CodecError。"""
+    if isinstance(raw, str):
+        raw = raw.encode()
+    codec = get_codec(codec_name or select_codec(raw))
+    obj = codec.decode(bytes(raw))
+    if codec.name != CODEC_JSON:
+        obj = to_jsonable(obj)
+    return obj
+
+
+def command_codec_name() -> str:
+    """下发命令默认使用的编解码器名称。"""
+    return str(_codec_config().get("COMMAND", CODEC_JSON)).lower()
+
+
+def encode_payload(obj, codec_name: Optional[str] = None) -> bytes:
+    """编码下发 payload；codec_name 为空时使用 settings.MQTT_GATEWAY_CODECS['COMMAND']。"""
+    codec = get_codec(codec_name or command_codec_name())
+    return codec.encode(obj)
@@ -0,0 +1,339 @@
+"""
+网关消息优先级通道：按设备类型与主题把消息分到不同通道，各通道由独立工作线程处理，
+避免烟雾告警 / LWT 离线等关键消息排在大量温湿度、功率上报之后。
+
+通道：
+  - alarm：所有 lwt 消息；烟雾传感器的全部上报（告警与解除需保持先后顺序）
+  - control：开关类执行设备（灯/空调/风扇）的 state 与 power
+  - telemetry：其余传感器上报（温湿度、光照、气压、人体感应）
+
+同一设备的 state/power 总是落在同一通道的同一分片（device_id 取模），保证单设备内有序；
+lwt 与 state 跨通道时，通过接收序号判断 state 是否已被更新的离线消息取代。
+MQTT 网络线程分类时只读设备类型缓存（启动时预加载，设备类型不会过期），不查库；缓存中没有的设备
+交给解析线程（不丢弃的队列）查库后再按类型分流与限流，该设备在解析完成前的后续消息也走解析线程，保持先后顺序。
+解析线程同时定期刷新缓存，拾取新增设备与类型变更。
+启用限流时，超速消息先在 IngestRateLimiter 中合并，由后台线程在令牌恢复后入队。
+"""
+
+import itertools
+import queue
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from django.db import close_old_connections
+
+from devices.constants import DeviceType
+from devices.models import Device
+from logs_app.models import SystemLog
+from mqtt_gateway import metrics
+from mqtt_gateway.ratelimit import IngestRateLimiter
+
+LANE_ALARM = "alarm"
+LANE_CONTROL = "control"
+LANE_TELEMETRY = "telemetry"
+LANES = (LANE_ALARM, LANE_CONTROL, LANE_TELEMETRY)
+
+ACTUATOR_TYPES = {
+    DeviceType.LAMP_SWITCH,
+    DeviceType.AC_SWITCH,
+    DeviceType.FAN_SWITCH,
+}
+
+
+def parse_topic(topic: str) -> tuple[Optional[int], str]:
+    """从 home/{id}/{suffix} 中提取设备 ID 与小写后缀；无法解析时设备 ID 为 None。"""
+    parts = topic.split("/")
+    if len(parts) < 3:
+        return None, ""
+    try:
+        device_id = int(parts[1])
+    except ValueError:
+        return None, parts[2].lower()
+    return device_id, parts[2].lower()
+
+
+def classify(suffix: str, device_type: Optional[str]) -> str:
+    """根据主题后缀与设备类型确定消息通道。"""
+    if suffix == "lwt" or device_type == DeviceType.SMOKE:
+        return LANE_ALARM
+    if device_type in ACTUATOR_TYPES:
+        return LANE_CONTROL
+    return LANE_TELEMETRY
+
+
+class DeviceTypeCache:
+    """
+    设备 ID -> 设备类型缓存，分类时无需每条消息查库；设备类型视为不可变，条目不过期，
+    超过 max_entries 时淘汰最久未用的。peek() 只读缓存（MQTT 网络线程使用），resolve() / prime() 查库。
+    """
+
+    def __init__(self, max_entries: int = 50000):
+        self.max_entries = max(1, int(max_entries))
+        self._items: OrderedDict[int, Optional[str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _store(self, device_id: int, device_type: Optional[str]) -> None:
+        # 调用方持有锁
+        self._items[device_id] = device_type
+        self._items.move_to_end(device_id)
+        while len(self._items) > self.max_entries:
+            self._items.popitem(last=False)
+
+    def peek(self, device_id: int) -> tuple[bool, Optional[str]]:
+        """只查缓存：返回 (是否命中, 设备类型)；未命中时不查库。"""
+        with self._lock:
+            if device_id not in self._items:
+                return False, None
+            self._items.move_to_end(device_id)
+            return True, self._items[device_id]
+
+    def resolve(self, device_id: int) -> Optional[str]:
+        """查库并写入缓存（不存在的设备缓存为 None，直到下次 prime() 刷新）。"""
+        device_type = Device.objects.filter(pk=device_id).values_list("type", flat=True).first()
+        with self._lock:
+            self._store(device_id, device_type)
+        return device_type
+
+    def get(self, device_id: int) -> Optional[str]:
+        hit, device_type = self.peek(device_id)
+        return device_type if hit else self.resolve(device_id)
+
+    def prime(self) -> None:
+        """加载设备类型（最多 max_entries 台），并清掉「设备不存在」的条目，让新建的设备重新查询。"""
+        rows = list(Device.objects.order_by("-id").values_list("id", "type")[: self.max_entries])
+        with self._lock:
+            for device_id in [key for key, value in self._items.items() if value is None]:
+                del self._items[device_id]
+            for device_id, device_type in reversed(rows):
+                self._store(device_id, device_type)
+
+    def invalidate(self, device_id: Optional[int] = None) -> None:
+        with self._lock:
+            if device_id is None:
+                self._items.clear()
+            else:
+                self._items.pop(device_id, None)
+
+
+class LaneDispatcher:
+    """
+    按通道分发消息到工作线程。
+    handler(topic, raw, received_seq) 在工作线程中调用。
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[str, bytes, int], None],
+        workers: Optional[dict] = None,
+        maxsize: Optional[dict] = None,
+        type_cache: Optional[DeviceTypeCache] = None,
+        limiter: Optional[IngestRateLimiter] = None,
+        flush_interval: float = 0.2,
+        type_refresh_seconds: float = 300.0,
+    ):
+        self.handler = handler
+        self.limiter = limiter
+        self.flush_interval = flush_interval
+        self.type_refresh_seconds = type_refresh_seconds
+        self._stop_event = threading.Event()
+        workers = workers or {}
+        maxsize = maxsize or {}
+        self.type_cache = type_cache or DeviceTypeCache()
+        self._seq = itertools.count(1)
+        self._lwt_seq: dict[int, int] = {}
+        self._lwt_lock = threading.Lock()
+        self._queues: dict[str, list[queue.Queue]] = {}
+        self._threads: list[threading.Thread] = []
+        self._flusher: Optional[threading.Thread] = None
+        # 等待查询设备类型的消息：(device_id, suffix, topic, raw, seq)；不设上限，不丢弃
+        self._resolve_queue: queue.Queue = queue.Queue()
+        # device_id -> 解析队列中该设备的消息数；大于 0 时新消息也必须排在解析队列中
+        self._resolving: dict[int, int] = {}
+        self._resolve_lock = threading.Lock()
+        self._resolver: Optional[threading.Thread] = None
+        for lane in LANES:
+            n = max(1, int(workers.get(lane, 1)))
+            size = max(0, int(maxsize.get(lane, 0)))
+            self._queues[lane] = [queue.Queue(maxsize=size) for _ in range(n)]
+
+    def start(self) -> None:
+        try:
+            self.type_cache.prime()
+        except Exception:
+            pass
+        for lane, shards in self._queues.items():
+            for index, q in enumerate(shards):
+                thread = threading.Thread(
+                    target=self._worker,
+                    args=(lane, q),
+                    name=f"gateway-{lane}-{index}",
+                    daemon=True,
+                )
+                thread.start()
+                self._threads.append(thread)
+        self._resolver = threading.Thread(target=self._resolve_loop, name="gateway-resolver", daemon=True)
+        self._resolver.start()
+        if self.limiter is not None:
+            self._flusher = threading.Thread(target=self._flush_loop, name="gateway-ratelimit", daemon=True)
+            self._flusher.start()
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """投递结束标记，等待已入队消息处理完毕。"""
+        self._stop_event.set()
+        if self._flusher is not None:
+            self._flusher.join(timeout=timeout)
+        if self._resolver is not None:
+            self._resolve_queue.put(None)
+            self._resolver.join(timeout=timeout)
+        for shards in self._queues.values():
+            for q in shards:
+                q.put(None)
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(timeout=max(0.0, deadline - time.monotonic()))
+
+    def depth(self, lane: str) -> int:
+        return sum(q.qsize() for q in self._queues[lane])
+
+    def submit(self, topic: str, raw: bytes) -> bool:
+        """
+        在 MQTT 网络线程中调用：分类并入队；队列已满时丢弃并计数（告警通道默认不设上限）。
+        超出设备速率的消息被限流器合并，返回 True 但暂不入队；类型未知的设备交给解析线程，不查库。
+        """
+        device_id, suffix = parse_topic(topic)
+        seq = next(self._seq)
+        if suffix == "lwt" and device_id is not None:
+            with self._lwt_lock:
+                self._lwt_seq[device_id] = seq
+
+        device_type = None
+        if device_id is not None and suffix != "lwt":
+            with self._resolve_lock:
+                hit, device_type = self.type_cache.peek(device_id)
+                if not hit or self._resolving.get(device_id):
+                    self._resolving[device_id] = self._resolving.get(device_id, 0) + 1
+                    self._resolve_queue.put_nowait((device_id, suffix, topic, raw, seq))
+                    return True
+        return self._admit(device_id, suffix, device_type, topic, raw, seq)
+
+    def _admit(self, device_id, suffix, device_type, topic, raw, seq) -> bool:
+        if self.limiter is not None:
+            decision = self.limiter.admit(device_id, device_type, suffix, topic, raw, seq)
+            if decision == IngestRateLimiter.COALESCED:
+                return True
+        return self._enqueue(device_id, suffix, device_type, topic, raw, seq)
+
+    def _resolve_loop(self) -> None:
+        """查询未知设备的类型后投递其消息；空闲或到期时刷新类型缓存。"""
+        refreshed_at = time.monotonic()
+        while True:
+            try:
+                item = self._resolve_queue.get(timeout=max(0.1, self.type_refresh_seconds))
+            except queue.Empty:
+                item = False
+            if item is None:
+                break
+            if self.type_refresh_seconds > 0 and time.monotonic() - refreshed_at >= self.type_refresh_seconds:
+                close_old_connections()
+                try:
+                    self.type_cache.prime()
+                except Exception:
+                    pass
+                refreshed_at = time.monotonic()
+            if item:
+                self._resolve_one(*item)
+        close_old_connections()
+
+    def _resolve_one(self, device_id, suffix, topic, raw, seq) -> None:
+        close_old_connections()
+        try:
+            try:
+                device_type = self.type_cache.get(device_id)
+            except Exception:
+                # 类型未知时不能判断是否为烟雾等免限流设备：不经过限流，投递到不丢弃的告警通道
+                self._enqueue(device_id, suffix, None, topic, raw, seq, lane=LANE_ALARM)
+            else:
+                self._admit(device_id, suffix, device_type, topic, raw, seq)
+        finally:
+            # 先入队再减计数：网络线程看到计数归零时，本条消息已在通道中，后续消息不会越过它
+            with self._resolve_lock:
+                remaining = self._resolving.get(device_id, 1) - 1
+                if remaining > 0:
+                    self._resolving[device_id] = remaining
+                else:
+                    self._resolving.pop(device_id, None)
+
+    def _enqueue(self, device_id, suffix, device_type, topic, raw, seq, lane: Optional[str] = None) -> bool:
+        lane = lane or classify(suffix, device_type)
+        shards = self._queues[lane]
+        q = shards[(device_id or 0) % len(shards)]
+        try:
+            q.put_nowait((topic, raw, seq, time.perf_counter()))
+        except queue.Full:
+            metrics.dropped_total.inc(reason=f"{lane}_queue_full")
+            return False
+        metrics.queue_depth.set(self.depth(lane), lane=lane)
+        return True
+
+    def lwt_seen_after(self, device_id: int, received_seq: Optional[int]) -> bool:
+        """该设备在 received_seq 之后是否已收到过 lwt（用于判断旧 state 是否应改写在线状态）。"""
+        if received_seq is None:
+            return False
+        with self._lwt_lock:
+            return self._lwt_seq.get(device_id, 0) > received_seq
+
+    def _worker(self, lane: str, q: queue.Queue) -> None:
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            topic, raw, seq, enqueued_at = item
+            metrics.queue_wait_seconds.observe(time.perf_counter() - enqueued_at, lane=lane)
+            metrics.queue_depth.set(self.depth(lane), lane=lane)
+            close_old_connections()
+            try:
+                self.handler(topic, raw, seq)
+            except Exception:
+                metrics.malformed_total.inc(reason="exception")
+        close_old_connections()
+
+    def _flush_loop(self) -> None:
+        """定期投递令牌已恢复的合并消息，并记录刷屏警告。"""
+        while not self._stop_event.wait(self.flush_interval):
+            for topic, raw, seq in self.limiter.flush_due():
+                device_id, suffix = parse_topic(topic)
+                self._enqueue(device_id, suffix, self._flush_type(device_id, suffix), topic, raw, seq)
+            events = self.limiter.drain_flood_events()
+            if events:
+                close_old_connections()
+                for event in events:
+                    try:
+                        self._log_flood(event)
+                    except Exception:
+                        pass
+
+    def _flush_type(self, device_id: Optional[int], suffix: str) -> Optional[str]:
+        # 后台线程可以查库：合并消息的设备通常已在缓存中，被淘汰时重新查询
+        if device_id is None or suffix == "lwt":
+            return None
+        try:
+            return self.type_cache.get(device_id)
+        except Exception:
+            return None
+
+    def _log_flood(self, event: dict) -> None:
+        device = Device.objects.filter(pk=event["device_id"]).only("id", "name", "owner_id").first()
+        name = device.name if device is not None else f"设备#{event['device_id']}"
+        SystemLog.objects.create(
+            level=SystemLog.LEVEL_WARN,
+            source="MQTT_GATEWAY",
+            message=(
+                f"设备 [{name}] 上报过于频繁（超过 {event['rate']:g} 条/秒），"
+                f"后续上报将合并为最新值后写入"
+            ),
+            data=event,
+            user_id=device.owner_id if device is not None else None,
+        )
+        metrics.flood_warnings_total.inc()
@@ -1,13 +1,18 @@
 """
 运行 MQTT 网关：订阅 home/+/state，更新设备状态与历史数据。
 用法：python3 manage.py run_mqtt_gateway
+      python3 manage.py run_mqtt_gateway --metrics-port 9108   # 暴露 Prometheus 指标
+      python3 manage.py run_mqtt_gateway -v 2                  # 逐条打印收到的消息（调试用）
 """
 
-import json
+import time
+from typing import Optional
 
 import paho.mqtt.client as mqtt
 from django.conf import settings
 from django.core.mail import mail_admins
+from django.db import connection, transaction
+from django.db.models import Max
 
 from logs_app.email_alert import send_email_alerts_for_value
 from django.core.management.base import BaseCommand
@@ -16,19 +21,109 @@ from django.utils import timezone
 from devices.constants import DeviceType
 from devices.models import Device, DeviceData
 from logs_app.models import SystemLog
-from mqtt_gateway.utils import _apply_tls, build_mqtt_client_id
+from mqtt_gateway import acks, codec, metrics, outbox, schema, tracing
+from mqtt_gateway.batch import BatchPayloadError, parse_batch_payload
+from mqtt_gateway.lanes import LANE_ALARM, LANE_CONTROL, LANE_TELEMETRY, DeviceTypeCache, LaneDispatcher
+from mqtt_gateway.ratelimit import IngestRateLimiter
+from mqtt_gateway.scheduler import SceneScheduler, window_open
+from mqtt_gateway.utils import _apply_tls, build_mqtt_client_id, disable_ack_listener
+from scenes.conditions import CompositeRuleMatcher, state_value_matches
 from scenes.models import SceneRule
 
+GATEWAY_SUFFIXES = ("state", "power", "lwt", "batch")
+
+
+# 同一执行设备在一个评估周期内被多条规则命中时的合并顺序：数值小的先应用，后应用者覆盖同名字段。
+# 切换开关依赖当前状态，最先应用；关闭最后应用，保证「关闭」优先于其他动作。
+ACTION_PRECEDENCE = {
+    SceneRule.ACTION_TOGGLE: 0,
+    SceneRule.ACTION_TURN_ON: 1,
+    SceneRule.ACTION_SET_TEMP: 2,
+    SceneRule.ACTION_SET_FAN_SPEED: 2,
+    SceneRule.ACTION_TURN_OFF: 3,
+}
+
 
 class Command(BaseCommand):
     help = "运行 MQTT 网关，订阅设备状态并更新数据库"
 
+    # 逐条消息回显仅在 -v 2 及以上开启：高频上报时 stdout 写入本身就是主要 CPU 开销
+    verbosity = 1
+    # 优先级通道分发器；--sync 或单元测试中为 None，消息在 MQTT 网络线程内同步处理
+    lanes = None
+    # TIME_STATE 场景规则调度器；为 None 时沿用「触发设备上报时检查」的旧逻辑
+    scene_scheduler = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # 边沿触发规则的布防状态：rule_id -> (是否已布防, 规则 updated_at)。
+        # 同一触发设备的消息总在同一工作线程处理，因此每条规则只会被一个线程读写。
+        self._rule_armed: dict[int, tuple[bool, object]] = {}
+        # COMPOSITE 组合条件规则的增量匹配器（跨设备、跨线程共享，内部加锁）
+        scheduler_config = getattr(settings, "MQTT_GATEWAY_SCENE_SCHEDULER", {})
+        self.composite_matcher = CompositeRuleMatcher(
+            reload_seconds=scheduler_config.get("RELOAD_SECONDS", 30)
+        )
+
+    def add_arguments(self, parser):
+        metrics_config = getattr(settings, "MQTT_GATEWAY_METRICS", {})
+        parser.add_argument(
+            "--metrics-port",
+            type=int,
+            default=metrics_config.get("PORT", 0),
+            help="在本地端口暴露 Prometheus 指标（/metrics），0 表示不开启",
+        )
+        parser.add_argument(
+            "--metrics-addr",
+            default=metrics_config.get("ADDR", "127.0.0.1"),
+            help="指标 HTTP 服务监听地址",
+        )
+        parser.add_argument(
+            "--metrics-file",
+            default=metrics_config.get("FILE") or "",
+            help="定期将指标写入该文件（node_exporter textfile 格式）",
+        )
+        parser.add_argument(
+            "--metrics-file-interval",
+            type=float,
+            default=metrics_config.get("FILE_INTERVAL_SECONDS", 15.0),
+            help="指标文件写入间隔（秒）",
+        )
+        parser.add_argument(
+            "--sync",
+            action="store_true",
+            help="不启用优先级通道，在 MQTT 网络线程内按到达顺序同步处理消息",
+        )
+
     def handle(self, *args, **options):
+        self.verbosity = int(options.get("verbosity", 1))
+        # ack 由网关的 _handle_command_topic 处理，联动命令使用的发布服务不再重复订阅
+        disable_ack_listener()
         config = settings.MQTT_CONFIG
         topic_prefix = config.get("TOPIC_PREFIX", "home")
 
+        if options.get("metrics_port"):
+            metrics.start_http_server(options["metrics_port"], options.get("metrics_addr") or "127.0.0.1")
+            self.stdout.write(
+                f"指标服务已启动: http://{options.get('metrics_addr')}:{options['metrics_port']}/metrics"
+            )
+        metrics_file_stop = None
+        if options.get("metrics_file"):
+            metrics_file_stop = metrics.start_file_writer(
+                options["metrics_file"], max(1.0, float(options.get("metrics_file_interval") or 15.0))
+            )
+            self.stdout.write(f"指标将定期写入: {options['metrics_file']}")
+        tracing_config = getattr(settings, "MQTT_GATEWAY_TRACING", {})
+        trace_file_stop = None
+        if tracing.enabled() and tracing_config.get("FILE"):
+            trace_file_stop = tracing.start_file_writer(
+                tracing_config["FILE"], max(1.0, float(tracing_config.get("FLUSH_SECONDS") or 10.0))
+            )
+            self.stdout.write(f"链路追踪将定期写入: {tracing_config['FILE']}")
+
         def on_connect(client, userdata, flags, rc):
             if rc == 0:
+                metrics.mqtt_connects_total.inc()
                 transport = "mqtts (TLS)" if config.get("USE_TLS") else "mqtt (no TLS)"
                 self.stdout.write(
                     self.style.SUCCESS(f"MQTT 已连接: {config['HOST']}:{config['PORT']} [{transport}]")
@@ -39,248 +134,510 @@ class Command(BaseCommand):
                 client.subscribe(f"{topic_prefix}/+/power", qos=1)
                 # LWT / 在线状态主题（约定为 lwt，可按需调整）
                 client.subscribe(f"{topic_prefix}/+/lwt", qos=1)
+                # 批量补传（设备侧时间戳，可压缩）
+                client.subscribe(f"{topic_prefix}/+/batch", qos=1)
+                # 显式指定编解码器的上报：home/{id}/state/cbor、home/{id}/power/msgpack 等
+                for suffix in GATEWAY_SUFFIXES:
+                    client.subscribe(f"{topic_prefix}/+/{suffix}/+", qos=1)
                 self.stdout.write(
-                    f"已订阅: {topic_prefix}/+/state, {topic_prefix}/+/power, {topic_prefix}/+/lwt"
+                    f"已订阅: {topic_prefix}/+/state, {topic_prefix}/+/power, "
+                    f"{topic_prefix}/+/lwt, {topic_prefix}/+/batch（及 /{{codec}} 变体）"
                 )
+                if acks.enabled():
+                    # 下发命令与设备确认：用于命令确认跟踪（见 mqtt_gateway.acks）
+                    client.subscribe(f"{topic_prefix}/+/cmd", qos=1)
+                    client.subscribe(f"{topic_prefix}/+/cmd/+", qos=1)
+                    client.subscribe(f"{topic_prefix}/+/ack", qos=1)
             else:
                 self.stdout.write(self.style.ERROR(f"MQTT 连接失败 rc={rc}"))
 
-                
-        # ChatGPT 优化后的代码
+        def on_disconnect(client, userdata, rc):
+            if rc != 0:
+                metrics.mqtt_disconnects_total.inc()
+                self.stdout.write(self.style.WARNING(f"MQTT 连接断开 rc={rc}，等待自动重连…"))
+
+        if not options.get("sync"):
+            lanes_config = getattr(settings, "MQTT_GATEWAY_LANES", {})
+            rate_limit_config = getattr(settings, "MQTT_GATEWAY_RATE_LIMIT", {})
+            limiter = None
+            if rate_limit_config.get("ENABLED", True):
+                limiter = IngestRateLimiter(rate_limit_config)
+            self.lanes = LaneDispatcher(
+                handler=self._process_message,
+                workers={
+                    LANE_ALARM: lanes_config.get("ALARM_WORKERS", 1),
+                    LANE_CONTROL: lanes_config.get("CONTROL_WORKERS", 1),
+                    LANE_TELEMETRY: lanes_config.get("TELEMETRY_WORKERS", 2),
+                },
+                maxsize={
+                    LANE_ALARM: 0,
+                    LANE_CONTROL: lanes_config.get("CONTROL_MAXSIZE", 0),
+                    LANE_TELEMETRY: lanes_config.get("TELEMETRY_MAXSIZE", 10000),
+                },
+                type_cache=DeviceTypeCache(max_entries=lanes_config.get("DEVICE_TYPE_CACHE_SIZE", 50000)),
+                type_refresh_seconds=lanes_config.get("DEVICE_TYPE_REFRESH_SECONDS", 300),
+                limiter=limiter,
+            )
+            self.lanes.start()
+
+        scheduler_config = getattr(settings, "MQTT_GATEWAY_SCENE_SCHEDULER", {})
+        if scheduler_config.get("ENABLED", True):
+            self.scene_scheduler = SceneScheduler(
+                executor=self._run_scheduled_rule,
+                tick_seconds=scheduler_config.get("TICK_SECONDS", 1.0),
+                reload_seconds=scheduler_config.get("RELOAD_SECONDS", 30),
+            )
+            rule_count = self.scene_scheduler.start()
+            self.stdout.write(f"TIME_STATE 场景调度器已启动，已加载 {rule_count} 条规则")
+
         def on_message(client, userdata, msg):
-            try:
-                # 1. 打印原始收到的消息（最关键的排查点）
-                topic = msg.topic
-                raw_payload = msg.payload.decode()
-                self.stdout.write(f"收到消息 -> 主题: {topic} | 内容: {raw_payload}")
-
-                # 解析 Topic 结构 (期望格式: home/{id}/{suffix})
-                parts = topic.split("/")
-                if len(parts) < 3:
-                    self.stdout.write(self.style.WARNING(f"主题格式错误: 期望 3 段，实际 {len(parts)} 段"))
-                    return
-
-                # 提取设备 ID
+            if self.lanes is not None:
+                self.lanes.submit(msg.topic, msg.payload)
+            else:
+                self._process_message(msg.topic, msg.payload)
+
+        client_id = build_mqtt_client_id(config, role="gateway")
+        client = mqtt.Client(client_id=client_id)
+        if config.get("USERNAME"):
+            client.username_pw_set(config["USERNAME"], config.get("PASSWORD", ""))
+
+        # TLS / mqtts
+        _apply_tls(client, config)
+        self.stdout.write(f"MQTT 客户端 ID: {client_id}")
+
+        client.on_connect = on_connect
+        client.on_disconnect = on_disconnect
+        client.on_message = on_message
+        try:
+            client.connect(config["HOST"], config["PORT"], config.get("KEEPALIVE", 60))
+            client.loop_forever()
+        except KeyboardInterrupt:
+            self.stdout.write(self.style.SUCCESS("正在关闭 MQTT 网关…"))
+            client.loop_stop()
+            client.disconnect()
+        except Exception as e:
+            self.stdout.write(self.style.ERROR(str(e)))
+        finally:
+            if self.lanes is not None:
+                self.lanes.stop()
+            if self.scene_scheduler is not None:
+                self.scene_scheduler.stop()
+            if metrics_file_stop is not None:
+                metrics_file_stop.set()
                 try:
-                    # 假设格式是 prefix/id/xxx
-                    device_id = int(parts[1])
-                except (ValueError, IndexError):
-                    self.stdout.write(self.style.WARNING(f"无法从主题中提取数字 ID: {parts[1]}"))
-                    return
+                    metrics.write_to_file(options["metrics_file"])
+                except OSError:
+                    pass
+            if trace_file_stop is not None:
+                trace_file_stop.set()
+                try:
+                    tracing.buffer.dump(tracing_config["FILE"])
+                except OSError:
+                    pass
+
+    def _process_message(self, topic: str, raw: bytes, received_seq=None):
+        """处理一条 MQTT 消息，并记录各阶段耗时与数据库查询数。"""
+        query_count = [0]
 
-                suffix = parts[2]
+        def _count_queries(execute, sql, params, many, context):
+            query_count[0] += 1
+            return execute(sql, params, many, context)
 
-                # 查找设备
+        suffix = None
+        try:
+            with tracing.trace_message(topic), connection.execute_wrapper(_count_queries):
+                suffix = self._handle_message(topic, raw, received_seq)
+        finally:
+            if suffix:
+                metrics.db_queries_per_message.observe(query_count[0], suffix=suffix)
+
+    def _handle_message(self, topic: str, raw: bytes, received_seq=None):
+        """
+        解析并处理消息；返回规范化的主题后缀（用于指标标签），无法识别时返回 None。
+        received_seq 为通道分发器分配的接收序号，用于识别已被后续 lwt 取代的旧上报。
+        """
+        try:
+            parse_started = time.perf_counter()
+
+            # 解析 Topic 结构 (期望格式: home/{id}/{suffix}[/{codec}])
+            parts = topic.split("/")
+            if len(parts) < 3:
+                metrics.malformed_total.inc(reason="topic")
+                self.stdout.write(self.style.WARNING(f"主题格式错误: 期望 3 段，实际 {len(parts)} 段"))
+                return None
+
+            # 提取设备 ID
+            try:
+                # 假设格式是 prefix/id/xxx
+                device_id = int(parts[1])
+            except (ValueError, IndexError):
+                metrics.malformed_total.inc(reason="device_id")
+                self.stdout.write(self.style.WARNING(f"无法从主题中提取数字 ID: {parts[1]}"))
+                return None
+
+            suffix = parts[2]
+            suffix_lower = suffix.lower()
+            topic_codec = parts[3] if len(parts) > 3 else None
+            metrics.messages_total.inc(suffix=suffix_lower)
+
+            if suffix_lower == "batch":
+                # 批量 payload 可能是压缩的二进制，解压后再解码，交给 _handle_batch_report 处理
+                payload = None
+                if self.verbosity >= 2:
+                    self.stdout.write(f"收到消息 -> 主题: {topic} | 批量 payload {len(raw)} 字节")
+            else:
+                codec_name = codec.select_codec(raw, topic_codec)
+                metrics.payload_codec_total.inc(codec=codec_name)
+                try:
+                    payload = codec.decode_payload(raw, codec_name)
+                except codec.CodecError as e:
+                    if codec_name != codec.CODEC_JSON:
+                        metrics.malformed_total.inc(reason="codec")
+                        self.stdout.write(self.style.WARNING(f"无法解码 payload（主题 {topic}）: {e}"))
+                        return suffix_lower
+                    # 非 JSON 文本（如 lwt 的 "offline"）按原始字符串处理
+                    payload = raw.decode(errors="replace") if isinstance(raw, (bytes, bytearray)) else str(raw)
+                if self.verbosity >= 2:
+                    self.stdout.write(f"收到消息 -> 主题: {topic} | 内容: {payload}")
+            tracing.observe_stage("parse", time.perf_counter() - parse_started)
+
+            # 命令确认跟踪：下发命令与设备 ack 不涉及设备表
+            if suffix_lower in ("cmd", "ack"):
+                self._handle_command_topic(device_id, suffix_lower, payload)
+                return suffix_lower
+
+            # 查找设备
+            with tracing.stage("lookup"):
                 try:
                     device = Device.objects.get(pk=device_id)
                 except Device.DoesNotExist:
-                    self.stdout.write(self.style.WARNING(f"数据库中不存在 ID 为 {device_id} 的设备"))
-                    return
+                    device = None
+            if device is None:
+                metrics.dropped_total.inc(reason="unknown_device")
+                self.stdout.write(self.style.WARNING(f"数据库中不存在 ID 为 {device_id} 的设备"))
+                return suffix_lower
+
+            # 该上报之后设备已发来 lwt（告警通道先处理），则不再用旧上报把设备改回在线
+            mark_online = not (
+                self.lanes is not None and self.lanes.lwt_seen_after(device.id, received_seq)
+            )
 
-                # 2. 解析 JSON（state 和 lwt 都优先尝试 JSON）
-                try:
-                    payload = json.loads(raw_payload)
-                except json.JSONDecodeError:
-                    payload = raw_payload
-
-                suffix_lower = suffix.lower()
-
-                # LWT / 在线离线状态处理
-                if suffix_lower == "lwt":
-                    text = payload if isinstance(payload, str) else str(payload)
-                    is_online = text.lower() not in ("offline", "0", "false")
-                    switch_types = {
-                        DeviceType.LAMP_SWITCH,
-                        DeviceType.AC_SWITCH,
-                        DeviceType.FAN_SWITCH,
-                    }
-                    update_fields = ["is_online", "updated_at"]
-                    force_off_payload = None
-
-                    # 异常离线时，自动把开关类设备置为关闭，避免前端与能耗统计误判。
-                    if not is_online and device.type in switch_types:
-                        current_state = device.current_state if isinstance(device.current_state, dict) else {}
-                        new_state = dict(current_state)
-                        new_state["on"] = False
-                        new_state["power_w"] = 0.0
-                        if new_state != current_state:
-                            device.current_state = new_state
-                            update_fields.append("current_state")
-                        force_off_payload = {"on": False, "power_w": 0.0}
-
-                    device.is_online = is_online
-                    device.save(update_fields=update_fields)
-
-                    if force_off_payload is not None:
-                        DeviceData.objects.create(
-                            device=device,
-                            timestamp=timezone.now(),
-                            data=force_off_payload,
-                        )
-
-                    if is_online:
-                        tls_label = " (TLS)" if config.get("USE_TLS") else " (no TLS)"
-                        lwt_msg = f"设备 [{device.name}] 已上线{tls_label}"
-                    else:
-                        lwt_msg = f"设备 [{device.name}] 离线"
-                    SystemLog.objects.create(
-                        level=SystemLog.LEVEL_WARN if not is_online else SystemLog.LEVEL_INFO,
-                        source="MQTT_LWT",
-                        message=lwt_msg,
-                        data={"topic": topic, "payload": text, "device_id": device_id},
-                        user=device.owner,
+            # LWT / 在线离线状态处理
+            if suffix_lower == "lwt":
+                with tracing.stage("db"):
+                    self._handle_lwt(device=device, topic=topic, payload=payload)
+                return suffix_lower
+
+            # 电参上报：例如 home/{id}/power -> {"power_w": 123.4, "energy_wh_total": 4567.8}
+            if suffix_lower == "power":
+                with tracing.stage("db"):
+                    self._handle_power_report(
+                        device=device, topic=topic, payload=payload, mark_online=mark_online
                     )
-                    return
-
-                # 电参上报：例如 home/{id}/power -> {"power_w": 123.4, "energy_wh_total": 4567.8}
-                if suffix_lower == "power":
-                    self._handle_power_report(device=device, topic=topic, payload=payload)
-                    return
-
-                if suffix_lower != "state":
-                    self.stdout.write(
-                        self.style.WARNING(
-                            f"未知主题后缀: {suffix}（仅支持 state / power / lwt）"
-                        )
+                return suffix_lower
+
+            # 批量补传：home/{id}/batch -> [{"ts": 1700000000, "data": {...}}, ...]
+            if suffix_lower == "batch":
+                with tracing.stage("db"):
+                    payload = self._handle_batch_report(
+                        device=device, topic=topic, raw=raw, mark_online=mark_online,
+                        topic_codec=topic_codec,
+                    )
+                # 仅当最新一条读数是实时数据时才参与告警与场景判断，避免补传的历史数据误触发
+                if payload is None:
+                    return suffix_lower
+            elif suffix_lower != "state":
+                metrics.dropped_total.inc(reason="unknown_suffix")
+                self.stdout.write(
+                    self.style.WARNING(
+                        f"未知主题后缀: {suffix}（仅支持 state / power / lwt / batch）"
                     )
-                    return
-
-                # 正常状态上报：执行写入操作
-                device.current_state = payload
-                device.is_online = True
-                device.save(update_fields=["current_state", "is_online", "updated_at"])
-
-                # 记录历史数据
-                DeviceData.objects.create(
-                    device=device,
-                    timestamp=timezone.now(),
-                    data=payload,
                 )
+                return suffix_lower
+            else:
+                # 设备回显的 cmd_id 只用于命令确认，不写入状态
+                echoed_cmd_id = payload.pop("cmd_id", None) if isinstance(payload, dict) else None
+                with tracing.stage("validate"):
+                    payload = self._normalize_report(device, topic, payload)
+                if payload is None:
+                    return suffix_lower
+                with tracing.stage("db"):
+                    self._save_state_report(
+                        device=device, topic=topic, payload=payload, mark_online=mark_online
+                    )
+                self._confirm_commands(device.id, payload, echoed_cmd_id)
 
-                # 记录日志：详细说明各字段更新值
-                detail_msg = self._format_state_message(device.name, device_id, payload)
-                SystemLog.objects.create(
-                    level=SystemLog.LEVEL_INFO,
-                    source="MQTT_GATEWAY",
-                    message=detail_msg,
-                    data={"topic": topic, "payload": payload},
-                    user=device.owner,
-                )
+            with tracing.stage("alert"):
+                self._evaluate_alerts(device=device, topic=topic, payload=payload)
 
-                # 安全告警：温度超过阈值（例如 35°C）
-                try:
-                    if (
-                        # device.type == DeviceType.TEMP_HUMI
-                        device.type == DeviceType.TEMPERATURE_HUMIDITY
-                        and isinstance(payload, dict)
-                        and "temp" in payload
-                    ):
-                        temp_value = float(payload["temp"])
-                        threshold = getattr(settings, "ALERT_TEMP_THRESHOLD", 35.0)
-                        if temp_value >= threshold:
-                            msg = (
-                                f"设备 {device.name}({device_id}) 温度过高：{temp_value}°C，"
-                                f"已超过阈值 {threshold}°C"
-                            )
-                            SystemLog.objects.create(
-                                level=SystemLog.LEVEL_WARN,
-                                source="ALERT",
-                                message=msg,
-                                data={"topic": topic, "payload": payload, "threshold": threshold},
-                                user=device.owner,
-                            )
-                            try:
-                                mail_admins(subject="[安全告警] 温度过高", message=msg, fail_silently=True)
-                            except Exception:
-                                pass
-                            try:
-                                send_email_alerts_for_value(device, "temp", temp_value)
-                            except Exception:
-                                pass
-                except Exception as e:
-                    self.stdout.write(self.style.WARNING(f"告警逻辑执行失败: {e}"))
-
-                # 通用邮件告警：对上报中的数值字段检查邮件规则
-                if isinstance(payload, dict):
-                    for field in ("temp", "humi", "light", "pressure"):
-                        if field in payload:
-                            try:
-                                v = float(payload[field])
-                                send_email_alerts_for_value(device, field, v)
-                            except (ValueError, TypeError):
-                                pass
-                    # 烟雾告警：二值触发（1=触发，0=未触发）
-                    if device.type == DeviceType.SMOKE:
-                        triggered = (
-                            payload.get("smoke") is True
-                            or payload.get("alarm") is True
-                            or bool(payload.get("value"))
-                        )
-                        send_email_alerts_for_value(
-                            device, "smoke", 1.0 if triggered else 0.0
-                        )
-
-                # 场景规则执行引擎：检查是否有规则被触发
+            # 场景规则执行引擎：检查是否有规则被触发
+            with tracing.stage("scene"):
                 try:
                     self._check_and_execute_scene_rules(device, payload)
+                    if self.scene_scheduler is not None:
+                        self.scene_scheduler.on_state_change(device.id, payload)
                 except Exception as e:
                     self.stdout.write(self.style.WARNING(f"场景规则执行失败: {e}"))
 
+            if self.verbosity >= 2:
                 self.stdout.write(self.style.SUCCESS(f"成功更新设备 {device_id} 的数据并存入历史表"))
+            return suffix_lower
+
+        except Exception as e:
+            metrics.malformed_total.inc(reason="exception")
+            self.stdout.write(self.style.ERROR(f"处理逻辑发生异常: {str(e)}"))
+            return None
 
-            except Exception as e:
-                self.stdout.write(self.style.ERROR(f"处理逻辑发生异常: {str(e)}"))
-
-        # def on_message(client, userdata, msg):
-        #     try:
-        #         topic = msg.topic
-        #         payload = json.loads(msg.payload.decode())
-        #         parts = topic.split("/")
-        #         if len(parts) < 2:
-        #             return
-        #         try:
-        #             device_id = int(parts[1])
-        #         except ValueError:
-        #             return
-        #         try:
-        #             device = Device.objects.get(pk=device_id)
-        #         except Device.DoesNotExist:
-        #             return
-        #         device.current_state = payload
-        #         device.is_online = True
-        #         device.save(update_fields=["current_state", "is_online", "updated_at"])
-        #         DeviceData.objects.create(
-        #             device=device, timestamp=timezone.now(), data=payload
-        #         )
-        #         SystemLog.objects.create(
-        #             level=SystemLog.LEVEL_INFO,
-        #             source="MQTT_GATEWAY",
-        #             message=f"设备 {device.name}({device_id}) 状态更新",
-        #             data={"topic": topic, "payload": payload},
-        #         )
-        #     except Exception as e:
-        #         self.stdout.write(self.style.ERROR(f"处理消息出错: {e}"))
+    def _handle_command_topic(self, device_id: int, suffix: str, payload) -> None:
+        """cmd：登记其他进程发布的命令（带 cmd_id 时）；ack：设备确认或报告执行失败。"""
+        if not acks.enabled() or not isinstance(payload, dict) or not payload.get("cmd_id"):
+            return
+        cmd_id = str(payload["cmd_id"])
+        if suffix == "cmd":
+            acks.tracker.register(device_id, payload, cmd_id=cmd_id)
+            return
+        command = acks.tracker.ack(
+            cmd_id,
+            ok=payload.get("ok", True) is not False,
+            error=payload.get("error"),
+            via=payload.get("via") or "ack",
+        )
+        if command is not None and command.status == acks.STATUS_FAILED:
+            SystemLog.objects.create(
+                level=SystemLog.LEVEL_WARN,
+                source="MQTT_GATEWAY",
+                message=f"设备 {device_id} 执行命令失败: {command.error or '未知原因'}",
+                data={"device_id": device_id, "cmd_id": cmd_id, "payload": command.payload},
+            )
 
-        client_id = build_mqtt_client_id(config, role="gateway")
-        client = mqtt.Client(client_id=client_id)
-        if config.get("USERNAME"):
-            client.username_pw_set(config["USERNAME"], config.get("PASSWORD", ""))
+    def _confirm_commands(self, device_id: int, state: dict, echoed_cmd_id=None) -> None:
+        """状态回显确认待确认命令，并代设备发布 ack，唤醒 API 进程中等待确认的请求。"""
+        if not acks.enabled():
+            return
+        from mqtt_gateway.utils import publish_command_ack
+
+        if echoed_cmd_id:
+            state = {**state, "cmd_id": echoed_cmd_id}
+        for command in acks.tracker.match_state(device_id, state):
+            publish_command_ack(device_id, command.cmd_id)
+
+    def _normalize_report(self, device: Device, topic: str, payload):
+        """按设备类型 schema 规范化 state 上报；整条非法时记录并返回 None。"""
+        normalized, invalid = schema.normalize_state(device.type, payload)
+        if invalid:
+            metrics.schema_invalid_fields_total.inc(len(invalid), device_type=device.type)
+        if normalized is None:
+            metrics.malformed_total.inc(reason="schema")
+            self.stdout.write(
+                self.style.WARNING(f"忽略非法 state payload（主题 {topic}）: {payload}")
+            )
+        elif invalid and self.verbosity >= 2:
+            self.stdout.write(self.style.WARNING(f"已丢弃非法字段 {invalid}（主题 {topic}）"))
+        return normalized
 
-        # TLS / mqtts
-        _apply_tls(client, config)
-        self.stdout.write(f"MQTT 客户端 ID: {client_id}")
+    def _handle_lwt(self, device: Device, topic: str, payload):
+        """处理 home/{id}/lwt 在线/离线消息。"""
+        config = settings.MQTT_CONFIG
+        text = payload if isinstance(payload, str) else str(payload)
+        is_online = text.lower() not in ("offline", "0", "false")
+        switch_types = {
+            DeviceType.LAMP_SWITCH,
+            DeviceType.AC_SWITCH,
+            DeviceType.FAN_SWITCH,
+        }
+        force_off_payload = None
+
+        # 异常离线时，自动把开关类设备置为关闭，避免前端与能耗统计误判。
+        if not is_online and device.type in switch_types:
+            force_off_payload = {"on": False, "power_w": 0.0}
+            device.patch_state(force_off_payload, refresh=False, is_online=False)
+        else:
+            device.is_online = is_online
+            device.save(update_fields=["is_online", "updated_at"])
+
+        if force_off_payload is not None:
+            DeviceData.objects.create(
+                device=device,
+                timestamp=timezone.now(),
+                data=force_off_payload,
+            )
 
-        client.on_connect = on_connect
-        client.on_message = on_message
+        if is_online:
+            tls_label = " (TLS)" if config.get("USE_TLS") else " (no TLS)"
+            lwt_msg = f"设备 [{device.name}] 已上线{tls_label}"
+        else:
+            lwt_msg = f"设备 [{device.name}] 离线"
+        SystemLog.objects.create(
+            level=SystemLog.LEVEL_WARN if not is_online else SystemLog.LEVEL_INFO,
+            source="MQTT_LWT",
+            message=lwt_msg,
+            data={"topic": topic, "payload": text, "device_id": device.id},
+            user=device.owner,
+        )
+
+        if is_online and outbox.enabled():
+            self._flush_outbox(device)
+
+    def _flush_outbox(self, device: Device) -> None:
+        """设备上线：离线期间合并的命令只下发一次。"""
+        row, _ = outbox.flush(device)
+        if row is None:
+            return
+        SystemLog.objects.create(
+            level=SystemLog.LEVEL_INFO,
+            source="MQTT_GATEWAY",
+            message=f"设备 [{device.name}] 上线，已下发离线期间的 {row.command_count} 条命令（合并为 1 条）",
+            data={"device_id": device.id, "payload": row.payload, "command_count": row.command_count},
+            user=device.owner,
+        )
+
+    def _save_state_report(self, device: Device, topic: str, payload, mark_online: bool = True):
+        """正常状态上报：更新当前状态、写入历史与日志。"""
+        # state 上报是设备的完整状态，整体替换 current_state（同时递增 state_version）
+        online_fields = {"is_online": True} if mark_online else {}
+        Device.objects.filter(pk=device.pk).replace_state(payload, **online_fields)
+        device.current_state = payload
+        for name, value in online_fields.items():
+            setattr(device, name, value)
+
+        # 记录历史数据
+        DeviceData.objects.create(
+            device=device,
+            timestamp=timezone.now(),
+            data=payload,
+        )
+
+        # 记录日志：详细说明各字段更新值
+        detail_msg = self._format_state_message(device.name, device.id, payload)
+        SystemLog.objects.create(
+            level=SystemLog.LEVEL_INFO,
+            source="MQTT_GATEWAY",
+            message=detail_msg,
+            data={"topic": topic, "payload": payload},
+            user=device.owner,
+        )
+
+    def _handle_batch_report(
+        self, device: Device, topic: str, raw: bytes, mark_online: bool = True, topic_codec=None
+    ):
+        """
+        处理 home/{id}/batch 批量补传：一次 bulk_create 写入全部读数（使用设备侧时间戳）。
+        仅把比已有历史更新的读数按时间顺序合并到 current_state，迟到的旧读数只写历史。
+        返回需要参与告警/场景判断的最新实时读数；不存在时返回 None。
+        """
         try:
-            client.connect(config["HOST"], config["PORT"], config.get("KEEPALIVE", 60))
-            client.loop_forever()
-        except KeyboardInterrupt:
-            self.stdout.write(self.style.SUCCESS("正在关闭 MQTT 网关…"))
-            client.loop_stop()
-            client.disconnect()
+            readings, rejected = parse_batch_payload(raw, codec_name=topic_codec)
+        except BatchPayloadError as e:
+            metrics.malformed_total.inc(reason="batch")
+            self.stdout.write(self.style.WARNING(f"忽略非法 batch payload（设备 {device.id}）: {e}"))
+            return None
+        valid_readings = []
+        for ts, data in readings:
+            normalized, invalid = schema.normalize_state(device.type, data)
+            if invalid:
+                metrics.schema_invalid_fields_total.inc(len(invalid), device_type=device.type)
+            if normalized is None:
+                rejected += 1
+            else:
+                valid_readings.append((ts, normalized))
+        readings = valid_readings
+        if rejected:
+            metrics.malformed_total.inc(rejected, reason="batch_item")
+        if not readings:
+            return None
+
+        latest_known = (
+            DeviceData.objects.filter(device=device).aggregate(latest=Max("timestamp"))["latest"]
+        )
+        DeviceData.objects.bulk_create(
+            [DeviceData(device=device, timestamp=ts, data=data) for ts, data in readings],
+            batch_size=1000,
+        )
+
+        newer = [(ts, data) for ts, data in readings if latest_known is None or ts >= latest_known]
+        online_fields = {"is_online": True} if mark_online else {}
+        if newer:
+            # 较新的读数按时间顺序合并后，一次性在数据库内合并进 current_state
+            patch = {}
+            for _, data in newer:
+                patch.update(data)
+            device.patch_state(patch, refresh=False, **online_fields)
+        else:
+            for name, value in online_fields.items():
+                setattr(device, name, value)
+            device.save(update_fields=["updated_at", *online_fields])
+
+        first_ts, last_ts = readings[0][0], readings[-1][0]
+        message = (
+            f"设备 [{device.name}] 批量上报 {len(readings)} 条读数"
+            f"（{first_ts:%Y-%m-%d %H:%M:%S} ~ {last_ts:%Y-%m-%d %H:%M:%S}）"
+        )
+        if rejected:
+            message += f"，丢弃 {rejected} 条无效读数"
+        SystemLog.objects.create(
+            level=SystemLog.LEVEL_INFO,
+            source="MQTT_GATEWAY",
+            message=message,
+            data={
+                "topic": topic,
+                "count": len(readings),
+                "rejected": rejected,
+                "first_ts": first_ts.isoformat(),
+                "last_ts": last_ts.isoformat(),
+            },
+            user=device.owner,
+        )
+
+        if not newer:
+            return None
+        realtime_window = int(getattr(settings, "MQTT_GATEWAY_BATCH", {}).get("REALTIME_WINDOW_SECONDS", 60))
+        latest_ts, latest_data = newer[-1]
+        if (timezone.now() - latest_ts).total_seconds() > realtime_window:
+            return None
+        return latest_data
+
+    def _evaluate_alerts(self, device: Device, topic: str, payload):
+        """安全告警与邮件告警规则检查。"""
+        device_id = device.id
+        # 安全告警：温度超过阈值（例如 35°C）
+        try:
+            # payload 已在入口按 schema 规范化，数值字段均为 float
+            if device.type == DeviceType.TEMPERATURE_HUMIDITY and "temp" in payload:
+                temp_value = payload["temp"]
+                threshold = getattr(settings, "ALERT_TEMP_THRESHOLD", 35.0)
+                if temp_value >= threshold:
+                    msg = (
+                        f"设备 {device.name}({device_id}) 温度过高：{temp_value}°C，"
+                        f"已超过阈值 {threshold}°C"
+                    )
+                    SystemLog.objects.create(
+                        level=SystemLog.LEVEL_WARN,
+                        source="ALERT",
+                        message=msg,
+                        data={"topic": topic, "payload": payload, "threshold": threshold},
+                        user=device.owner,
+                    )
+                    try:
+                        mail_admins(subject="[安全告警] 温度过高", message=msg, fail_silently=True)
+                    except Exception:
+                        pass
+                    try:
+                        send_email_alerts_for_value(device, "temp", temp_value)
+                    except Exception:
+                        pass
         except Exception as e:
-            self.stdout.write(self.style.ERROR(str(e)))
+            self.stdout.write(self.style.WARNING(f"告警逻辑执行失败: {e}"))
+
+        # 通用邮件告警：只检查该设备类型 schema 声明并已规范化为数值的字段，未声明字段原样透传、可能不是数值
+        declared = schema.declared_fields(device.type)
+        for field in ("temp", "humi", "light", "pressure"):
+            if field in payload and field in declared:
+                send_email_alerts_for_value(device, field, payload[field])
+        # 烟雾告警：二值触发（1=触发，0=未触发）；smoke 已由 schema 合并 alarm / value
+        if device.type == DeviceType.SMOKE and "smoke" in payload:
+            send_email_alerts_for_value(
+                device, "smoke", 1.0 if payload["smoke"] else 0.0
+            )
 
     def _format_state_message(self, device_name: str, device_id: int, payload: dict) -> str:
         """将状态 payload 格式化为可读的日志消息。"""
@@ -301,14 +658,8 @@ class Command(BaseCommand):
             parts.append(f"气压 {payload['pressure']}hPa")
         if "battery_v" in payload:
             parts.append(f"电池电压 {payload['battery_v']}V")
-        elif "battery_voltage" in payload:
-            parts.append(f"电池电压 {payload['battery_voltage']}V")
-        elif "battery" in payload:
-            parts.append(f"电池电压 {payload['battery']}V")
         if "battery_pct" in payload:
             parts.append(f"电量 {payload['battery_pct']}%")
-        elif "battery_percent" in payload:
-            parts.append(f"电量 {payload['battery_percent']}%")
 
         skip_keys = {
             "temp",
@@ -318,10 +669,7 @@ class Command(BaseCommand):
             "light",
             "pressure",
             "battery_v",
-            "battery_voltage",
-            "battery",
             "battery_pct",
-            "battery_percent",
         }
         for k, v in payload.items():
             if k in skip_keys:
@@ -331,42 +679,24 @@ class Command(BaseCommand):
             return f"设备 [{device_name}]({device_id}) 状态已更新"
         return f"设备 [{device_name}] 上报：{', '.join(parts)}"
 
-    def _handle_power_report(self, device: Device, topic: str, payload):
+    def _handle_power_report(self, device: Device, topic: str, payload, mark_online: bool = True):
         """
         处理 home/{id}/power 电参上报。
         支持字段：
           - power_w 或 power（W）
           - energy_wh_total（Wh，累计电量，可选）
         """
-        if isinstance(payload, (int, float)):
-            payload = {"power_w": float(payload)}
-        if not isinstance(payload, dict):
-            self.stdout.write(
-                self.style.WARNING(f"忽略非法 power payload（非 JSON 对象）: {payload}")
-            )
+        power_data, invalid = schema.normalize_power(payload)
+        if invalid:
+            metrics.schema_invalid_fields_total.inc(len(invalid), device_type=device.type)
+        if power_data is None:
+            metrics.malformed_total.inc(reason="schema")
+            self.stdout.write(self.style.WARNING(f"忽略非法 power payload: {payload}"))
             return
 
-        raw_power = payload.get("power_w", payload.get("power"))
-        try:
-            power_w = max(0.0, float(raw_power))
-        except (TypeError, ValueError):
-            self.stdout.write(self.style.WARNING(f"忽略非法功率字段: {raw_power}"))
-            return
-
-        power_data = {"power_w": round(power_w, 3)}
-        raw_energy = payload.get("energy_wh_total")
-        if raw_energy is not None:
-            try:
-                power_data["energy_wh_total"] = round(max(0.0, float(raw_energy)), 3)
-            except (TypeError, ValueError):
-                pass
-
-        # 合并到 current_state，供设备详情与能耗估算使用
-        state = (device.current_state or {}).copy()
-        state.update(power_data)
-        device.current_state = state
-        device.is_online = True
-        device.save(update_fields=["current_state", "is_online", "updated_at"])
+        # 在数据库内只合并电参字段，不会覆盖同时发生的用户控制（on / temp 等）
+        online_fields = {"is_online": True} if mark_online else {}
+        device.patch_state(power_data, refresh=False, **online_fields)
 
         # 记录历史功率点（不写 SystemLog，避免高频上报刷屏）
         DeviceData.objects.create(
@@ -391,140 +721,262 @@ class Command(BaseCommand):
             return f"已自动切换 {action_device_name} 开关"
         return f"已执行 {action_device_name} 动作"
 
+    def _time_state_match(self, rule: SceneRule, current_time) -> bool:
+        """TIME_STATE 规则：当前时间在窗口内，且（可选的）状态设备满足 trigger_state_value。"""
+        if not window_open(rule.trigger_time_start, rule.trigger_time_end, current_time):
+            return False
+        if rule.trigger_state_device and rule.trigger_state_value:
+            device_state = rule.trigger_state_device.current_state or {}
+            for key, expected_value in rule.trigger_state_value.items():
+                if not state_value_matches(key, device_state.get(key), expected_value):
+                    return False
+        return True
+
+    def _run_scheduled_rule(self, rule_id: int):
+        """调度器回调：窗口打开或状态设备相关字段变化时，按数据库最新状态评估并执行 TIME_STATE 规则。"""
+        rule = (
+            SceneRule.objects.filter(pk=rule_id, enabled=True, trigger_type=SceneRule.TRIGGER_TIME_STATE)
+            .select_related("action_device", "trigger_device", "trigger_state_device")
+            .first()
+        )
+        if rule is None:
+            return
+        now = timezone.now()
+        if rule.last_triggered_at and (now - rule.last_triggered_at).total_seconds() < rule.debounce_seconds:
+            return
+        if self._time_state_match(rule, now.time()):
+            self._execute_scene_rule(rule, rule.trigger_device, now)
+
     def _check_and_execute_scene_rules(self, trigger_device: Device, payload: dict):
         """
         检查场景规则是否被触发，如果触发则执行动作。
+        启用调度器时，TIME_STATE 规则改由 SceneScheduler 在窗口边界与状态变化时评估。
+        COMPOSITE 规则由增量匹配器评估，见 _check_composite_rules()。
+        本次命中的全部规则汇总后由 _execute_scene_actions() 按执行设备合并、批量落库。
         """
-        from datetime import datetime, time as dt_time
-        from mqtt_gateway.utils import publish_device_command
+        now = timezone.now()
+        current_time = now.time()
+        fired = self._check_composite_rules(trigger_device, payload, now)
 
         # 查找所有启用且以该设备为触发设备的规则
         rules = SceneRule.objects.filter(
             enabled=True,
             trigger_device=trigger_device,
+        ).exclude(
+            trigger_type=SceneRule.TRIGGER_COMPOSITE,
         ).select_related("action_device", "trigger_state_device")
-
-        now = timezone.now()
-        current_time = now.time()
+        if self.scene_scheduler is not None:
+            rules = rules.exclude(trigger_type=SceneRule.TRIGGER_TIME_STATE)
 
         for rule in rules:
-            # 防抖检查：如果距离上次触发时间太短，跳过
-            if rule.last_triggered_at:
-                delta = (now - rule.last_triggered_at).total_seconds()
-                if delta < rule.debounce_seconds:
-                    continue
-
             triggered = False
 
             # 4. 定时触发（时间+可选状态条件）：不依赖 payload 数值，只要本设备有上报就检查时间与状态
             if rule.trigger_type == SceneRule.TRIGGER_TIME_STATE:
-                time_match = False
-                if rule.trigger_time_start and rule.trigger_time_end:
-                    if rule.trigger_time_start <= rule.trigger_time_end:
-                        time_match = rule.trigger_time_start <= current_time <= rule.trigger_time_end
-                    else:
-                        time_match = current_time >= rule.trigger_time_start or current_time <= rule.trigger_time_end
-
-                state_match = True
-                if rule.trigger_state_device and rule.trigger_state_value:
-                    device_state = rule.trigger_state_device.current_state or {}
-                    for key, expected_value in rule.trigger_state_value.items():
-                        actual = device_state.get(key)
-                        if key in ("motion", "pir"):
-                            state_match = bool(actual) == bool(expected_value)
-                        elif key == "value":
-                            state_match = (actual is not None and (actual is True or (isinstance(actual, (int, float)) and float(actual) > 0))) == bool(expected_value)
-                        else:
-                            state_match = actual == expected_value
-                        if not state_match:
-                            break
-
-                triggered = time_match and state_match
+                triggered = self._time_state_match(rule, current_time)
 
             else:
                 # 阈值类触发：需要 payload 中含 trigger_field 且为数值
                 trigger_field_value = payload.get(rule.trigger_field)
-                if trigger_field_value is None:
+                if not isinstance(trigger_field_value, (int, float)) or isinstance(trigger_field_value, bool):
                     continue
-                try:
-                    trigger_field_value = float(trigger_field_value)
-                except (ValueError, TypeError):
+                triggered, rearm = self._threshold_match(rule, trigger_field_value)
+
+                # 边沿触发：已触发未复位时不再执行；回到条件外（含回差）后重新布防
+                if rule.trigger_mode == SceneRule.MODE_EDGE:
+                    armed, version = self._rule_armed.get(rule.id, (True, rule.updated_at))
+                    if version != rule.updated_at:
+                        armed = True
+                    if not armed:
+                        if rearm:
+                            self._rule_armed[rule.id] = (True, rule.updated_at)
+                        continue
+                    if not triggered:
+                        continue
+
+            if triggered and rule.last_triggered_at:
+                # 防抖检查：如果距离上次触发时间太短，跳过
+                delta = (now - rule.last_triggered_at).total_seconds()
+                if delta < rule.debounce_seconds:
                     continue
 
-                # 1. 阈值上限触发
-                if rule.trigger_type == SceneRule.TRIGGER_THRESHOLD_ABOVE:
-                    threshold = float(rule.trigger_value) if isinstance(rule.trigger_value, (int, float)) else float(rule.trigger_value.get("value", 0))
-                    triggered = trigger_field_value > threshold
-
-                # 2. 阈值下限触发
-                elif rule.trigger_type == SceneRule.TRIGGER_THRESHOLD_BELOW:
-                    threshold = float(rule.trigger_value) if isinstance(rule.trigger_value, (int, float)) else float(rule.trigger_value.get("value", 0))
-                    triggered = trigger_field_value < threshold
+            if triggered:
+                fired.append(rule)
 
-                # 3. 区间外触发
-                elif rule.trigger_type == SceneRule.TRIGGER_RANGE_OUT:
-                    if isinstance(rule.trigger_value, dict):
-                        min_val = float(rule.trigger_value.get("min", 0))
-                        max_val = float(rule.trigger_value.get("max", 0))
-                        triggered = trigger_field_value < min_val or trigger_field_value > max_val
+        if not fired:
+            return
+        executed = self._execute_scene_actions(fired, trigger_device, now)
+        for rule in fired:
+            if (
+                rule.id in executed
+                and rule.trigger_mode == SceneRule.MODE_EDGE
+                and rule.trigger_type != SceneRule.TRIGGER_COMPOSITE
+            ):
+                self._rule_armed[rule.id] = (False, rule.updated_at)
+
+    def _check_composite_rules(self, trigger_device: Device, payload: dict, now) -> list[SceneRule]:
+        """
+        组合条件规则：匹配器只重新评估依赖本次上报字段的叶子条件，返回需要执行的规则。
+        边沿触发在条件由不满足变为满足时执行；持续触发在相关字段上报且条件满足时执行（受防抖限制）。
+        """
+        hits = self.composite_matcher.on_reading(trigger_device.id, payload)
+        due = {
+            rule_id: rising
+            for rule_id, matched, rising in hits
+            if matched
+        }
+        if not due:
+            return []
+        rules = SceneRule.objects.filter(
+            pk__in=due, enabled=True, trigger_type=SceneRule.TRIGGER_COMPOSITE
+        ).select_related("action_device")
+        fired = []
+        for rule in rules:
+            if rule.trigger_mode == SceneRule.MODE_EDGE and not due[rule.id]:
+                continue
+            if rule.last_triggered_at and (now - rule.last_triggered_at).total_seconds() < rule.debounce_seconds:
+                continue
+            fired.append(rule)
+        return fired
 
-            if triggered:
-                # 执行设备离线时，跳过联动，不发布命令、不写场景日志/横幅。
-                if not rule.action_device.is_online:
-                    self.stdout.write(
-                        self.style.WARNING(
-                            f"场景规则「{rule.name}」命中，但执行设备 [{rule.action_device.name}] 离线，已跳过联动"
-                        )
-                    )
-                    continue
+    @staticmethod
+    def _threshold_match(rule: SceneRule, value: float) -> tuple[bool, bool]:
+        """
+        阈值类规则判断，返回 (是否满足触发条件, 是否已离开条件超过回差可重新布防)。
+        """
+        hysteresis = max(0.0, float(rule.hysteresis or 0.0))
+        # 1. 阈值上限触发
+        if rule.trigger_type == SceneRule.TRIGGER_THRESHOLD_ABOVE:
+            threshold = float(rule.trigger_value) if isinstance(rule.trigger_value, (int, float)) else float(rule.trigger_value.get("value", 0))
+            return value > threshold, value <= threshold - hysteresis
+
+        # 2. 阈值下限触发
+        if rule.trigger_type == SceneRule.TRIGGER_THRESHOLD_BELOW:
+            threshold = float(rule.trigger_value) if isinstance(rule.trigger_value, (int, float)) else float(rule.trigger_value.get("value", 0))
+            return value < threshold, value >= threshold + hysteresis
+
+        # 3. 区间外触发
+        if rule.trigger_type == SceneRule.TRIGGER_RANGE_OUT and isinstance(rule.trigger_value, dict):
+            min_val = float(rule.trigger_value.get("min", 0))
+            max_val = float(rule.trigger_value.get("max", 0))
+            return (
+                value < min_val or value > max_val,
+                min_val + hysteresis <= value <= max_val - hysteresis,
+            )
+        return False, False
 
-                # 执行动作
-                action_payload = {}
-                if rule.action_type == SceneRule.ACTION_TOGGLE:
-                    current_on = bool(rule.action_device.current_state.get("on", False))
-                    action_payload = {"on": not current_on}
-                elif rule.action_type == SceneRule.ACTION_SET_TEMP:
-                    temp_value = rule.action_value if isinstance(rule.action_value, (int, float)) else rule.action_value.get("temp", 26)
-                    action_payload = {"temp": float(temp_value), "on": True}
-                elif rule.action_type == SceneRule.ACTION_SET_FAN_SPEED:
-                    speed_value = rule.action_value if isinstance(rule.action_value, int) else rule.action_value.get("speed", 1)
-                    action_payload = {"speed": int(speed_value), "on": True}
-                elif rule.action_type == SceneRule.ACTION_TURN_ON:
-                    action_payload = {"on": True}
-                elif rule.action_type == SceneRule.ACTION_TURN_OFF:
-                    action_payload = {"on": False}
-
-                # 更新动作设备的状态
-                state = rule.action_device.current_state.copy()
-                state.update(action_payload)
-                rule.action_device.current_state = state
-                rule.action_device.save(update_fields=["current_state", "updated_at"])
-
-                # 发布 MQTT 命令
-                publish_device_command(device_id=rule.action_device.id, payload=action_payload)
-
-                # 更新规则的最后触发时间
-                rule.last_triggered_at = now
-                rule.save(update_fields=["last_triggered_at"])
-
-                # 记录日志（便于横幅展示）
-                action_desc = self._format_action_desc(rule.action_device.name, rule.action_type, action_payload)
-                scene_msg = f"场景联动：{action_desc}"
-                SystemLog.objects.create(
-                    level=SystemLog.LEVEL_INFO,
-                    source="SCENE_RULE",
-                    message=scene_msg,
-                    data={
-                        "rule_id": rule.id,
-                        "trigger_device_id": trigger_device.id,
-                        "action_device_id": rule.action_device.id,
-                        "action_payload": action_payload,
-                    },
-                    user=rule.owner,
+    def _build_action_payload(self, rule: SceneRule) -> Optional[dict]:
+        """
+        计算规则动作要下发的 payload；执行设备离线时返回 None（不发布命令、不写场景日志/横幅），
+        启用离线队列时由 _execute_scene_actions 把动作合并写入队列，设备上线后下发。
+        """
+        if not rule.action_device.is_online:
+            note = "已加入离线队列，上线后下发" if outbox.enabled() else "已跳过联动"
+            self.stdout.write(
+                self.style.WARNING(
+                    f"场景规则「{rule.name}」命中，但执行设备 [{rule.action_device.name}] 离线，{note}"
                 )
+            )
+            return None
+        return self._action_payload(rule)
+
+    @staticmethod
+    def _action_payload(rule: SceneRule) -> dict:
+        action_payload = {}
+        if rule.action_type == SceneRule.ACTION_TOGGLE:
+            current_on = bool(rule.action_device.current_state.get("on", False))
+            action_payload = {"on": not current_on}
+        elif rule.action_type == SceneRule.ACTION_SET_TEMP:
+            temp_value = rule.action_value if isinstance(rule.action_value, (int, float)) else rule.action_value.get("temp", 26)
+            action_payload = {"temp": float(temp_value), "on": True}
+        elif rule.action_type == SceneRule.ACTION_SET_FAN_SPEED:
+            speed_value = rule.action_value if isinstance(rule.action_value, int) else rule.action_value.get("speed", 1)
+            action_payload = {"speed": int(speed_value), "on": True}
+        elif rule.action_type == SceneRule.ACTION_TURN_ON:
+            action_payload = {"on": True}
+        elif rule.action_type == SceneRule.ACTION_TURN_OFF:
+            action_payload = {"on": False}
+        return action_payload
+
+    def _execute_scene_rule(self, rule: SceneRule, trigger_device: Device, now) -> bool:
+        """执行单条已命中规则的动作；执行设备离线而跳过时返回 False。"""
+        return rule.id in self._execute_scene_actions([rule], trigger_device, now)
+
+    def _execute_scene_actions(self, rules: list[SceneRule], trigger_device: Device, now) -> set[int]:
+        """
+        执行一个评估周期内命中的全部规则，返回实际执行的规则 ID：
+          - 按执行设备分组，按 ACTION_PRECEDENCE、规则 ID 的顺序合并 payload（后者覆盖同名字段）
+          - 设备状态（数据库内合并）、规则触发时间、场景日志在一个事务内写入
+          - 事务提交后每个执行设备只发布一条合并后的 MQTT 命令
+        """
+        from mqtt_gateway.utils import publish_device_command
 
-                self.stdout.write(
-                    self.style.SUCCESS(
-                        f"场景规则「{rule.name}」已触发并执行动作"
+        groups: dict[int, list[tuple[SceneRule, dict]]] = {}
+        offline: dict[int, list[SceneRule]] = {}
+        for rule in rules:
+            action_payload = self._build_action_payload(rule)
+            if action_payload is not None:
+                groups.setdefault(rule.action_device_id, []).append((rule, action_payload))
+            elif outbox.enabled():
+                offline.setdefault(rule.action_device_id, []).append(rule)
+        for device_id, offline_rules in offline.items():
+            # 与在线设备相同的合并顺序，再写入离线队列
+            offline_rules.sort(key=lambda rule: (ACTION_PRECEDENCE.get(rule.action_type, 0), rule.id))
+            merged = {}
+            for rule in offline_rules:
+                merged.update(self._action_payload(rule))
+            outbox.enqueue(device_id, merged)
+        if not groups:
+            return set()
+
+        # 由设备上报触发时，trace_id 写入场景日志与下发命令，便于端到端关联
+        trace = tracing.current()
+        trace_id = trace.trace_id if trace is not None else None
+        devices = []
+        commands = []
+        logs = []
+        executed = set()
+        for actions in groups.values():
+            actions.sort(key=lambda item: (ACTION_PRECEDENCE.get(item[0].action_type, 0), item[0].id))
+            device = actions[0][0].action_device
+            merged = {}
+            for rule, action_payload in actions:
+                merged.update(action_payload)
+                executed.add(rule.id)
+                rule.last_triggered_at = now
+                action_desc = self._format_action_desc(device.name, rule.action_type, action_payload)
+                logs.append(
+                    SystemLog(
+                        level=SystemLog.LEVEL_INFO,
+                        source="SCENE_RULE",
+                        message=f"场景联动：{action_desc}",
+                        data={
+                            "rule_id": rule.id,
+                            "trigger_device_id": trigger_device.id,
+                            "action_device_id": device.id,
+                            "action_payload": action_payload,
+                            "trace_id": trace_id,
+                        },
+                        user_id=rule.owner_id,
                     )
                 )
+            devices.append((device, merged))
+            commands.append((device.id, merged))
+
+        with transaction.atomic():
+            # 每个执行设备一条 UPDATE，在数据库内只合并动作字段，不覆盖并发的上报或用户控制
+            for device, merged in devices:
+                device.patch_state(merged, refresh=False)
+            SceneRule.objects.filter(pk__in=executed).update(last_triggered_at=now)
+            SystemLog.objects.bulk_create(logs)
+
+        for device_id, merged in commands:
+            with tracing.stage("publish"):
+                publish_device_command(device_id=device_id, payload=merged, trace_id=trace_id)
+            tracing.mark_command_published()
+            # 执行设备状态变化同步给组合条件匹配器；不在此处连锁触发其他规则，避免规则间循环
+            self.composite_matcher.on_reading(device_id, merged)
+
+        for rule, _ in (item for actions in groups.values() for item in actions):
+            self.stdout.write(self.style.SUCCESS(f"场景规则「{rule.name}」已触发并执行动作"))
+        return executed
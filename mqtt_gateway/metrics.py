@@ -0,0 +1,291 @@
+"""
+网关运行指标：计数器 / 仪表 / 直方图，输出 Prometheus 文本格式（text/plain; version=0.0.4）。
+不依赖 prometheus_client，可通过本地 HTTP 端口暴露或定期写入文件（node_exporter textfile）。
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterable, Optional
+
+# 默认延迟分桶（秒），覆盖 0.5ms ~ 5s
+DEFAULT_LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+
+
+def _escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: Optional[dict] = None) -> str:
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.extend(extra.items())
+    if not pairs:
+        return ""
+    body = ",".join(f'{k}="{_escape_label_value(v)}"' for k, v in pairs)
+    return "{" + body + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: dict[tuple, float] = {}
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = float(value)
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # key -> [bucket counts..., sum, count]
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = [0] * len(self.buckets) + [0.0, 0]
+                self._values[key] = state
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    def count(self, **labels) -> int:
+        state = self._values.get(self._key(labels))
+        return int(state[-1]) if state else 0
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        lines = []
+        for key, state in items:
+            cumulative = 0
+            for i, bound in enumerate(self.buckets):
+                cumulative += state[i]
+                le = {"le": _format_value(bound) if bound != float("inf") else "+Inf"}
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {state[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """指标注册表：按注册顺序渲染为 Prometheus 文本。"""
+
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(m.render() for m in metrics) + "\n"
+
+
+# ==== 网关指标（进程内单例） ====
+
+registry = MetricsRegistry()
+
+messages_total = registry.counter(
+    "smarthome_gateway_messages_total", "收到的 MQTT 消息数（按主题后缀）", ["suffix"]
+)
+malformed_total = registry.counter(
+    "smarthome_gateway_malformed_total", "无法处理的消息数（按原因）", ["reason"]
+)
+payload_codec_total = registry.counter(
+    "smarthome_gateway_payload_codec_total", "按编解码器统计的上报消息数", ["codec"]
+)
+schema_invalid_fields_total = registry.counter(
+    "smarthome_gateway_schema_invalid_fields_total", "未通过 schema 校验而被丢弃的字段数（按设备类型）", ["device_type"]
+)
+dropped_total = registry.counter(
+    "smarthome_gateway_dropped_total", "被丢弃的消息数（按原因）", ["reason"]
+)
+stage_seconds = registry.histogram(
+    "smarthome_gateway_stage_seconds", "消息处理各阶段耗时（秒）", ["stage"]
+)
+db_queries_per_message = registry.histogram(
+    "smarthome_gateway_db_queries_per_message",
+    "每条消息触发的数据库查询数",
+    ["suffix"],
+    buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55),
+)
+queue_depth = registry.gauge(
+    "smarthome_gateway_queue_depth", "待处理消息队列深度（按优先级通道）", ["lane"]
+)
+queue_wait_seconds = registry.histogram(
+    "smarthome_gateway_queue_wait_seconds", "消息在通道队列中的等待时间（秒）", ["lane"]
+)
+ratelimited_total = registry.counter(
+    "smarthome_gateway_ratelimited_total", "因超出速率被合并的消息数（按设备类型）", ["device_type"]
+)
+ratelimit_pending = registry.gauge(
+    "smarthome_gateway_ratelimit_pending", "等待令牌恢复后投递的合并消息数"
+)
+flood_warnings_total = registry.counter(
+    "smarthome_gateway_flood_warnings_total", "记录的设备刷屏警告次数"
+)
+mqtt_connects_total = registry.counter(
+    "smarthome_gateway_mqtt_connects_total", "MQTT 连接成功次数（大于 1 即发生过重连）"
+)
+mqtt_disconnects_total = registry.counter(
+    "smarthome_gateway_mqtt_disconnects_total", "MQTT 非预期断开次数"
+)
+commands_total = registry.counter(
+    "smarthome_gateway_commands_total", "设备命令的确认结果（acked / failed / timeout）", ["result"]
+)
+commands_pending = registry.gauge(
+    "smarthome_gateway_commands_pending", "已发布、等待设备确认的命令数"
+)
+command_ack_seconds = registry.histogram(
+    "smarthome_gateway_command_ack_seconds", "命令发布到设备确认的耗时（秒，按确认来源 ack / state）", ["via"]
+)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # 抓取请求频繁，不输出访问日志
+        return
+
+
+def start_http_server(port: int, addr: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """在后台线程启动 /metrics HTTP 服务。"""
+    server = ThreadingHTTPServer((addr, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="gateway-metrics-http", daemon=True)
+    thread.start()
+    return server
+
+
+def write_to_file(path: str) -> None:
+    """原子写入指标文件（先写临时文件再替换），避免采集端读到半截内容。"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fp:
+        fp.write(registry.render())
+    os.replace(tmp_path, path)
+
+
+def start_file_writer(path: str, interval_seconds: float = 15.0) -> threading.Event:
+    """后台线程定期写入指标文件；返回的 Event 置位后停止。"""
+    stop_event = threading.Event()
+
+    def _loop():
+        while not stop_event.wait(interval_seconds):
+            try:
+                write_to_file(path)
+            except OSError:
+                pass
+
+    threading.Thread(target=_loop, name="gateway-metrics-file", daemon=True).start()
+    return stop_event
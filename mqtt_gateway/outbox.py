@@ -0,0 +1,81 @@
+"""
+离线设备命令队列（outbox）。
+
+- 执行设备离线时，API 控制接口与场景联动不再发布注定丢失的命令，而是写入 CommandOutbox：
+  每台设备一行，多条命令合并为最终期望状态（同名字段后者覆盖）
+- 网关收到设备 LWT 上线消息后取出并删除该行，合并后的命令只下发一次；
+  超过 MAX_AGE_SECONDS 未下发的命令视为过期，直接丢弃
+- 队列存放在数据库中，API 进程与网关进程共享，网关重启也不会丢失
+"""
+
+from datetime import timedelta
+from typing import Optional
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from devices.models import CommandOutbox, Device
+
+
+def outbox_config() -> dict:
+    return getattr(settings, "MQTT_COMMAND_OUTBOX", {})
+
+
+def enabled() -> bool:
+    return bool(outbox_config().get("ENABLED", True))
+
+
+def enqueue(device_id: int, payload: dict) -> dict:
+    """把命令合并进设备的待下发状态，返回合并后的 payload。"""
+    for _ in range(2):
+        try:
+            with transaction.atomic():
+                row = CommandOutbox.objects.select_for_update().filter(device_id=device_id).first()
+                if row is None:
+                    CommandOutbox.objects.create(device_id=device_id, payload=dict(payload), command_count=1)
+                    return dict(payload)
+                merged = {**row.payload, **payload}
+                if merged == row.payload:
+                    # 重复命令（如 LEVEL 规则持续命中）不产生写入
+                    return merged
+                row.payload = merged
+                row.command_count += 1
+                row.save(update_fields=["payload", "command_count", "updated_at"])
+                return merged
+        except IntegrityError:
+            # 并发首次入队：另一方已创建该行，重试时走合并分支
+            continue
+    raise RuntimeError(f"设备 {device_id} 的离线命令入队失败")
+
+
+def take(device_id: int) -> Optional[CommandOutbox]:
+    """取出并删除设备的待下发命令；不存在或已过期时返回 None。"""
+    with transaction.atomic():
+        row = CommandOutbox.objects.select_for_update().filter(device_id=device_id).first()
+        if row is None:
+            return None
+        row.delete()
+    max_age = outbox_config().get("MAX_AGE_SECONDS", 86400)
+    if max_age and row.updated_at < timezone.now() - timedelta(seconds=max_age):
+        return None
+    return row
+
+
+def flush(device: Device):
+    """
+    设备上线后调用：合并的命令写入 current_state 并下发一次。
+    返回 (outbox 行, 待确认命令)；没有待下发命令时返回 (None, None)。
+    """
+    from mqtt_gateway.utils import publish_device_command
+
+    row = take(device.id)
+    if row is None or not row.payload:
+        return None, None
+    device.patch_state(row.payload, refresh=False)
+    return row, publish_device_command(device_id=device.id, payload=row.payload)
+
+
+def queued_command(payload: dict) -> dict:
+    """入队命令在 API 响应中的表示（与 PendingCommand.to_dict() 字段一致）。"""
+    return {"id": None, "status": "queued", "via": None, "error": None, "latency_ms": None, "payload": payload}
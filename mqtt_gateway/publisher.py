@@ -0,0 +1,130 @@
+"""
+API 进程内的 MQTT 发布服务（每个工作进程一个）。
+
+- 由 MqttGatewayConfig.ready() 预先启动：connect_async + loop_start，连接与断线重连都在 paho 的网络线程内完成，
+  重连间隔按 RECONNECT_MIN_SECONDS ~ RECONNECT_MAX_SECONDS 指数退避
+- publish() 从不阻塞请求线程：已连接时交给 paho（只入队）；未连接时放入有界缓冲区，
+  连接成功后在网络线程中按顺序补发，缓冲区满时丢弃最旧的消息并计数
+- 进程 fork（如 gunicorn 预加载）后按 PID 重新创建，子进程不会复用父进程中已失效的网络线程
+"""
+
+import os
+import threading
+from collections import deque
+from typing import Callable, Optional
+
+import paho.mqtt.client as mqtt
+from django.conf import settings
+
+
+class PublishResult:
+    """与 paho MQTTMessageInfo 兼容的最小接口：rc 为 MQTT_ERR_SUCCESS 表示已发送或已缓冲。"""
+
+    __slots__ = ("rc", "mid", "queued")
+
+    def __init__(self, rc: int, mid: Optional[int] = None, queued: bool = False):
+        self.rc = rc
+        self.mid = mid
+        self.queued = queued
+
+
+def publisher_config() -> dict:
+    return getattr(settings, "MQTT_PUBLISHER", {})
+
+
+class MqttPublisher:
+    def __init__(self, client_factory: Callable[[], mqtt.Client], buffer_size: int = 1000,
+                 reconnect_min: float = 1, reconnect_max: float = 60,
+                 on_connected: Optional[Callable[[mqtt.Client], None]] = None,
+                 on_message: Optional[Callable] = None):
+        self.client = client_factory()
+        self.client.reconnect_delay_set(min_delay=max(1, int(reconnect_min)), max_delay=max(1, int(reconnect_max)))
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+        if on_message is not None:
+            self.client.on_message = on_message
+        self._on_connected = on_connected
+        self._buffer: deque = deque()
+        self._buffer_size = max(1, int(buffer_size))
+        self._lock = threading.Lock()
+        self._connected = False
+        self._started = False
+        self._published = 0
+        self._completed = 0
+        self.dropped = 0
+        self.connects = 0
+        self.pid = os.getpid()
+
+    def start(self, host: str, port: int, keepalive: int = 60) -> None:
+        """非阻塞启动：DNS 解析与 TCP 连接均在 paho 网络线程中进行，失败后自动重试。"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        self.client.connect_async(host, port, keepalive)
+        self.client.loop_start()
+
+    def stop(self) -> None:
+        self.client.loop_stop()
+        self.client.disconnect()
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def publish(self, topic: str, payload, qos: int = 1, retain: bool = False) -> PublishResult:
+        with self._lock:
+            if not self._connected:
+                self._buffer_locked((topic, payload, qos, retain))
+                return PublishResult(mqtt.MQTT_ERR_SUCCESS, queued=True)
+            self._published += 1
+        info = self.client.publish(topic, payload, qos=qos, retain=retain)
+        if info.rc == mqtt.MQTT_ERR_NO_CONN:
+            # 连接刚断开、on_disconnect 尚未执行：改为缓冲，重连后补发
+            with self._lock:
+                self._completed += 1
+                self._buffer_locked((topic, payload, qos, retain))
+            return PublishResult(mqtt.MQTT_ERR_SUCCESS, queued=True)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            with self._lock:
+                self._completed += 1
+        return PublishResult(info.rc, mid=info.mid)
+
+    def _buffer_locked(self, item) -> None:
+        if len(self._buffer) >= self._buffer_size:
+            self._buffer.popleft()
+            self.dropped += 1
+        self._buffer.append(item)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "connected": self._connected,
+                "in_flight": max(0, self._published - self._completed),
+                "queued": len(self._buffer),
+                "dropped": self.dropped,
+                "connects": self.connects,
+            }
+
+    # ==== paho 回调（网络线程） ====
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            return
+        with self._lock:
+            self._connected = True
+            self.connects += 1
+            pending = list(self._buffer)
+            self._buffer.clear()
+        if self._on_connected is not None:
+            self._on_connected(client)
+        for topic, payload, qos, retain in pending:
+            self.publish(topic, payload, qos=qos, retain=retain)
+
+    def _on_disconnect(self, client, userdata, rc):
+        with self._lock:
+            self._connected = False
+
+    def _on_publish(self, client, userdata, mid):
+        with self._lock:
+            self._completed += 1
@@ -0,0 +1,169 @@
+"""
+网关入口限流：按设备的令牌桶限制写库频率，防止单个异常设备刷爆网关与数据库。
+
+- 每台设备一个令牌桶，速率/突发量按设备类型配置（MQTT_GATEWAY_RATE_LIMIT.TYPE_LIMITS）
+- 超出速率的消息不丢弃，而是按 (设备, 主题后缀) 合并为最新一条，待令牌恢复后再投递
+- 每台设备在一个时间窗口内只记录一次「上报过于频繁」的 SystemLog 警告
+- lwt 与 batch 不参与合并（合并会丢失离线事件或补传数据）；默认烟雾传感器不限流
+- 未登记的设备 ID 使用单独的 UNKNOWN_DEVICE_LIMIT（默认更严格），类型查询失败时网关不经过限流
+- flush_due() 每隔 PRUNE_INTERVAL_SECONDS 清理已回满且没有待投递消息的令牌桶（与新建的桶等价），
+  以及刷屏窗口已过的记录，设备数量再多内存也只与近期活跃设备数相关
+"""
+
+import threading
+import time
+from typing import Optional
+
+from mqtt_gateway import metrics
+
+
+class TokenBucket:
+    """经典令牌桶：rate 个/秒匀速补充，最多累积 burst 个。"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.updated_at = now
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.updated_at = now
+
+    def try_consume(self, now: float) -> bool:
+        self._refill(now)
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+
+class IngestRateLimiter:
+    """
+    admit() 在 MQTT 网络线程中调用；flush_due() / drain_flood_events() 由后台线程定期调用。
+    """
+
+    ADMIT = "admit"
+    COALESCED = "coalesced"
+    # 不能合并为「最新一条」的主题后缀
+    EXEMPT_SUFFIXES = ("lwt", "batch", "cmd", "ack")
+    PRUNE_INTERVAL_SECONDS = 30.0
+
+    def __init__(self, config: Optional[dict] = None):
+        config = config or {}
+        self.default_limit = (
+            float(config.get("DEFAULT_RATE", 5.0)),
+            float(config.get("DEFAULT_BURST", 20)),
+        )
+        # 设备类型 -> (rate, burst)；值为 None 表示该类型不限流
+        self.type_limits: dict = dict(config.get("TYPE_LIMITS", {}))
+        # 数据库中不存在的设备 ID（device_type 为 None）单独配置，不套用默认值
+        unknown = config.get("UNKNOWN_DEVICE_LIMIT", (1.0, 5))
+        self.unknown_limit = (float(unknown[0]), float(unknown[1])) if unknown else None
+        self.flood_window_seconds = float(config.get("FLOOD_LOG_WINDOW_SECONDS", 60))
+        self._buckets: dict[int, TokenBucket] = {}
+        # (device_id, suffix) -> (topic, raw, seq)
+        self._pending: dict[tuple, tuple] = {}
+        self._coalesced_in_window: dict[int, int] = {}
+        self._flood_logged_at: dict[int, float] = {}
+        self._flood_events: list[dict] = []
+        self._pruned_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _limit_for(self, device_type: Optional[str]):
+        """device_type 由网关查库确定（见 lanes.LaneDispatcher）；None 只表示设备未登记。"""
+        if device_type is None:
+            return self.unknown_limit
+        if device_type in self.type_limits:
+            return self.type_limits[device_type]
+        return self.default_limit
+
+    def admit(self, device_id: Optional[int], device_type: Optional[str], suffix: str,
+              topic: str, raw: bytes, seq: int, now: Optional[float] = None) -> str:
+        """判断消息是否可立即投递；否则合并到待投递表（同设备同后缀只保留最新一条）。"""
+        if device_id is None or suffix in self.EXEMPT_SUFFIXES:
+            return self.ADMIT
+        limit = self._limit_for(device_type)
+        if not limit:
+            return self.ADMIT
+        now = time.monotonic() if now is None else now
+        key = (device_id, suffix)
+        with self._lock:
+            bucket = self._buckets.get(device_id)
+            if bucket is None:
+                bucket = self._buckets[device_id] = TokenBucket(limit[0], limit[1], now)
+            # 已有待投递的合并消息时，新消息也必须合并，避免新旧顺序颠倒
+            if key not in self._pending and bucket.try_consume(now):
+                return self.ADMIT
+            self._pending[key] = (topic, raw, seq)
+            self._record_flood(device_id, device_type, now)
+            pending = len(self._pending)
+        metrics.ratelimited_total.inc(device_type=device_type or "")
+        metrics.ratelimit_pending.set(pending)
+        return self.COALESCED
+
+    def _record_flood(self, device_id: int, device_type: Optional[str], now: float) -> None:
+        self._coalesced_in_window[device_id] = self._coalesced_in_window.get(device_id, 0) + 1
+        logged_at = self._flood_logged_at.get(device_id)
+        if logged_at is not None and now - logged_at < self.flood_window_seconds:
+            return
+        limit = self._limit_for(device_type)
+        self._flood_events.append(
+            {
+                "device_id": device_id,
+                "device_type": device_type,
+                "rate": limit[0],
+                "burst": limit[1],
+                "coalesced": self._coalesced_in_window[device_id],
+                "window_seconds": self.flood_window_seconds,
+            }
+        )
+        self._flood_logged_at[device_id] = now
+        self._coalesced_in_window[device_id] = 0
+
+    def flush_due(self, now: Optional[float] = None) -> list[tuple]:
+        """取出令牌已恢复的设备的合并消息，返回 [(topic, raw, seq), ...]。"""
+        now = time.monotonic() if now is None else now
+        ready = []
+        with self._lock:
+            for key in list(self._pending.keys()):
+                bucket = self._buckets.get(key[0])
+                if bucket is None or bucket.try_consume(now):
+                    ready.append(self._pending.pop(key))
+            if self._pruned_at is None or now - self._pruned_at >= self.PRUNE_INTERVAL_SECONDS:
+                self._prune(now)
+                self._pruned_at = now
+            pending = len(self._pending)
+        metrics.ratelimit_pending.set(pending)
+        return ready
+
+    def _prune(self, now: float) -> None:
+        # 调用方持有锁
+        busy = {key[0] for key in self._pending}
+        for device_id, bucket in list(self._buckets.items()):
+            if device_id in busy:
+                continue
+            bucket._refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self._buckets[device_id]
+        for device_id, logged_at in list(self._flood_logged_at.items()):
+            if now - logged_at >= self.flood_window_seconds and device_id not in busy:
+                del self._flood_logged_at[device_id]
+                self._coalesced_in_window.pop(device_id, None)
+
+    def drain_flood_events(self) -> list[dict]:
+        with self._lock:
+            events, self._flood_events = self._flood_events, []
+        return events
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "tracked_devices": len(self._buckets),
+                "pending": len(self._pending),
+                "pending_devices": sorted({k[0] for k in self._pending}),
+            }
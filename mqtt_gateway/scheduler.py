@@ -0,0 +1,291 @@
+"""
+TIME_STATE 场景规则调度器：在时间窗口边界与相关状态变化时评估规则，而不是依赖触发设备的每次上报。
+
+- 时间窗口的开始 / 结束作为定时事件放入哈希时间轮（1 秒一格、覆盖 24 小时），
+  插入 / 取消 O(1)，每个 tick 只处理到期格子，窗口边界最多 24 小时后，因此每个定时器只被访问一次
+- 窗口打开时评估一次；窗口打开期间，仅当状态设备上报中与 trigger_state_value 相关的字段发生变化时再评估
+- 规则由 API 进程增删改，调度器定期比较 (数量, ID 之和, 最近更新时间) 指纹，有变化时重新加载
+
+调度器只决定「何时评估」；是否命中与执行动作由 executor(rule_id) 基于数据库最新状态完成。
+"""
+
+import math
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+from django.db import close_old_connections
+from django.db.models import Count, Max, Sum
+from django.utils import timezone
+
+from scenes.models import SceneRule
+
+EVENT_OPEN = "open"
+EVENT_CLOSE = "close"
+
+
+class TimerWheel:
+    """
+    单层哈希时间轮：tick_seconds 一格，slots 格一圈；格子按需创建（稀疏）。
+    超过一圈的定时器记录绝对 tick，轮转到时未到期则保留（多圈），保证正确性。
+    """
+
+    def __init__(self, tick_seconds: float = 1.0, slots: int = 86400, now: Optional[float] = None):
+        self.tick_seconds = float(tick_seconds)
+        self.slots = int(slots)
+        self._origin = time.time() if now is None else now
+        self._tick = 0
+        # slot -> {key: deadline_tick}
+        self._wheel: dict[int, dict] = {}
+        # key -> deadline_tick（用于 O(1) 取消 / 重排）
+        self._index: dict = {}
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def _to_tick(self, when: float) -> int:
+        return math.ceil((when - self._origin) / self.tick_seconds)
+
+    def schedule(self, key, when: float) -> None:
+        """安排 key 在 when（epoch 秒）到期；已存在则先取消。已过期的时间在下一个 tick 到期。"""
+        self.cancel(key)
+        deadline = max(self._to_tick(when), self._tick + 1)
+        self._wheel.setdefault(deadline % self.slots, {})[key] = deadline
+        self._index[key] = deadline
+
+    def cancel(self, key) -> None:
+        deadline = self._index.pop(key, None)
+        if deadline is None:
+            return
+        slot = deadline % self.slots
+        bucket = self._wheel.get(slot)
+        if bucket is not None:
+            bucket.pop(key, None)
+            if not bucket:
+                del self._wheel[slot]
+
+    def advance(self, now: float) -> list:
+        """推进到 now，返回到期的 key（按到期顺序）。"""
+        target = math.floor((now - self._origin) / self.tick_seconds)
+        expired = []
+        # 停顿超过一圈时，逐 tick 推进也只遍历一圈格子
+        if target - self._tick > self.slots:
+            self._tick = target - self.slots
+        while self._tick < target:
+            self._tick += 1
+            slot = self._tick % self.slots
+            bucket = self._wheel.get(slot)
+            if not bucket:
+                continue
+            for key, deadline in list(bucket.items()):
+                if deadline <= self._tick:
+                    del bucket[key]
+                    del self._index[key]
+                    expired.append(key)
+            if not bucket:
+                del self._wheel[slot]
+        return expired
+
+
+def window_open(start, end, current_time) -> bool:
+    """时间窗口 [start, end] 是否包含 current_time；start > end 表示跨午夜。"""
+    if not start or not end:
+        return False
+    if start <= end:
+        return start <= current_time <= end
+    return current_time >= start or current_time <= end
+
+
+def next_occurrence(time_of_day, now: datetime) -> datetime:
+    """time_of_day 在 now 之后（不含）的下一次出现时刻。"""
+    candidate = datetime.combine(now.date(), time_of_day)
+    if timezone.is_aware(now):
+        candidate = timezone.make_aware(candidate, now.tzinfo)
+    if candidate <= now:
+        candidate += timedelta(days=1)
+    return candidate
+
+
+class _ScheduledRule:
+    __slots__ = ("id", "start", "end", "state_device_id", "state_keys", "is_open")
+
+    def __init__(self, rule_id, start, end, state_device_id, state_keys):
+        self.id = rule_id
+        self.start = start
+        self.end = end
+        self.state_device_id = state_device_id
+        self.state_keys = state_keys
+        self.is_open = False
+
+
+class SceneScheduler:
+    """
+    executor(rule_id) 在调度线程中调用，负责最终判断与执行。
+    on_state_change() 可在任意线程调用，只做字典查找与入队。
+    """
+
+    def __init__(
+        self,
+        executor: Callable[[int], None],
+        tick_seconds: float = 1.0,
+        reload_seconds: float = 30.0,
+    ):
+        self.executor = executor
+        self.tick_seconds = float(tick_seconds)
+        self.reload_seconds = float(reload_seconds)
+        self.wheel = TimerWheel(tick_seconds=self.tick_seconds)
+        self._rules: dict[int, _ScheduledRule] = {}
+        # 状态设备 ID -> 关注该设备的规则 ID
+        self._watchers: dict[int, set] = {}
+        # 状态设备 ID -> 上次看到的相关字段值
+        self._last_values: dict[int, dict] = {}
+        self._fingerprint = None
+        self._changes: queue.Queue = queue.Queue()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # ==== 加载规则 ====
+
+    def _current_fingerprint(self):
+        agg = SceneRule.objects.filter(
+            enabled=True, trigger_type=SceneRule.TRIGGER_TIME_STATE
+        ).aggregate(count=Count("id"), ids=Sum("id"), updated=Max("updated_at"))
+        # ID 之和：数量不变时，启用 / 禁用互换的两条规则也会改变指纹
+        return agg["count"], agg["ids"], agg["updated"]
+
+    def load(self, now: Optional[datetime] = None) -> int:
+        """从数据库加载启用的 TIME_STATE 规则并安排窗口边界事件；返回规则数。"""
+        now = now or timezone.now()
+        rows = SceneRule.objects.filter(
+            enabled=True, trigger_type=SceneRule.TRIGGER_TIME_STATE
+        ).values_list(
+            "id", "trigger_time_start", "trigger_time_end", "trigger_state_device_id", "trigger_state_value"
+        )
+        # 重新加载时整体重建时间轮，原点对齐到 now
+        self.wheel = TimerWheel(tick_seconds=self.tick_seconds, now=now.timestamp())
+        self._rules.clear()
+        self._watchers.clear()
+        current_time = now.time()
+
+        for rule_id, start, end, state_device_id, state_value in rows:
+            # 未设置时间窗口的规则永远不会命中，与原逻辑一致
+            if not start or not end:
+                continue
+            state_keys = tuple(state_value.keys()) if state_device_id and isinstance(state_value, dict) else ()
+            rule = _ScheduledRule(rule_id, start, end, state_device_id if state_keys else None, state_keys)
+            rule.is_open = window_open(start, end, current_time)
+            self._rules[rule_id] = rule
+            if rule.state_device_id:
+                self._watchers.setdefault(rule.state_device_id, set()).add(rule_id)
+            self._schedule_boundaries(rule, now)
+
+        self._fingerprint = self._current_fingerprint()
+        return len(self._rules)
+
+    def _schedule_boundaries(self, rule: _ScheduledRule, now: datetime) -> None:
+        self.wheel.schedule((rule.id, EVENT_OPEN), next_occurrence(rule.start, now).timestamp())
+        # 窗口结束时间为闭区间，下一秒才关闭
+        close_at = next_occurrence(rule.end, now - timedelta(seconds=1)) + timedelta(seconds=1)
+        self.wheel.schedule((rule.id, EVENT_CLOSE), close_at.timestamp())
+
+    def reload_if_changed(self, now: Optional[datetime] = None) -> bool:
+        if self._current_fingerprint() == self._fingerprint:
+            return False
+        self.load(now)
+        return True
+
+    # ==== 事件处理 ====
+
+    def on_state_change(self, device_id: int, payload) -> None:
+        """网关写入 state 后调用：只有被 TIME_STATE 规则关注的设备才入队。"""
+        if device_id in self._watchers and isinstance(payload, dict):
+            self._changes.put((device_id, payload))
+
+    def process_state_change(self, device_id: int, payload: dict) -> list[int]:
+        """比较相关字段是否变化，返回需要评估的（窗口已打开的）规则 ID。"""
+        rule_ids = self._watchers.get(device_id)
+        if not rule_ids:
+            return []
+        previous = self._last_values.setdefault(device_id, {})
+        due = []
+        for rule_id in rule_ids:
+            rule = self._rules.get(rule_id)
+            if rule is None:
+                continue
+            changed = False
+            for key in rule.state_keys:
+                if key in payload and previous.get(key, object()) != payload[key]:
+                    changed = True
+            if changed and rule.is_open:
+                due.append(rule_id)
+        for rule_id in rule_ids:
+            rule = self._rules.get(rule_id)
+            if rule is not None:
+                for key in rule.state_keys:
+                    if key in payload:
+                        previous[key] = payload[key]
+        return sorted(due)
+
+    def advance(self, now: Optional[datetime] = None) -> list[int]:
+        """推进时间轮，处理窗口开闭事件并重新安排下一次边界；返回窗口刚打开、需要评估的规则 ID。"""
+        now = now or timezone.now()
+        due = []
+        for rule_id, event in self.wheel.advance(now.timestamp()):
+            rule = self._rules.get(rule_id)
+            if rule is None:
+                continue
+            if event == EVENT_OPEN:
+                rule.is_open = True
+                due.append(rule_id)
+                self.wheel.schedule((rule_id, EVENT_OPEN), next_occurrence(rule.start, now).timestamp())
+            else:
+                rule.is_open = False
+                close_at = next_occurrence(rule.end, now) + timedelta(seconds=1)
+                self.wheel.schedule((rule_id, EVENT_CLOSE), close_at.timestamp())
+        return due
+
+    def _run_executor(self, rule_ids) -> None:
+        for rule_id in rule_ids:
+            try:
+                self.executor(rule_id)
+            except Exception:
+                pass
+
+    # ==== 后台线程 ====
+
+    def start(self) -> int:
+        """加载规则并启动调度线程；返回加载的规则数。"""
+        count = self.load()
+        self._thread = threading.Thread(target=self._loop, name="gateway-scene-scheduler", daemon=True)
+        self._thread.start()
+        return count
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop_event.set()
+        self._changes.put(None)
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+
+    def _loop(self) -> None:
+        next_tick = time.monotonic()
+        next_reload = time.monotonic() + self.reload_seconds
+        while not self._stop_event.is_set():
+            try:
+                item = self._changes.get(timeout=max(0.0, next_tick - time.monotonic()))
+            except queue.Empty:
+                item = None
+            close_old_connections()
+            if item is not None:
+                self._run_executor(self.process_state_change(*item))
+            if time.monotonic() >= next_tick:
+                next_tick += self.tick_seconds
+                self._run_executor(self.advance())
+            if time.monotonic() >= next_reload:
+                next_reload = time.monotonic() + self.reload_seconds
+                try:
+                    self.reload_if_changed()
+                except Exception:
+                    pass
+        close_old_connections()
@@ -0,0 +1,209 @@
+"""
+上报 payload 的按设备类型 schema 校验与规范化。
+
+每种设备类型声明字段（规范名、类型、别名、取值范围），首次使用时编译为「键 -> 转换函数」查找表，
+入口处对每条上报只做一次：
+  - 别名统一为规范名（battery_voltage / battery -> battery_v，battery_percent -> battery_pct 等）
+  - 数值字段转换为 float / int，布尔字段接受 true/false、1/0、"on"/"off"
+  - 超出范围或无法转换的已知字段被丢弃；未声明的字段原样保留
+  - 烟雾传感器的 smoke / alarm / value 合并出规范的 smoke 布尔值
+
+规范化后的 payload 直接写入 current_state 与 DeviceData，下游（告警、场景、能耗统计）不再重复解析。
+"""
+
+import math
+from typing import Callable, Optional
+
+from devices.constants import DeviceType
+
+
+class Field:
+    """
+    字段声明：kind 为 float / int / bool；aliases 为设备可能使用的其他字段名。
+    clamp=True 时超出范围的数值被截断到边界，否则视为非法。
+    """
+
+    __slots__ = ("name", "kind", "aliases", "min_value", "max_value", "ndigits", "clamp")
+
+    def __init__(self, name, kind, aliases=(), min_value=None, max_value=None, ndigits=None, clamp=False):
+        self.name = name
+        self.kind = kind
+        self.aliases = tuple(aliases)
+        self.min_value = min_value
+        self.max_value = max_value
+        self.ndigits = ndigits
+        self.clamp = clamp
+
+
+_TRUE_STRINGS = {"1", "true", "on", "yes"}
+_FALSE_STRINGS = {"0", "false", "off", "no"}
+
+
+def _to_bool(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return value != 0
+    if isinstance(value, str):
+        text = value.strip().lower()
+        if text in _TRUE_STRINGS:
+            return True
+        if text in _FALSE_STRINGS:
+            return False
+    raise ValueError(value)
+
+
+def _to_number(value) -> float:
+    if isinstance(value, bool):
+        raise ValueError(value)
+    number = float(value)
+    if math.isnan(number) or math.isinf(number):
+        raise ValueError(value)
+    return number
+
+
+def _compile_field(field: Field) -> Callable:
+    """把字段声明编译为单个转换函数，失败时抛出 ValueError / TypeError。"""
+    if field.kind == "bool":
+        return _to_bool
+
+    low, high, ndigits, clamp = field.min_value, field.max_value, field.ndigits, field.clamp
+    as_int = field.kind == "int"
+
+    def convert(value):
+        number = _to_number(value)
+        if low is not None and number < low:
+            if not clamp:
+                raise ValueError(value)
+            number = low
+        if high is not None and number > high:
+            if not clamp:
+                raise ValueError(value)
+            number = high
+        if as_int:
+            return int(round(number))
+        return round(number, ndigits) if ndigits is not None else number
+
+    return convert
+
+
+# 所有类型通用的字段（电池供电设备）
+COMMON_FIELDS = (
+    Field("battery_v", "float", aliases=("battery_voltage", "battery"), min_value=0, max_value=60, ndigits=3),
+    Field("battery_pct", "float", aliases=("battery_percent", "batteryPercentage"), min_value=0, max_value=100, clamp=True),
+)
+
+# 开关类设备的电参字段（state 中也可能携带）
+POWER_FIELDS = (
+    Field("power_w", "float", aliases=("power",), min_value=0.0, ndigits=3, clamp=True),
+    Field("energy_wh_total", "float", min_value=0.0, ndigits=3, clamp=True),
+)
+
+STATE_SCHEMAS = {
+    DeviceType.TEMPERATURE_HUMIDITY: (
+        Field("temp", "float", aliases=("temperature",), min_value=-60, max_value=150),
+        Field("humi", "float", aliases=("humidity",), min_value=0, max_value=100),
+    ),
+    DeviceType.LIGHT: (
+        Field("light", "float", aliases=("lux",), min_value=0),
+    ),
+    DeviceType.PRESSURE: (
+        Field("pressure", "float", min_value=0, max_value=2000),
+    ),
+    DeviceType.PIR: (
+        Field("motion", "bool", aliases=("pir",)),
+        Field("value", "int", min_value=0),
+    ),
+    DeviceType.SMOKE: (
+        Field("smoke", "bool"),
+        Field("alarm", "bool"),
+        Field("value", "int", min_value=0),
+    ),
+    DeviceType.LAMP_SWITCH: (
+        Field("on", "bool"),
+    ) + POWER_FIELDS,
+    DeviceType.AC_SWITCH: (
+        Field("on", "bool"),
+        Field("temp", "float", min_value=0, max_value=50),
+    ) + POWER_FIELDS,
+    DeviceType.FAN_SWITCH: (
+        Field("on", "bool"),
+        Field("speed", "int", min_value=0, max_value=10),
+    ) + POWER_FIELDS,
+}
+
+
+class CompiledSchema:
+    """编译后的 schema：键（含别名）-> (规范名, 转换函数)。"""
+
+    def __init__(self, fields):
+        self.lookup: dict[str, tuple[str, Callable]] = {}
+        for field in fields:
+            convert = _compile_field(field)
+            self.lookup[field.name] = (field.name, convert)
+            for alias in field.aliases:
+                self.lookup[alias] = (field.name, convert)
+
+    def normalize(self, payload: dict) -> tuple[dict, list[str]]:
+        """返回 (规范化后的 payload, 被丢弃的非法字段名)。规范名与别名同时出现时以规范名为准。"""
+        result = {}
+        invalid = []
+        lookup = self.lookup
+        for key, value in payload.items():
+            entry = lookup.get(key)
+            if entry is None:
+                result[key] = value
+                continue
+            name, convert = entry
+            if name != key and name in payload:
+                continue
+            try:
+                result[name] = convert(value)
+            except (TypeError, ValueError):
+                invalid.append(key)
+        return result, invalid
+
+
+_STATE_COMPILED: dict = {}
+_POWER_COMPILED = CompiledSchema(POWER_FIELDS)
+_DEFAULT_COMPILED = CompiledSchema(COMMON_FIELDS)
+
+
+def _state_schema(device_type: Optional[str]) -> CompiledSchema:
+    compiled = _STATE_COMPILED.get(device_type)
+    if compiled is None:
+        fields = STATE_SCHEMAS.get(device_type)
+        compiled = CompiledSchema(fields + COMMON_FIELDS) if fields else _DEFAULT_COMPILED
+        _STATE_COMPILED[device_type] = compiled
+    return compiled
+
+
+def declared_fields(device_type: Optional[str]) -> frozenset:
+    """设备类型 schema 中声明（会被规范化）的字段名；未声明的字段按原样透传，类型不可信。"""
+    return frozenset(name for name, _ in _state_schema(device_type).lookup.values())
+
+
+def normalize_state(device_type: Optional[str], payload) -> tuple[Optional[dict], list[str]]:
+    """
+    规范化 state 上报。payload 非 JSON 对象、或全部字段都非法时返回 (None, 非法字段)，调用方应丢弃该上报。
+    """
+    if not isinstance(payload, dict):
+        return None, []
+    result, invalid = _state_schema(device_type).normalize(payload)
+    if device_type == DeviceType.SMOKE and ("alarm" in result or "value" in result or "smoke" in result):
+        result["smoke"] = bool(result.get("smoke") or result.get("alarm") or result.get("value"))
+    if not result:
+        return None, invalid
+    return result, invalid
+
+
+def normalize_power(payload) -> tuple[Optional[dict], list[str]]:
+    """规范化 power 上报：裸数值视为 power_w；仅保留电参字段，缺少合法 power_w 时返回 None。"""
+    if isinstance(payload, (int, float)) and not isinstance(payload, bool):
+        payload = {"power_w": payload}
+    if not isinstance(payload, dict):
+        return None, []
+    result, invalid = _POWER_COMPILED.normalize(payload)
+    if "power_w" not in result:
+        return None, invalid
+    return {k: result[k] for k in ("power_w", "energy_wh_total") if k in result}, invalid
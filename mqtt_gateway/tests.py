@@ -1,15 +1,28 @@
-from unittest.mock import patch
+import gzip
+import json
+import threading
+import time as time_module
+from datetime import datetime, time as dt_time, timedelta
+from unittest import skipUnless
+from unittest.mock import MagicMock, patch
 
 from django.contrib.auth import get_user_model
 from django.test import TestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework.test import APIClient
 from rest_framework_simplejwt.tokens import AccessToken
 
 from devices.constants import DeviceType
-from devices.models import Device
+from devices.models import CommandOutbox, Device, DeviceData
 from logs_app.models import SystemLog
+from mqtt_gateway import acks, codec, lanes, metrics, outbox, schema, tracing
+from mqtt_gateway.batch import BatchPayloadError, parse_batch_payload
 from mqtt_gateway.management.commands.run_mqtt_gateway import Command
+from mqtt_gateway.publisher import MqttPublisher
+from mqtt_gateway.ratelimit import IngestRateLimiter
+from mqtt_gateway.scheduler import SceneScheduler, TimerWheel
+from mqtt_gateway.utils import handle_ack_payload, publish_device_command
 from scenes.models import SceneRule
 
 
@@ -84,6 +97,7 @@ class SceneRuleExecutionTests(TestCase):
         publish_mock.assert_called_once_with(
             device_id=self.action_device.id,
             payload={"on": True},
+            trace_id=None,
         )
         self.assertTrue(
             SystemLog.objects.filter(source="SCENE_RULE", data__rule_id=self.rule.id).exists()
@@ -130,3 +144,917 @@ class RealtimeStreamSecurityTests(TestCase):
     def test_legacy_query_access_token_can_be_enabled_explicitly(self):
         legacy = self.client.get(self.stream_url, {"access_token": self.access})
         self.assertEqual(legacy.status_code, 200)
+
+
+class GatewayMetricsTests(TestCase):
+    def setUp(self):
+        self.device = Device.objects.create(
+            name="温度传感器",
+            type=DeviceType.TEMPERATURE_HUMIDITY,
+            is_online=True,
+            current_state={"temp": 25.0},
+        )
+        self.command = Command()
+
+    def test_state_message_updates_counters_and_stage_histograms(self):
+        before_msgs = metrics.messages_total.value(suffix="state")
+        before_scene = metrics.stage_seconds.count(stage="scene")
+        before_queries = metrics.db_queries_per_message.count(suffix="state")
+
+        self.command._process_message(f"home/{self.device.id}/state", b'{"temp": 26.5}')
+
+        self.assertEqual(metrics.messages_total.value(suffix="state"), before_msgs + 1)
+        self.assertEqual(metrics.stage_seconds.count(stage="scene"), before_scene + 1)
+        self.assertEqual(metrics.db_queries_per_message.count(suffix="state"), before_queries + 1)
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.current_state, {"temp": 26.5})
+
+    def test_malformed_topic_and_unknown_device_are_counted(self):
+        before_malformed = metrics.malformed_total.value(reason="device_id")
+        before_dropped = metrics.dropped_total.value(reason="unknown_device")
+
+        self.command._process_message("home/abc/state", b"{}")
+        self.command._process_message("home/999999/state", b"{}")
+
+        self.assertEqual(metrics.malformed_total.value(reason="device_id"), before_malformed + 1)
+        self.assertEqual(metrics.dropped_total.value(reason="unknown_device"), before_dropped + 1)
+
+    def test_render_prometheus_text_format(self):
+        registry = metrics.MetricsRegistry()
+        hist = registry.histogram("demo_seconds", "demo", ["stage"], buckets=(0.1, 1.0))
+        hist.observe(0.05, stage="parse")
+        hist.observe(0.5, stage="parse")
+        registry.counter("demo_total", "demo", ["suffix"]).inc(suffix="state")
+
+        text = registry.render()
+        self.assertIn("# TYPE demo_seconds histogram", text)
+        self.assertIn('demo_seconds_bucket{stage="parse",le="0.1"} 1', text)
+        self.assertIn('demo_seconds_bucket{stage="parse",le="+Inf"} 2', text)
+        self.assertIn('demo_seconds_count{stage="parse"} 2', text)
+        self.assertIn('demo_total{suffix="state"} 1', text)
+
+
+class GatewayPriorityLaneTests(TestCase):
+    def setUp(self):
+        self.sensor = Device.objects.create(name="温度传感器", type=DeviceType.TEMPERATURE_HUMIDITY)
+        self.smoke = Device.objects.create(name="烟雾传感器", type=DeviceType.SMOKE)
+        self.lamp = Device.objects.create(name="客厅灯", type=DeviceType.LAMP_SWITCH)
+
+    def test_classify_by_suffix_and_device_type(self):
+        self.assertEqual(lanes.classify("lwt", DeviceType.TEMPERATURE_HUMIDITY), lanes.LANE_ALARM)
+        self.assertEqual(lanes.classify("state", DeviceType.SMOKE), lanes.LANE_ALARM)
+        self.assertEqual(lanes.classify("state", DeviceType.AC_SWITCH), lanes.LANE_CONTROL)
+        self.assertEqual(lanes.classify("power", DeviceType.LAMP_SWITCH), lanes.LANE_CONTROL)
+        self.assertEqual(lanes.classify("state", DeviceType.PIR), lanes.LANE_TELEMETRY)
+        self.assertEqual(lanes.classify("state", None), lanes.LANE_TELEMETRY)
+
+    def test_alarm_lane_is_not_blocked_by_telemetry_backlog(self):
+        release = threading.Event()
+        alarm_done = threading.Event()
+        processed = []
+
+        def handler(topic, raw, seq):
+            if topic.endswith("/lwt") or topic.startswith(f"home/{self.smoke.id}/"):
+                processed.append(topic)
+                alarm_done.set()
+                return
+            release.wait(5)
+            processed.append(topic)
+
+        dispatcher = lanes.LaneDispatcher(handler=handler)
+        dispatcher.start()
+        try:
+            for _ in range(50):
+                dispatcher.submit(f"home/{self.sensor.id}/state", b'{"temp": 25}')
+            dispatcher.submit(f"home/{self.smoke.id}/state", b'{"smoke": true}')
+
+            self.assertTrue(alarm_done.wait(2))
+            self.assertEqual(processed[0], f"home/{self.smoke.id}/state")
+            self.assertGreater(dispatcher.depth(lanes.LANE_TELEMETRY), 0)
+        finally:
+            release.set()
+            dispatcher.stop()
+
+    def test_unknown_device_is_resolved_off_the_network_thread(self):
+        dispatcher = lanes.LaneDispatcher(handler=lambda *args: None, maxsize={lanes.LANE_TELEMETRY: 1})
+        dispatcher.type_cache.prime()
+        new_smoke = Device.objects.create(name="新烟雾传感器", type=DeviceType.SMOKE)
+        dispatcher.submit(f"home/{self.sensor.id}/state", b'{"temp": 25}')
+        with self.assertNumQueries(0):
+            self.assertTrue(dispatcher.submit(f"home/{new_smoke.id}/state", b'{"smoke": true}'))
+            self.assertTrue(dispatcher.submit(f"home/{new_smoke.id}/state", b'{"smoke": false}'))
+        # 未知设备的消息不进入可能丢弃的遥测通道
+        self.assertEqual(dispatcher.depth(lanes.LANE_TELEMETRY), 1)
+        self.assertEqual(dispatcher.depth(lanes.LANE_ALARM), 0)
+
+        # 解析线程查库后按类型投递，两条消息保持先后顺序
+        while not dispatcher._resolve_queue.empty():
+            dispatcher._resolve_one(*dispatcher._resolve_queue.get_nowait())
+        alarm_queue = dispatcher._queues[lanes.LANE_ALARM][0]
+        self.assertEqual([alarm_queue.get_nowait()[1] for _ in range(2)], [b'{"smoke": true}', b'{"smoke": false}'])
+        with self.assertNumQueries(0):
+            dispatcher.submit(f"home/{new_smoke.id}/state", b'{"smoke": true}')
+        self.assertEqual(dispatcher.depth(lanes.LANE_ALARM), 1)
+
+    def test_primed_types_do_not_expire(self):
+        dispatcher = lanes.LaneDispatcher(handler=lambda *args: None, maxsize={lanes.LANE_TELEMETRY: 1})
+        dispatcher.type_cache.prime()
+        dispatcher.submit(f"home/{self.sensor.id}/state", b'{"temp": 25}')
+        with patch("mqtt_gateway.lanes.time.monotonic", return_value=time_module.monotonic() + 3600):
+            self.assertTrue(dispatcher.submit(f"home/{self.smoke.id}/state", b'{"smoke": true}'))
+        self.assertEqual(dispatcher.depth(lanes.LANE_ALARM), 1)
+        self.assertEqual(dispatcher.depth(lanes.LANE_TELEMETRY), 1)
+
+    def test_device_type_cache_evicts_least_recently_used(self):
+        cache = lanes.DeviceTypeCache(max_entries=2)
+        cache.prime()
+        self.assertEqual(cache.peek(self.sensor.id), (False, None))
+        self.assertEqual(cache.peek(self.lamp.id), (True, DeviceType.LAMP_SWITCH))
+        cache.resolve(self.sensor.id)
+        self.assertFalse(cache.peek(self.smoke.id)[0])
+        self.assertTrue(cache.peek(self.lamp.id)[0])
+
+    def test_stale_state_does_not_mark_device_online_after_lwt(self):
+        self.lamp.is_online = False
+        self.lamp.save(update_fields=["is_online"])
+        command = Command()
+        command.lanes = lanes.LaneDispatcher(handler=command._process_message)
+        # 不启动工作线程，仅用于分配接收序号
+        command.lanes.submit(f"home/{self.lamp.id}/state", b'{"on": true}')
+        command.lanes.submit(f"home/{self.lamp.id}/lwt", b"offline")
+
+        command._process_message(f"home/{self.lamp.id}/state", b'{"on": true}', received_seq=1)
+
+        self.lamp.refresh_from_db()
+        self.assertFalse(self.lamp.is_online)
+        self.assertTrue(self.lamp.current_state.get("on"))
+
+
+class IngestRateLimiterTests(TestCase):
+    def _limiter(self):
+        return IngestRateLimiter(
+            {
+                "DEFAULT_RATE": 1.0,
+                "DEFAULT_BURST": 2,
+                "TYPE_LIMITS": {DeviceType.SMOKE: None},
+                "FLOOD_LOG_WINDOW_SECONDS": 60,
+            }
+        )
+
+    def test_excess_messages_are_coalesced_to_latest_and_flushed(self):
+        limiter = self._limiter()
+        admit = IngestRateLimiter.ADMIT
+        coalesced = IngestRateLimiter.COALESCED
+        args = (1, DeviceType.TEMPERATURE_HUMIDITY, "state", "home/1/state")
+
+        self.assertEqual(limiter.admit(*args, b'{"temp": 1}', 1, now=0.0), admit)
+        self.assertEqual(limiter.admit(*args, b'{"temp": 2}', 2, now=0.0), admit)
+        self.assertEqual(limiter.admit(*args, b'{"temp": 3}', 3, now=0.0), coalesced)
+        self.assertEqual(limiter.admit(*args, b'{"temp": 4}', 4, now=0.1), coalesced)
+        # 其他设备不受影响
+        self.assertEqual(
+            limiter.admit(2, DeviceType.TEMPERATURE_HUMIDITY, "state", "home/2/state", b"{}", 5, now=0.1),
+            admit,
+        )
+
+        self.assertEqual(limiter.flush_due(now=0.5), [])
+        self.assertEqual(limiter.flush_due(now=1.2), [("home/1/state", b'{"temp": 4}', 4)])
+        self.assertEqual(limiter.stats()["pending"], 0)
+
+    def test_flood_warning_once_per_window_and_exempt_types(self):
+        limiter = self._limiter()
+        for i in range(10):
+            limiter.admit(1, DeviceType.PIR, "state", "home/1/state", b"{}", i, now=0.0)
+        events = limiter.drain_flood_events()
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]["device_id"], 1)
+        self.assertEqual(limiter.drain_flood_events(), [])
+
+        for i in range(10):
+            decision = limiter.admit(3, DeviceType.SMOKE, "state", "home/3/state", b"{}", i, now=0.0)
+            self.assertEqual(decision, IngestRateLimiter.ADMIT)
+        self.assertEqual(
+            limiter.admit(1, DeviceType.PIR, "lwt", "home/1/lwt", b"offline", 99, now=0.0),
+            IngestRateLimiter.ADMIT,
+        )
+
+
+    def test_unknown_devices_use_their_own_limit(self):
+        limiter = IngestRateLimiter({"DEFAULT_RATE": 100.0, "DEFAULT_BURST": 100, "UNKNOWN_DEVICE_LIMIT": (1.0, 1)})
+        decisions = [limiter.admit(7, None, "state", "home/7/state", b"{}", i, now=0.0) for i in range(2)]
+        self.assertEqual(decisions, [IngestRateLimiter.ADMIT, IngestRateLimiter.COALESCED])
+
+    def test_dispatcher_passes_resolved_smoke_type_to_limiter(self):
+        smoke = Device.objects.create(name="烟雾传感器", type=DeviceType.SMOKE)
+        dispatcher = lanes.LaneDispatcher(handler=lambda *args: None, limiter=self._limiter())
+        for i in range(10):
+            dispatcher.submit(f"home/{smoke.id}/state", b'{"smoke": true}')
+        while not dispatcher._resolve_queue.empty():
+            dispatcher._resolve_one(*dispatcher._resolve_queue.get_nowait())
+        # 烟雾传感器免限流：全部进入告警通道，没有被合并
+        self.assertEqual(dispatcher.depth(lanes.LANE_ALARM), 10)
+        self.assertEqual(dispatcher.limiter.stats()["pending"], 0)
+
+    def test_flush_prunes_idle_buckets(self):
+        limiter = self._limiter()
+        for i in range(3):
+            limiter.admit(1, DeviceType.PIR, "state", "home/1/state", b"{}", i, now=0.0)
+        limiter.admit(2, DeviceType.PIR, "state", "home/2/state", b"{}", 9, now=0.0)
+        limiter.flush_due(now=0.5)
+        # 设备 1 仍有待投递消息，设备 2 的桶尚未回满
+        self.assertEqual(limiter.stats()["tracked_devices"], 2)
+
+        limiter.flush_due(now=1.2)
+        self.assertEqual(limiter.stats()["pending"], 0)
+        limiter.flush_due(now=100.0)
+        self.assertEqual(limiter.stats()["tracked_devices"], 0)
+        self.assertEqual(limiter._flood_logged_at, {})
+
+
+class BatchTelemetryTests(TestCase):
+    def setUp(self):
+        self.device = Device.objects.create(
+            name="温度传感器",
+            type=DeviceType.TEMPERATURE_HUMIDITY,
+            is_online=False,
+            current_state={"temp": 20.0},
+        )
+        self.command = Command()
+        self.topic = f"home/{self.device.id}/batch"
+
+    def _batch(self, readings, compress=True):
+        body = json.dumps(readings).encode()
+        return gzip.compress(body) if compress else body
+
+    def test_out_of_order_gzip_batch_is_stored_with_device_timestamps(self):
+        now = timezone.now().replace(microsecond=0)
+        epochs = [int((now - timedelta(minutes=m)).timestamp()) for m in (0, 10, 5)]
+        raw = self._batch(
+            [
+                {"ts": epochs[0], "data": {"temp": 23.0}},
+                {"ts": epochs[1] * 1000, "data": {"temp": 21.0}},
+                {"ts": epochs[2], "data": {"temp": 22.0}},
+                {"ts": "not-a-time", "data": {"temp": 99}},
+            ]
+        )
+
+        self.command._process_message(self.topic, raw)
+
+        rows = list(DeviceData.objects.filter(device=self.device).order_by("timestamp"))
+        self.assertEqual([r.data["temp"] for r in rows], [21.0, 22.0, 23.0])
+        self.assertEqual(rows[0].timestamp, now - timedelta(minutes=10))
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.current_state, {"temp": 23.0})
+        self.assertTrue(self.device.is_online)
+        self.assertEqual(
+            SystemLog.objects.filter(source="MQTT_GATEWAY", data__count=3).count(), 1
+        )
+
+    def test_late_batch_does_not_override_newer_state(self):
+        self.command._process_message(f"home/{self.device.id}/state", b'{"temp": 26.0}')
+        old = int((timezone.now() - timedelta(hours=1)).timestamp())
+        raw = self._batch([{"ts": old, "data": {"temp": 18.0}}], compress=False)
+
+        with patch.object(Command, "_check_and_execute_scene_rules") as scene_check:
+            self.command._process_message(self.topic, raw)
+
+        scene_check.assert_not_called()
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.current_state, {"temp": 26.0})
+        self.assertEqual(DeviceData.objects.filter(device=self.device).count(), 2)
+
+    def test_rejects_oversized_and_future_items(self):
+        future = int((timezone.now() + timedelta(hours=1)).timestamp())
+        readings, rejected = parse_batch_payload(
+            json.dumps({"readings": [{"ts": future, "data": {}}, {"ts": 0, "data": "x"}]}).encode()
+        )
+        self.assertEqual((readings, rejected), ([], 2))
+        with override_settings(MQTT_GATEWAY_BATCH={"MAX_DECOMPRESSED_BYTES": 64}):
+            with self.assertRaises(BatchPayloadError):
+                parse_batch_payload(gzip.compress(b"[" + b" " * 1000 + b"]"))
+
+
+class PayloadCodecTests(TestCase):
+    def setUp(self):
+        self.device = Device.objects.create(
+            name="客厅灯",
+            type=DeviceType.LAMP_SWITCH,
+            is_online=True,
+            current_state={"on": False},
+        )
+        self.command = Command()
+
+    def test_select_codec_by_topic_marker_and_default(self):
+        self.assertEqual(codec.select_codec(b'{"on": true}'), codec.CODEC_JSON)
+        self.assertEqual(codec.select_codec(b"\x81\xa2on\xc3", "MsgPack"), codec.CODEC_MSGPACK)
+        self.assertEqual(codec.select_codec(codec.CBOR_SELF_DESCRIBE + b"\xa0"), codec.CODEC_CBOR)
+        with override_settings(MQTT_GATEWAY_CODECS={"DEFAULT": "cbor"}):
+            self.assertEqual(codec.select_codec(b"\xa0"), codec.CODEC_CBOR)
+
+    def test_to_jsonable_keeps_stored_format(self):
+        self.assertEqual(
+            codec.to_jsonable({1: b"\x01\x02", "t": (1.5, None)}),
+            {"1": "AQI=", "t": [1.5, None]},
+        )
+
+    def test_unknown_topic_codec_is_counted_as_malformed(self):
+        before = metrics.malformed_total.value(reason="codec")
+        self.command._process_message(f"home/{self.device.id}/state/xml", b"<on/>")
+        self.assertEqual(metrics.malformed_total.value(reason="codec"), before + 1)
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.current_state, {"on": False})
+
+    @skipUnless(codec.cbor2 is not None, "需要 cbor2")
+    def test_cbor_state_is_stored_as_json(self):
+        raw = codec.CBOR_SELF_DESCRIBE + codec.cbor2.dumps({"on": True, "brightness": 80})
+        self.command._process_message(f"home/{self.device.id}/state", raw)
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.current_state, {"on": True, "brightness": 80})
+
+    @skipUnless(codec.msgpack is not None, "需要 msgpack")
+    def test_msgpack_round_trip(self):
+        raw = codec.encode_payload({"on": True}, codec.CODEC_MSGPACK)
+        self.assertEqual(codec.decode_payload(raw, codec.CODEC_MSGPACK), {"on": True})
+
+    def test_publish_device_command_uses_configured_codec(self):
+        client = MagicMock()
+        client.publish.return_value.rc = 0
+        with patch("mqtt_gateway.utils.get_mqtt_client", return_value=client):
+            publish_device_command(self.device.id, {"on": True})
+            with override_settings(MQTT_GATEWAY_CODECS={"COMMAND": "cbor"}):
+                publish_device_command(self.device.id, {"on": True})
+
+        topic, message = client.publish.call_args_list[0].args
+        self.assertEqual(topic, f"home/{self.device.id}/cmd")
+        message = json.loads(message)
+        self.assertTrue(message.pop("cmd_id"))
+        self.assertEqual(message, {"on": True})
+        # CBOR 不可用时不发布
+        expected_calls = 2 if codec.cbor2 is not None else 1
+        self.assertEqual(client.publish.call_count, expected_calls)
+
+
+class PayloadSchemaTests(TestCase):
+    def setUp(self):
+        self.sensor = Device.objects.create(
+            name="温湿度传感器", type=DeviceType.TEMPERATURE_HUMIDITY, current_state={}
+        )
+        self.lamp = Device.objects.create(name="客厅灯", type=DeviceType.LAMP_SWITCH, current_state={})
+        self.command = Command()
+
+    def test_normalize_coerces_numbers_and_battery_aliases(self):
+        data, invalid = schema.normalize_state(
+            DeviceType.TEMPERATURE_HUMIDITY,
+            {"temperature": "24.5", "humi": 999, "battery_voltage": "3.71", "battery_percent": 120, "rssi": -60},
+        )
+        self.assertEqual(data, {"temp": 24.5, "battery_v": 3.71, "battery_pct": 100, "rssi": -60})
+        self.assertEqual(invalid, ["humi"])
+
+        data, _ = schema.normalize_state(DeviceType.SMOKE, {"alarm": "1", "value": 1})
+        self.assertEqual(data, {"alarm": True, "value": 1, "smoke": True})
+        self.assertEqual(schema.normalize_power("12.3456"), (None, []))
+        self.assertEqual(schema.normalize_power({"power": -5, "energy_wh_total": "10"})[0],
+                         {"power_w": 0.0, "energy_wh_total": 10.0})
+
+    def test_junk_state_is_not_written_to_history(self):
+        before = metrics.malformed_total.value(reason="schema")
+        self.command._process_message(f"home/{self.sensor.id}/state", b'"garbage"')
+        self.command._process_message(f"home/{self.sensor.id}/state", b'{"temp": "hot"}')
+
+        self.assertEqual(metrics.malformed_total.value(reason="schema"), before + 2)
+        self.assertFalse(DeviceData.objects.filter(device=self.sensor).exists())
+
+    def test_state_and_power_are_stored_normalized(self):
+        self.command._process_message(f"home/{self.lamp.id}/state", b'{"on": "off", "battery": 3.3}')
+        self.command._process_message(f"home/{self.lamp.id}/power", b'{"power": "7.5"}')
+
+        self.lamp.refresh_from_db()
+        self.assertEqual(self.lamp.current_state, {"on": False, "battery_v": 3.3, "power_w": 7.5})
+        self.assertEqual(
+            list(DeviceData.objects.filter(device=self.lamp).order_by("id").values_list("data", flat=True)),
+            [{"on": False, "battery_v": 3.3}, {"power_w": 7.5}],
+        )
+
+
+    def test_undeclared_non_numeric_field_does_not_break_alerts(self):
+        from logs_app.models import EmailAlertRule
+
+        pressure = Device.objects.create(name="气压计", type=DeviceType.PRESSURE, current_state={})
+        EmailAlertRule.objects.create(
+            name="温度", trigger_device=pressure, trigger_field="temp", trigger_value=20, recipients=["a@example.com"]
+        )
+        before = metrics.malformed_total.value(reason="exception")
+        self.command._process_message(f"home/{pressure.id}/state", b'{"pressure": 1013, "temp": "22.5"}')
+
+        self.assertEqual(metrics.malformed_total.value(reason="exception"), before)
+        pressure.refresh_from_db()
+        self.assertEqual(pressure.current_state, {"pressure": 1013.0, "temp": "22.5"})
+
+
+class SceneSchedulerTests(TestCase):
+    def setUp(self):
+        self.user = user = get_user_model().objects.create_user(username="sched_user", password="pass123456")
+        self.pir = Device.objects.create(name="人体感应", type=DeviceType.PIR, owner=user, current_state={})
+        self.lamp = Device.objects.create(
+            name="客厅灯", type=DeviceType.LAMP_SWITCH, owner=user, is_online=True, current_state={"on": False}
+        )
+        self.rule = SceneRule.objects.create(
+            name="晚上有人开灯",
+            owner=user,
+            trigger_type=SceneRule.TRIGGER_TIME_STATE,
+            trigger_device=self.pir,
+            trigger_field="motion",
+            trigger_value={},
+            trigger_time_start=dt_time(19, 0),
+            trigger_time_end=dt_time(23, 0),
+            trigger_state_device=self.pir,
+            trigger_state_value={"motion": True},
+            action_device=self.lamp,
+            action_type=SceneRule.ACTION_TURN_ON,
+            debounce_seconds=0,
+        )
+        self.fired = []
+        self.scheduler = SceneScheduler(executor=self.fired.append)
+
+    def test_enable_disable_swap_triggers_reload(self):
+        other = SceneRule.objects.create(
+            name="晚上有人开灯（备用）",
+            owner=self.user,
+            enabled=False,
+            trigger_type=SceneRule.TRIGGER_TIME_STATE,
+            trigger_device=self.pir,
+            trigger_field="motion",
+            trigger_value={},
+            trigger_time_start=dt_time(20, 0),
+            trigger_time_end=dt_time(22, 0),
+            trigger_state_device=self.pir,
+            trigger_state_value={"motion": True},
+            action_device=self.lamp,
+            action_type=SceneRule.ACTION_TURN_ON,
+        )
+        # 另有一条最近更新的启用规则：互换后数量与最大更新时间都不变
+        newest = SceneRule.objects.get(pk=self.rule.pk)
+        newest.pk = None
+        newest.name = "另一条规则"
+        newest.save()
+        SceneRule.objects.filter(pk=newest.pk).update(updated_at=timezone.now() + timedelta(hours=1))
+        SceneRule.objects.filter(pk=other.pk).update(updated_at=timezone.now() - timedelta(days=1))
+        self.scheduler.load()
+
+        client = APIClient()
+        client.force_authenticate(self.user)
+        client.post(f"/api/scenes/{self.rule.id}/toggle_enabled/")
+        client.post(f"/api/scenes/{other.id}/toggle_enabled/")
+
+        self.assertTrue(self.scheduler.reload_if_changed())
+        self.assertEqual(
+            set(SceneRule.objects.filter(enabled=True).values_list("id", flat=True)), {other.id, newest.id}
+        )
+
+    def test_timer_wheel_expires_in_order_and_supports_cancel(self):
+        wheel = TimerWheel(tick_seconds=1.0, slots=10, now=0.0)
+        wheel.schedule("a", 3.0)
+        wheel.schedule("b", 25.0)  # 超过一圈
+        wheel.schedule("c", 5.0)
+        wheel.cancel("c")
+        self.assertEqual(wheel.advance(2.5), [])
+        self.assertEqual(wheel.advance(4.0), ["a"])
+        self.assertEqual(wheel.advance(15.0), [])
+        self.assertEqual(wheel.advance(25.0), ["b"])
+        self.assertEqual(len(wheel), 0)
+
+    def test_window_open_boundary_and_close(self):
+        self.scheduler.load(now=datetime(2024, 1, 1, 18, 59, 58))
+        self.assertEqual(self.scheduler.advance(datetime(2024, 1, 1, 18, 59, 59)), [])
+        self.assertEqual(self.scheduler.advance(datetime(2024, 1, 1, 19, 0, 0)), [self.rule.id])
+        # 窗口打开期间仅相关字段变化才评估
+        self.assertEqual(self.scheduler.process_state_change(self.pir.id, {"motion": True}), [self.rule.id])
+        self.assertEqual(self.scheduler.process_state_change(self.pir.id, {"motion": True, "value": 1}), [])
+        self.assertEqual(self.scheduler.advance(datetime(2024, 1, 1, 23, 0, 1)), [])
+        self.assertEqual(self.scheduler.process_state_change(self.pir.id, {"motion": False}), [])
+        # 第二天再次打开
+        self.assertEqual(self.scheduler.advance(datetime(2024, 1, 2, 19, 0, 0)), [self.rule.id])
+
+    def test_gateway_executes_time_state_rule_via_scheduler_only(self):
+        command = Command()
+        command.scene_scheduler = self.scheduler
+        self.pir.current_state = {"motion": True}
+        self.pir.save(update_fields=["current_state"])
+
+        # 启用调度器后，触发设备的上报不再直接评估 TIME_STATE 规则
+        with patch("mqtt_gateway.utils.publish_device_command") as publish_mock:
+            command._check_and_execute_scene_rules(self.pir, {"motion": True})
+            publish_mock.assert_not_called()
+            with patch("mqtt_gateway.management.commands.run_mqtt_gateway.timezone.now",
+                       return_value=datetime(2024, 1, 1, 20, 0)):
+                command._run_scheduled_rule(self.rule.id)
+            publish_mock.assert_called_once_with(device_id=self.lamp.id, payload={"on": True}, trace_id=None)
+
+
+class EdgeTriggeredSceneTests(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_user(username="edge_user", password="pass123456")
+        self.sensor = Device.objects.create(
+            name="温度传感器", type=DeviceType.TEMPERATURE_HUMIDITY, owner=user, current_state={}
+        )
+        self.ac = Device.objects.create(
+            name="客厅空调", type=DeviceType.AC_SWITCH, owner=user, is_online=True, current_state={"on": False}
+        )
+        self.rule = SceneRule.objects.create(
+            name="高温开空调",
+            owner=user,
+            trigger_type=SceneRule.TRIGGER_THRESHOLD_ABOVE,
+            trigger_device=self.sensor,
+            trigger_field="temp",
+            trigger_value=28.0,
+            action_device=self.ac,
+            action_type=SceneRule.ACTION_TURN_ON,
+            debounce_seconds=0,
+            trigger_mode=SceneRule.MODE_EDGE,
+            hysteresis=1.0,
+        )
+        self.command = Command()
+
+    def _feed(self, values):
+        with patch("mqtt_gateway.utils.publish_device_command") as publish_mock:
+            for value in values:
+                self.command._check_and_execute_scene_rules(self.sensor, {"temp": value})
+        return publish_mock.call_count
+
+    def test_fires_once_per_crossing_and_rearms_after_hysteresis(self):
+        # 持续高温只触发一次；27.5 未越过回差不布防；26.9 布防后再次越限触发
+        self.assertEqual(self._feed([29, 30, 31, 27.5, 29]), 1)
+        self.assertEqual(self._feed([26.9, 30, 30]), 1)
+        self.assertEqual(
+            SystemLog.objects.filter(source="SCENE_RULE", data__rule_id=self.rule.id).count(), 2
+        )
+
+    def test_level_mode_keeps_refiring_and_edit_rearms(self):
+        self.assertEqual(self._feed([29, 30]), 1)
+        self.rule.hysteresis = 0.5
+        self.rule.save()
+        self.assertEqual(self._feed([30]), 1)
+
+        SceneRule.objects.filter(pk=self.rule.pk).update(trigger_mode=SceneRule.MODE_LEVEL)
+        self.assertEqual(self._feed([30, 31]), 2)
+
+
+class CompositeSceneRuleTests(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_user(username="composite_user", password="pass123456")
+        self.sensor = Device.objects.create(
+            name="温度传感器", type=DeviceType.TEMPERATURE_HUMIDITY, owner=user, current_state={"temp": 25}
+        )
+        self.pir = Device.objects.create(
+            name="人体感应", type=DeviceType.PIR, owner=user, current_state={"motion": False}
+        )
+        self.ac = Device.objects.create(
+            name="客厅空调", type=DeviceType.AC_SWITCH, owner=user, is_online=True, current_state={"on": False}
+        )
+        self.rule = SceneRule.objects.create(
+            name="有人且高温开空调",
+            owner=user,
+            trigger_type=SceneRule.TRIGGER_COMPOSITE,
+            trigger_device=self.sensor,
+            trigger_field="",
+            trigger_value={},
+            conditions={
+                "op": "AND",
+                "children": [
+                    {"device": self.sensor.id, "field": "temp", "cmp": ">", "value": 28},
+                    {"device": self.pir.id, "field": "motion", "cmp": "==", "value": True},
+                ],
+            },
+            action_device=self.ac,
+            action_type=SceneRule.ACTION_TURN_ON,
+            debounce_seconds=0,
+            trigger_mode=SceneRule.MODE_EDGE,
+        )
+        self.command = Command()
+
+    def _feed(self, device, payload):
+        with patch("mqtt_gateway.utils.publish_device_command") as publish_mock:
+            self.command._check_and_execute_scene_rules(device, payload)
+        return publish_mock.call_count
+
+    def test_fires_when_conditions_across_devices_become_true(self):
+        # 初始真值来自 current_state：温度 25、无人
+        self.assertEqual(self._feed(self.sensor, {"temp": 30}), 0)
+        self.assertEqual(self._feed(self.pir, {"motion": True}), 1)
+        # 边沿触发：条件保持满足时不重复执行，先变为不满足再满足才再次执行
+        self.assertEqual(self._feed(self.sensor, {"temp": 31}), 0)
+        self.assertEqual(self._feed(self.pir, {"motion": False}), 0)
+        self.assertEqual(self._feed(self.pir, {"motion": True}), 1)
+
+    def test_unrelated_fields_do_not_touch_rule(self):
+        self.assertEqual(self.command.composite_matcher.on_reading(self.sensor.id, {"humi": 80}), [])
+        hits = self.command.composite_matcher.on_reading(self.sensor.id, {"temp": 29})
+        self.assertEqual(hits, [(self.rule.id, False, False)])
+
+
+class SceneActionCoalescingTests(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_user(username="coalesce_user", password="pass123456")
+        self.sensor = Device.objects.create(
+            name="温度传感器", type=DeviceType.TEMPERATURE_HUMIDITY, owner=user, current_state={}
+        )
+        self.ac = Device.objects.create(
+            name="客厅空调", type=DeviceType.AC_SWITCH, owner=user, is_online=True, current_state={"on": False}
+        )
+        self.fan = Device.objects.create(
+            name="风扇", type=DeviceType.FAN_SWITCH, owner=user, is_online=True, current_state={"on": False}
+        )
+        base = dict(
+            owner=user,
+            trigger_type=SceneRule.TRIGGER_THRESHOLD_ABOVE,
+            trigger_device=self.sensor,
+            trigger_field="temp",
+            debounce_seconds=0,
+        )
+        self.cool = SceneRule.objects.create(
+            name="高温制冷", trigger_value=28, action_device=self.ac,
+            action_type=SceneRule.ACTION_SET_TEMP, action_value=24, **base
+        )
+        self.off = SceneRule.objects.create(
+            name="过热保护关空调", trigger_value=40, action_device=self.ac,
+            action_type=SceneRule.ACTION_TURN_OFF, **base
+        )
+        self.fan_on = SceneRule.objects.create(
+            name="高温开风扇", trigger_value=28, action_device=self.fan,
+            action_type=SceneRule.ACTION_TURN_ON, **base
+        )
+
+    def test_actions_merge_per_device_with_turn_off_precedence(self):
+        with patch("mqtt_gateway.utils.publish_device_command") as publish_mock:
+            Command()._check_and_execute_scene_rules(self.sensor, {"temp": 45})
+
+        commands = {call.kwargs["device_id"]: call.kwargs["payload"] for call in publish_mock.call_args_list}
+        self.assertEqual(publish_mock.call_count, 2)
+        self.assertEqual(commands[self.ac.id], {"temp": 24.0, "on": False})
+        self.assertEqual(commands[self.fan.id], {"on": True})
+
+        self.ac.refresh_from_db()
+        self.assertEqual(self.ac.current_state, {"on": False, "temp": 24.0})
+        self.assertEqual(SceneRule.objects.filter(last_triggered_at__isnull=False).count(), 3)
+        self.assertEqual(SystemLog.objects.filter(source="SCENE_RULE").count(), 3)
+
+    def test_single_rule_fires_alone_below_second_threshold(self):
+        with patch("mqtt_gateway.utils.publish_device_command") as publish_mock:
+            Command()._check_and_execute_scene_rules(self.sensor, {"temp": 30})
+        commands = {call.kwargs["device_id"]: call.kwargs["payload"] for call in publish_mock.call_args_list}
+        self.assertEqual(commands[self.ac.id], {"temp": 24.0, "on": True})
+
+
+class GatewayTracingTests(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_user(username="trace_user", password="pass123456")
+        self.sensor = Device.objects.create(
+            name="温度传感器", type=DeviceType.TEMPERATURE_HUMIDITY, owner=user, current_state={}
+        )
+        self.fan = Device.objects.create(
+            name="风扇", type=DeviceType.FAN_SWITCH, owner=user, is_online=True, current_state={"on": False}
+        )
+        self.rule = SceneRule.objects.create(
+            name="高温开风扇", owner=user, trigger_type=SceneRule.TRIGGER_THRESHOLD_ABOVE,
+            trigger_device=self.sensor, trigger_field="temp", trigger_value=28, debounce_seconds=0,
+            action_device=self.fan, action_type=SceneRule.ACTION_TURN_ON,
+        )
+        tracing.buffer.clear()
+        self.addCleanup(tracing.buffer.clear)
+
+    def test_trace_id_links_command_and_scene_log(self):
+        with patch("mqtt_gateway.utils.publish_device_command") as publish_mock:
+            Command()._process_message(f"home/{self.sensor.id}/state", b'{"temp": 30}')
+
+        trace = tracing.buffer.snapshot()[-1]
+        stages = [stage for stage, _ in trace["spans"]]
+        for stage in ("parse", "lookup", "validate", "db", "alert", "publish", "trigger_to_command", "scene"):
+            self.assertIn(stage, stages)
+        self.assertEqual(publish_mock.call_args.kwargs["trace_id"], trace["trace_id"])
+        log = SystemLog.objects.get(source="SCENE_RULE", data__rule_id=self.rule.id)
+        self.assertEqual(log.data["trace_id"], trace["trace_id"])
+
+    def test_summary_percentiles_and_admin_endpoint(self):
+        traces = [
+            {"trace_id": str(i), "total": i / 1000, "spans": [["db", i / 1000], ["trigger_to_command", i / 1000]]}
+            for i in range(1, 101)
+        ]
+        summary = tracing.summarize(traces, slowest=3)
+        self.assertEqual(summary["stages"]["db"]["count"], 100)
+        self.assertEqual(summary["stages"]["db"]["p50_ms"], 50.0)
+        self.assertEqual(summary["stages"]["db"]["p99_ms"], 99.0)
+        self.assertEqual([item["trace_id"] for item in summary["slowest"]], ["100", "99", "98"])
+
+        for item in traces:
+            tracing.buffer.add(item)
+        client = APIClient()
+        url = reverse("mqtt-traces")
+        client.force_authenticate(get_user_model().objects.get(username="trace_user"))
+        self.assertEqual(client.get(url).status_code, 403)
+        admin = get_user_model().objects.create_user(username="trace_admin", password="pass123456", is_staff=True)
+        client.force_authenticate(admin)
+        res = client.get(url)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data["source"], "memory")
+        self.assertEqual(res.data["stages"]["trigger_to_command"]["p95_ms"], 95.0)
+
+
+class CommandAckTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="ack_user", password="pass123456")
+        self.lamp = Device.objects.create(
+            name="台灯", type=DeviceType.LAMP_SWITCH, owner=self.user, is_online=True, current_state={"on": False}
+        )
+        self.tracker = acks.CommandTracker(timeout_seconds=5)
+        patcher = patch.object(acks, "tracker", self.tracker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_tracker_ack_state_echo_and_timeout(self):
+        before_timeout = metrics.commands_total.value(result="timeout")
+        self.tracker.match_state(self.lamp.id, {"on": False, "speed": 1})
+        acked = self.tracker.register(self.lamp.id, {"on": True})
+        echoed = self.tracker.register(self.lamp.id, {"speed": 2, "on": True})
+        lost = self.tracker.register(self.lamp.id, {"on": False})
+
+        self.assertIs(self.tracker.ack(acked.cmd_id), acked)
+        self.assertIsNone(self.tracker.ack(acked.cmd_id))
+        self.assertEqual(acked.status, acks.STATUS_ACKED)
+        self.assertIsNotNone(acked.latency)
+
+        # 回显缺少 speed 时不确认；字段齐全后确认
+        self.assertEqual(self.tracker.match_state(self.lamp.id, {"on": True}), [])
+        self.assertEqual(self.tracker.match_state(self.lamp.id, {"on": True, "speed": 2}), [echoed])
+        self.assertEqual(echoed.via, "state")
+
+        self.assertEqual(self.tracker.expire(now=lost.deadline + 1), 1)
+        self.assertEqual(lost.wait(0), acks.STATUS_TIMEOUT)
+        self.assertEqual(len(self.tracker), 0)
+        self.assertEqual(metrics.commands_total.value(result="timeout"), before_timeout + 1)
+
+    def test_unchanged_telemetry_does_not_confirm_command(self):
+        self.tracker.match_state(self.lamp.id, {"on": True})
+        command = self.tracker.register(self.lamp.id, {"on": True})
+        unknown = self.tracker.register(self.lamp.id + 1000, {"on": True})
+
+        # 命令前已是 on=true：周期性上报不能确认，只能靠 cmd_id 回显
+        self.assertEqual(self.tracker.match_state(self.lamp.id, {"on": True}), [])
+        self.assertEqual(self.tracker.match_state(unknown.device_id, {"on": True}), [])
+        self.assertEqual(self.tracker.match_state(self.lamp.id, {"on": True, "cmd_id": command.cmd_id}), [command])
+
+    def test_gateway_correlates_cmd_with_state_echo(self):
+        command = Command()
+        command._process_message(f"home/{self.lamp.id}/cmd", b'{"on": true, "cmd_id": "c1"}')
+        self.assertEqual(self.tracker.get("c1").status, acks.STATUS_PENDING)
+
+        with patch("mqtt_gateway.utils.publish_command_ack") as ack_mock:
+            command._process_message(f"home/{self.lamp.id}/state", b'{"on": true, "cmd_id": "c1"}')
+
+        ack_mock.assert_called_once_with(self.lamp.id, "c1")
+        self.assertIsNone(self.tracker.get("c1"))
+        self.lamp.refresh_from_db()
+        self.assertEqual(self.lamp.current_state, {"on": True})
+
+    def test_device_failure_ack_is_logged(self):
+        pending = self.tracker.register(self.lamp.id, {"on": True}, cmd_id="c2")
+        Command()._process_message(f"home/{self.lamp.id}/ack", b'{"cmd_id": "c2", "ok": false, "error": "relay stuck"}')
+        self.assertEqual(pending.status, acks.STATUS_FAILED)
+        self.assertTrue(SystemLog.objects.filter(data__cmd_id="c2").exists())
+
+    def test_toggle_waits_for_ack(self):
+        client = MagicMock()
+        client.publish.return_value.rc = 0
+
+        def device_acks():
+            for _ in range(100):
+                published = client.publish.call_args_list
+                if published:
+                    cmd_id = json.loads(published[0].args[1])["cmd_id"]
+                    handle_ack_payload(json.dumps({"cmd_id": cmd_id}).encode())
+                    return
+                threading.Event().wait(0.01)
+
+        api = APIClient()
+        api.force_authenticate(self.user)
+        with patch("mqtt_gateway.utils.get_mqtt_client", return_value=client):
+            worker = threading.Thread(target=device_acks)
+            worker.start()
+            res = api.post(f"/api/devices/{self.lamp.id}/toggle/?wait=2", {}, format="json")
+            worker.join()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data["command"]["status"], acks.STATUS_ACKED)
+        self.assertEqual(res.data["current_state"], {"on": True})
+
+
+class MqttPublisherTests(TestCase):
+    def setUp(self):
+        self.client = MagicMock()
+        self.client.publish.return_value.rc = 0
+        self.subscribed = []
+        self.publisher = MqttPublisher(lambda: self.client, buffer_size=2, on_connected=self.subscribed.append)
+
+    def test_buffers_while_disconnected_and_flushes_on_connect(self):
+        for n in range(3):
+            result = self.publisher.publish("home/1/cmd", f"m{n}".encode())
+            self.assertTrue(result.queued)
+        self.client.publish.assert_not_called()
+        self.assertEqual(self.publisher.stats()["queued"], 2)
+        self.assertEqual(self.publisher.stats()["dropped"], 1)
+
+        self.publisher._on_connect(self.client, None, {}, 0)
+        self.assertEqual(self.subscribed, [self.client])
+        self.assertEqual([call.args[1] for call in self.client.publish.call_args_list], [b"m1", b"m2"])
+        stats = self.publisher.stats()
+        self.assertEqual((stats["connected"], stats["queued"], stats["in_flight"]), (True, 0, 2))
+
+        self.publisher._on_publish(self.client, None, 1)
+        self.assertEqual(self.publisher.stats()["in_flight"], 1)
+
+    def test_gateway_publisher_does_not_consume_acks(self):
+        from mqtt_gateway import utils
+
+        with patch.object(utils, "_publisher", None), patch.object(utils, "_ack_listener_enabled", True), \
+                patch("mqtt_gateway.utils.MqttPublisher") as publisher_cls:
+            utils.disable_ack_listener()
+            utils.get_publisher()
+        kwargs = publisher_cls.call_args.kwargs
+        self.assertIsNone(kwargs["on_message"])
+        self.assertIsNone(kwargs["on_connected"])
+
+    def test_prewarm_only_in_server_entry_points(self):
+        from mqtt_gateway.apps import PREWARM_ENV, _should_prewarm
+
+        cases = [
+            (["manage.py", "dumpdata"], {}, False),
+            (["manage.py", "run_mqtt_gateway"], {}, False),
+            (["manage.py", "runserver"], {}, False),
+            (["manage.py", "runserver"], {"RUN_MAIN": "true"}, True),
+            (["gunicorn", "smart_home_backend.wsgi"], {PREWARM_ENV: "1"}, True),
+            (["gunicorn", "smart_home_backend.wsgi"], {PREWARM_ENV: "0"}, False),
+        ]
+        for argv, env, expected in cases:
+            with self.subTest(argv=argv, env=env), patch("sys.argv", argv), \
+                    patch.dict("os.environ", env, clear=False) as environ:
+                if PREWARM_ENV not in env:
+                    environ.pop(PREWARM_ENV, None)
+                if "RUN_MAIN" not in env:
+                    environ.pop("RUN_MAIN", None)
+                self.assertEqual(_should_prewarm(), expected)
+
+    def test_start_does_not_block_on_broker(self):
+        self.publisher.start("broker.invalid", 1883)
+        self.publisher.start("broker.invalid", 1883)
+        self.client.connect_async.assert_called_once_with("broker.invalid", 1883, 60)
+        self.client.loop_start.assert_called_once_with()
+        self.client.connect.assert_not_called()
+
+    def test_status_endpoint_reports_publisher_counts(self):
+        user = get_user_model().objects.create_user(username="publisher_user", password="pass123456")
+        api = APIClient()
+        api.force_authenticate(user)
+        with patch("mqtt_gateway.views.get_publisher", return_value=self.publisher):
+            self.publisher.publish("home/1/cmd", b"{}")
+            res = api.get(reverse("mqtt-status"))
+        self.assertEqual(res.data["connected"], False)
+        self.assertEqual(res.data["publisher"]["queued"], 1)
+
+
+class CommandOutboxTests(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_user(username="outbox_user", password="pass123456")
+        self.sensor = Device.objects.create(
+            name="温度传感器", type=DeviceType.TEMPERATURE_HUMIDITY, owner=user, current_state={}
+        )
+        self.ac = Device.objects.create(
+            name="客厅空调", type=DeviceType.AC_SWITCH, owner=user, is_online=False, current_state={"on": False}
+        )
+        base = dict(
+            owner=user, trigger_type=SceneRule.TRIGGER_THRESHOLD_ABOVE, trigger_device=self.sensor,
+            trigger_field="temp", debounce_seconds=0, action_device=self.ac,
+        )
+        SceneRule.objects.create(name="高温制冷", trigger_value=28, action_type=SceneRule.ACTION_SET_TEMP,
+                                 action_value=24, **base)
+        SceneRule.objects.create(name="过热关机", trigger_value=40, action_type=SceneRule.ACTION_TURN_OFF, **base)
+
+    def test_offline_scene_actions_flush_once_on_lwt_online(self):
+        command = Command()
+        with patch("mqtt_gateway.utils.publish_device_command") as publish_mock:
+            command._check_and_execute_scene_rules(self.sensor, {"temp": 30})
+            command._check_and_execute_scene_rules(self.sensor, {"temp": 45})
+            publish_mock.assert_not_called()
+            self.assertEqual(CommandOutbox.objects.get(device=self.ac).payload, {"temp": 24.0, "on": False})
+
+            command._process_message(f"home/{self.ac.id}/lwt", b"online")
+
+        publish_mock.assert_called_once_with(device_id=self.ac.id, payload={"temp": 24.0, "on": False})
+        self.assertFalse(CommandOutbox.objects.exists())
+        self.ac.refresh_from_db()
+        self.assertEqual(self.ac.current_state, {"on": False, "temp": 24.0})
+
+    @override_settings(MQTT_COMMAND_OUTBOX={"ENABLED": True, "MAX_AGE_SECONDS": 60})
+    def test_stale_commands_are_dropped(self):
+        outbox.enqueue(self.ac.id, {"on": True})
+        CommandOutbox.objects.update(updated_at=timezone.now() - timedelta(hours=1))
+        self.assertIsNone(outbox.take(self.ac.id))
+        self.assertFalse(CommandOutbox.objects.exists())
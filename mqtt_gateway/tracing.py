@@ -0,0 +1,220 @@
+"""
+网关消息处理链路追踪：从收到传感器上报到发布联动命令（home/{id}/cmd）的端到端耗时。
+
+- 每条消息一个 Trace（trace_id + 各阶段 span：parse / lookup / validate / db / alert / scene / publish），
+  处理完成后放入进程内环形缓冲区（最近 N 条）
+- 场景联动发布命令时，trace_id 写入命令 payload 与 SCENE_RULE 日志的 data，
+  并记录 trigger_to_command（从收到上报到命令发布完成）
+- 网关与 API 不在同一进程：网关定期把缓冲区原子写入本地 JSON 文件，
+  管理员接口 /api/mqtt/traces/ 读取后计算各阶段 p50 / p95 / p99
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from typing import Optional
+
+from django.conf import settings
+
+from mqtt_gateway import metrics
+
+# 端到端阶段：收到上报到联动命令发布完成
+STAGE_TRIGGER_TO_COMMAND = "trigger_to_command"
+
+_local = threading.local()
+
+
+def _tracing_config() -> dict:
+    return getattr(settings, "MQTT_GATEWAY_TRACING", {})
+
+
+class Trace:
+    __slots__ = ("trace_id", "topic", "started_at", "_started", "spans")
+
+    def __init__(self, topic: str = ""):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.topic = topic
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        # [(阶段, 耗时秒)]，同一阶段可出现多次（例如多次发布）
+        self.spans: list[tuple[str, float]] = []
+
+    def add_span(self, stage: str, seconds: float) -> None:
+        self.spans.append((stage, seconds))
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._started
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "topic": self.topic,
+            "started_at": self.started_at,
+            "total": self.elapsed(),
+            "spans": [[stage, seconds] for stage, seconds in self.spans],
+        }
+
+
+class TraceBuffer:
+    """线程安全的环形缓冲区，保存最近 maxlen 条已完成的 trace（字典形式）。"""
+
+    def __init__(self, maxlen: int = 5000):
+        self._items: deque = deque(maxlen=max(1, int(maxlen)))
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def add(self, item: dict) -> None:
+        with self._lock:
+            self._items.append(item)
+
+    def snapshot(self) -> list[dict]:
+        with self._lock:
+            return list(self._items)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+    def dump(self, path: str) -> None:
+        """原子写入 JSON 文件（先写临时文件再替换），避免读取端读到半截内容。"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fp:
+            json.dump({"written_at": time.time(), "traces": self.snapshot()}, fp)
+        os.replace(tmp_path, path)
+
+
+buffer = TraceBuffer(_tracing_config().get("BUFFER_SIZE", 5000))
+
+
+def enabled() -> bool:
+    return bool(_tracing_config().get("ENABLED", True))
+
+
+def current() -> Optional[Trace]:
+    """当前线程正在处理的消息的 trace；不在消息处理中时为 None。"""
+    return getattr(_local, "trace", None)
+
+
+@contextmanager
+def trace_message(topic: str):
+    """包裹一条消息的处理过程；追踪关闭时只产出 None。"""
+    if not enabled():
+        yield None
+        return
+    trace = Trace(topic)
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = None
+        buffer.add(trace.to_dict())
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    """记录一个阶段耗时：写入 Prometheus 直方图，并作为 span 记入当前 trace。"""
+    metrics.stage_seconds.observe(seconds, stage=stage)
+    trace = current()
+    if trace is not None:
+        trace.add_span(stage, seconds)
+
+
+@contextmanager
+def stage(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - started)
+
+
+def mark_command_published() -> Optional[str]:
+    """联动命令发布完成时调用：记录 trigger_to_command，返回当前 trace_id。"""
+    trace = current()
+    if trace is None:
+        return None
+    trace.add_span(STAGE_TRIGGER_TO_COMMAND, trace.elapsed())
+    return trace.trace_id
+
+
+def start_file_writer(path: str, interval_seconds: float = 10.0) -> threading.Event:
+    """后台线程定期把缓冲区写入文件；返回的 Event 置位后停止。"""
+    stop_event = threading.Event()
+
+    def _loop():
+        while not stop_event.wait(interval_seconds):
+            try:
+                buffer.dump(path)
+            except OSError:
+                pass
+
+    threading.Thread(target=_loop, name="gateway-trace-file", daemon=True).start()
+    return stop_event
+
+
+# ==== 统计 ====
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    """最近秩法百分位数；sorted_values 需已升序。"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(-(-q * len(sorted_values) // 100)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(traces: list[dict], slowest: int = 10) -> dict:
+    """按阶段汇总耗时（毫秒）：count / p50 / p95 / p99 / max，并列出端到端最慢的联动 trace。"""
+    by_stage: dict[str, list[float]] = {}
+    for item in traces:
+        by_stage.setdefault("total", []).append(item.get("total", 0.0))
+        for stage_name, seconds in item.get("spans", []):
+            by_stage.setdefault(stage_name, []).append(seconds)
+
+    stages = {}
+    for stage_name, values in sorted(by_stage.items()):
+        values.sort()
+        stages[stage_name] = {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 50) * 1000, 3),
+            "p95_ms": round(percentile(values, 95) * 1000, 3),
+            "p99_ms": round(percentile(values, 99) * 1000, 3),
+            "max_ms": round(values[-1] * 1000, 3),
+        }
+
+    def command_latency(item):
+        return max(
+            (seconds for stage_name, seconds in item.get("spans", []) if stage_name == STAGE_TRIGGER_TO_COMMAND),
+            default=None,
+        )
+
+    with_command = [item for item in traces if command_latency(item) is not None]
+    with_command.sort(key=command_latency, reverse=True)
+    return {
+        "trace_count": len(traces),
+        "stages": stages,
+        "slowest": with_command[:slowest],
+    }
+
+
+def load_traces() -> tuple[list[dict], str]:
+    """
+    读取 trace：本进程缓冲区非空时直接使用（网关进程 / 测试），否则读取网关写出的文件。
+    返回 (traces, 来源 "memory" | "file" | "none")。
+    """
+    traces = buffer.snapshot()
+    if traces:
+        return traces, "memory"
+    path = _tracing_config().get("FILE")
+    if not path:
+        return [], "none"
+    try:
+        with open(path, encoding="utf-8") as fp:
+            return json.load(fp).get("traces", []), "file"
+    except (OSError, ValueError):
+        return [], "none"
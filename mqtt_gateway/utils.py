@@ -2,7 +2,7 @@
 MQTT 工具：发布设备控制命令，供后端 API 调用。
 """
 
-import json
+import os
 import secrets
 import ssl
 import threading
@@ -12,8 +12,14 @@ from typing import Optional
 import paho.mqtt.client as mqtt
 from django.conf import settings
 
-_mqtt_client: Optional[mqtt.Client] = None
+from mqtt_gateway import acks
+from mqtt_gateway.codec import CODEC_JSON, CodecError, command_codec_name, decode_payload, encode_payload
+from mqtt_gateway.publisher import MqttPublisher, publisher_config
+
+_publisher: Optional[MqttPublisher] = None
 _client_lock = threading.Lock()
+# 网关进程自己订阅并处理 ack（含失败日志），其发布服务不能再消费同一确认
+_ack_listener_enabled = True
 
 # 项目根目录，用于解析 .env 中的相对证书路径
 _BASE_DIR = Path(settings.BASE_DIR) if hasattr(settings, "BASE_DIR") else Path(__file__).resolve().parent.parent
@@ -85,40 +91,126 @@ def _apply_tls(client: mqtt.Client, config: dict) -> None:
         client.tls_insecure_set(True)
 
 
-def get_mqtt_client() -> mqtt.Client:
-    """获取全局 MQTT 客户端单例。"""
-    global _mqtt_client
-    if _mqtt_client is None:
-        with _client_lock:
-            if _mqtt_client is None:
-                config = settings.MQTT_CONFIG
-                client_id = build_mqtt_client_id(config, role="api")
-                _mqtt_client = mqtt.Client(client_id=client_id)
-                if config.get("USERNAME"):
-                    _mqtt_client.username_pw_set(
-                        config["USERNAME"], config.get("PASSWORD", "")
-                    )
-                _apply_tls(_mqtt_client, config)
-                try:
-                    _mqtt_client.connect(
-                        config["HOST"], config["PORT"], config.get("KEEPALIVE", 60)
-                    )
-                    _mqtt_client.loop_start()
-                except Exception as e:
-                    print(f"MQTT 连接失败: {e}")
-    return _mqtt_client
-
-
-def publish_device_command(device_id: int, payload: dict) -> None:
-    """向主题 home/{device_id}/cmd 发布控制命令。"""
+def _subscribe_acks(client: mqtt.Client) -> None:
+    """连接（含重连）成功后订阅命令确认主题，用于唤醒等待确认的 API 请求。"""
+    topic_prefix = settings.MQTT_CONFIG.get("TOPIC_PREFIX", "home")
+    client.subscribe(f"{topic_prefix}/+/ack", qos=1)
+
+
+def _on_ack_message(client, userdata, msg):
+    handle_ack_payload(msg.payload)
+
+
+def disable_ack_listener() -> None:
+    """网关启动时调用：本进程的发布服务只发布，不订阅 home/+/ack。"""
+    global _ack_listener_enabled
+    with _client_lock:
+        _ack_listener_enabled = False
+        if _publisher is not None:
+            _publisher.client.on_message = None
+            _publisher._on_connected = None
+
+
+def handle_ack_payload(raw) -> None:
+    """解析 home/{id}/ack：{"cmd_id": "...", "ok": true, "error": "...", "via": "ack" | "state"}。"""
+    try:
+        payload = decode_payload(raw, CODEC_JSON)
+    except CodecError:
+        return
+    if isinstance(payload, dict) and payload.get("cmd_id"):
+        acks.tracker.ack(
+            str(payload["cmd_id"]),
+            ok=payload.get("ok", True) is not False,
+            error=payload.get("error"),
+            via=payload.get("via") or "ack",
+        )
+
+
+def publish_command_ack(device_id: int, cmd_id: str, ok: bool = True, via: str = "state") -> None:
+    """网关通过状态回显确认命令后，代设备发布 ack（始终为 JSON）。"""
+    topic_prefix = settings.MQTT_CONFIG.get("TOPIC_PREFIX", "home")
+    message = encode_payload({"cmd_id": cmd_id, "ok": ok, "via": via}, CODEC_JSON)
+    try:
+        get_mqtt_client().publish(f"{topic_prefix}/{device_id}/ack", message, qos=1)
+    except Exception as e:
+        print(f"发布命令确认时出错: {e}")
+
+
+def _build_client() -> mqtt.Client:
+    config = settings.MQTT_CONFIG
+    client = mqtt.Client(client_id=build_mqtt_client_id(config, role="api"))
+    if config.get("USERNAME"):
+        client.username_pw_set(config["USERNAME"], config.get("PASSWORD", ""))
+    _apply_tls(client, config)
+    return client
+
+
+def get_publisher() -> MqttPublisher:
+    """获取本进程的 MQTT 发布服务（首次调用或 fork 后创建并以非阻塞方式启动）。"""
+    global _publisher
+    publisher = _publisher
+    if publisher is not None and publisher.pid == os.getpid():
+        return publisher
+    with _client_lock:
+        if _publisher is None or _publisher.pid != os.getpid():
+            config = settings.MQTT_CONFIG
+            options = publisher_config()
+            ack_enabled = acks.enabled() and _ack_listener_enabled
+            publisher = MqttPublisher(
+                _build_client,
+                buffer_size=options.get("BUFFER_SIZE", 1000),
+                reconnect_min=options.get("RECONNECT_MIN_SECONDS", 1),
+                reconnect_max=options.get("RECONNECT_MAX_SECONDS", 60),
+                on_connected=_subscribe_acks if ack_enabled else None,
+                on_message=_on_ack_message if ack_enabled else None,
+            )
+            try:
+                publisher.start(config["HOST"], config["PORT"], config.get("KEEPALIVE", 60))
+            except Exception as e:
+                print(f"MQTT 发布服务启动失败: {e}")
+            _publisher = publisher
+        return _publisher
+
+
+def get_mqtt_client() -> MqttPublisher:
+    """
+    兼容旧调用：返回本进程的发布服务，提供 publish() / is_connected()。
+    publish() 不会在请求线程中等待 broker；未连接时命令进入有界缓冲区，重连后补发。
+    """
+    return get_publisher()
+
+
+def publish_device_command(
+    device_id: int, payload: dict, codec_name: Optional[str] = None, trace_id: Optional[str] = None
+) -> Optional[acks.PendingCommand]:
+    """
+    向主题 home/{device_id}/cmd 发布控制命令。
+    使用非 JSON 编解码器（MQTT_GATEWAY_CODECS['COMMAND'] 或 codec_name）时发布到 home/{device_id}/cmd/{codec}。
+    trace_id 不为空时随命令下发（payload 中的 trace_id 字段），用于关联触发该命令的上报。
+    启用命令确认（MQTT_COMMAND_ACK）时 payload 带 cmd_id，返回待确认记录，可调用其 wait() 等待设备确认。
+    """
+    command = None
     try:
+        if trace_id:
+            payload = {**payload, "trace_id": trace_id}
+        if acks.enabled():
+            command = acks.tracker.register(device_id, payload)
+            payload = {**payload, "cmd_id": command.cmd_id}
         config = settings.MQTT_CONFIG
         topic_prefix = config.get("TOPIC_PREFIX", "home")
+        codec_name = (codec_name or command_codec_name()).lower()
         topic = f"{topic_prefix}/{device_id}/cmd"
+        if codec_name != CODEC_JSON:
+            topic = f"{topic}/{codec_name}"
         client = get_mqtt_client()
-        message = json.dumps(payload)
+        message = encode_payload(payload, codec_name)
         result = client.publish(topic, message, qos=1)
         if result.rc != mqtt.MQTT_ERR_SUCCESS:
             print(f"MQTT 发布失败: topic={topic}, rc={result.rc}")
+            if command is not None:
+                acks.tracker.ack(command.cmd_id, ok=False, error=f"publish rc={result.rc}", via="publish")
     except Exception as e:
         print(f"发布 MQTT 命令时出错: {e}")
+        if command is not None:
+            acks.tracker.ack(command.cmd_id, ok=False, error=str(e), via="publish")
+    return command
@@ -18,10 +18,13 @@ from rest_framework.response import Response
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
 
+from accounts.permissions import IsAdminUserRole
 from devices.models import Device
-from devices.serializers import DeviceSerializer
+from devices.serializers import render_devices_json
+from devices.visibility import visible_devices
 from logs_app.models import SystemLog
-from mqtt_gateway.utils import get_mqtt_client
+from mqtt_gateway import tracing
+from mqtt_gateway.utils import get_mqtt_client, get_publisher
 
 STREAM_TOKEN_SALT = "mqtt_gateway.realtime_stream"
 STREAM_TOKEN_CACHE_PREFIX = "mqtt_gateway:stream_token:used:"
@@ -31,10 +34,13 @@ STREAM_TOKEN_TTL_SECONDS = max(int(getattr(settings, "REALTIME_STREAM_TOKEN_TTL_
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def mqtt_status(request):
-    """GET /api/mqtt/status/ 返回 MQTT 连接状态（已登录用户均可调用，用于横幅提示）。"""
+    """
+    GET /api/mqtt/status/ 返回 MQTT 连接状态（已登录用户均可调用，用于横幅提示），
+    以及本进程发布服务的待确认 / 缓冲中 / 已丢弃的消息数。
+    """
     try:
-        client = get_mqtt_client()
-        return Response({"connected": client.is_connected()})
+        stats = get_publisher().stats()
+        return Response({"connected": stats.pop("connected"), "publisher": stats})
     except Exception as e:
         return Response(
             {"connected": False, "error": str(e)},
@@ -42,6 +48,20 @@ def mqtt_status(request):
         )
 
 
+@api_view(["GET"])
+@permission_classes([IsAuthenticated & IsAdminUserRole])
+def gateway_traces(request):
+    """
+    GET /api/mqtt/traces/ 网关最近处理消息的各阶段耗时分位数（毫秒，仅管理员）。
+    数据来自网关定期写出的追踪文件（MQTT_GATEWAY_TRACING['FILE']）；
+    slowest 为「上报 → 联动命令发布」最慢的若干条 trace，可按 trace_id 在场景日志中检索。
+    """
+    traces, source = tracing.load_traces()
+    summary = tracing.summarize(traces)
+    summary["source"] = source
+    return Response(summary)
+
+
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def realtime_stream_token(request):
@@ -129,17 +149,11 @@ def _authenticate_stream_user(request):
 
 
 def _visible_devices_qs(user):
-    qs = Device.objects.all().order_by("id")
-    if user.is_staff or user.is_superuser:
-        return qs
-    return (qs.filter(owner=user) | qs.filter(is_public=True)).distinct().order_by("id")
+    return visible_devices(user, Device.objects.order_by("id"))
 
 
 def _visible_logs_qs(user):
-    qs = SystemLog.objects.all()
-    if user.is_staff or user.is_superuser:
-        return qs
-    return (qs.filter(user__isnull=True) | qs.filter(user=user)).distinct()
+    return SystemLog.objects.visible_to(user)
 
 
 def _mqtt_connected() -> bool:
@@ -150,7 +164,11 @@ def _mqtt_connected() -> bool:
 
 
 def _sse(event: str, data) -> str:
-    payload = json.dumps(data, ensure_ascii=False, default=str)
+    return _sse_raw(event, json.dumps(data, ensure_ascii=False, default=str))
+
+
+def _sse_raw(event: str, payload: str) -> str:
+    """payload 为已序列化的 JSON 文本（如拼接好的设备列表）。"""
     return f"event: {event}\ndata: {payload}\n\n"
 
 
@@ -171,15 +189,10 @@ def realtime_stream(request):
         last_mqtt = _mqtt_connected()
         device_signature = None
 
-        init_devices_qs = _visible_devices_qs(user)
-        init_devices = DeviceSerializer(init_devices_qs, many=True).data
-        yield _sse(
+        init_devices = render_devices_json(_visible_devices_qs(user)).decode()
+        yield _sse_raw(
             "init",
-            {
-                "last_log_id": last_log_id,
-                "mqtt_connected": last_mqtt,
-                "devices": init_devices,
-            },
+            f'{{"last_log_id": {last_log_id}, "mqtt_connected": {json.dumps(last_mqtt)}, "devices": {init_devices}}}',
         )
 
         try:
@@ -216,7 +229,8 @@ def realtime_stream(request):
                 signature = f"{agg.get('count', 0)}|{max_updated.isoformat() if max_updated else ''}"
                 if signature != device_signature:
                     device_signature = signature
-                    yield _sse("devices", {"items": DeviceSerializer(devices_qs, many=True).data})
+                    items = render_devices_json(devices_qs).decode()
+                    yield _sse_raw("devices", f'{{"items": {items}}}')
 
                 # SSE 保活注释行，避免中间层超时断开
                 yield ": ping\n\n"
@@ -0,0 +1,381 @@
+"""
+规则回测：用历史数据（DeviceData）重放规则，统计「如果当时已启用，会在何时触发、共触发多少次」。
+
+判定语义与网关一致：
+  - 阈值 / 区间规则：与 _threshold_match 相同（含边沿触发的布防与回差），计入防抖时间
+  - TIME_STATE 规则：与 SceneScheduler 相同，在每日窗口打开时、以及窗口内状态设备相关字段变化时评估，
+    状态取评估时刻之前状态设备最近一次上报的值
+  - COMPOSITE 规则：相关设备的历史按时间合并后送入同一个增量匹配器
+  - 邮件告警规则：与 send_email_alerts_for_value 相同，每条满足阈值的上报触发一次（邮件规则没有防抖）
+
+阈值 / 邮件规则的历史数据按 (timestamp, id) 键集分页读取（每页 PAGE_ROWS 行，内存只保留数值数组），
+每页用 NumPy 整列转换：时间转为 datetime64、按值的类型向量化筛出数值，不做逐行 Python 处理；
+阈值比较在整段序列上向量化计算，防抖 / 布防只在候选触发点之间用二分查找跳转，循环次数等于触发次数。
+单次回测读取的行数以 SCENE_BACKTEST["MAX_SAMPLES"] 为上限（默认覆盖 30 天 1 Hz），超出时抛出
+BacktestTooLarge（接口返回 400，提示缩小 range）。判定部分的耗时可用 manage.py bench_backtest 测量。
+"""
+
+import bisect
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from devices.constants import DeviceType
+from devices.energy import RANGE_TO_DELTA
+from devices.models import DeviceData
+from mqtt_gateway.scheduler import window_open
+from .conditions import IncrementalMatcher, state_value_matches, validate_conditions
+from .models import SceneRule
+
+# 返回的触发时间点上限，触发次数仍为完整统计
+MAX_FIRE_TIMESTAMPS = 1000
+
+# 键集分页读取历史数据时每页的行数
+PAGE_ROWS = 50000
+
+# 网关对邮件告警规则检查的数值字段（见 _evaluate_alerts）
+EMAIL_NUMERIC_FIELDS = ("temp", "humi", "light", "pressure")
+
+
+def parse_range(range_value, now=None):
+    """?range= 参数（6h / 24h / 3d / 7d / 30d，默认 7d）转换为 (start, end)；不支持的取值抛出 ValueError。"""
+    delta = RANGE_TO_DELTA.get(range_value or "7d")
+    if delta is None:
+        raise ValueError(f"range 仅支持 {' / '.join(RANGE_TO_DELTA)}")
+    now = now or timezone.now()
+    return now - delta, now
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class BacktestTooLarge(ValueError):
+    """回测区间内的历史数据超过 MAX_SAMPLES 行。"""
+
+
+def _max_samples() -> int:
+    return getattr(settings, "SCENE_BACKTEST", {}).get("MAX_SAMPLES", 3000000)
+
+
+def _too_large(limit: int) -> BacktestTooLarge:
+    return BacktestTooLarge(f"回测区间内的数据超过 {limit} 条，请缩小 range")
+
+
+def _capped_rows(qs) -> list:
+    """最多读取 MAX_SAMPLES 行，超出时抛出 BacktestTooLarge，而不是把整段历史读进内存。"""
+    limit = _max_samples()
+    rows = list(qs[: limit + 1])
+    if len(rows) > limit:
+        raise _too_large(limit)
+    return rows
+
+
+def _object_column(column, n: int):
+    return np.fromiter(column, dtype=object, count=n)
+
+
+def _numeric_mask(column):
+    """值为 int / float（不含 bool）的位置；map(type) 与数组比较都在 C 中完成。"""
+    types = np.fromiter(map(type, column), dtype=object, count=len(column))
+    return (types == int) | (types == float)
+
+
+def _truthy(column):
+    return np.fromiter(map(bool, column), dtype=bool, count=len(column))
+
+
+def _read_pages(qs, fields: tuple[str, ...], convert):
+    """
+    按 (timestamp, id) 键集分页读取 values_list(timestamp, id, *fields)，
+    convert(columns) 把一页的字段列（对象数组）转为 (保留的掩码, 数值数组)；返回 (datetime64 数组, 数值数组, 读取行数)。
+    """
+    limit = _max_samples()
+    stamps, values = [], []
+    total = 0
+    last = None
+    while True:
+        page = qs
+        if last is not None:
+            page = page.filter(Q(timestamp__gt=last[0]) | Q(timestamp=last[0], id__gt=last[1]))
+        rows = list(page.order_by("timestamp", "id").values_list("timestamp", "id", *fields)[:PAGE_ROWS])
+        if not rows:
+            break
+        total += len(rows)
+        if total > limit:
+            raise _too_large(limit)
+        last = rows[-1][:2]
+        columns = [_object_column(column, len(rows)) for column in zip(*rows)]
+        keep, page_values = convert(columns[2:])
+        stamps.append(_datetime64(columns[0])[keep])
+        values.append(page_values)
+        if len(rows) < PAGE_ROWS:
+            break
+    if not stamps:
+        return np.empty(0, dtype="datetime64[us]"), np.empty(0, dtype=float), 0
+    return np.concatenate(stamps), np.concatenate(values), total
+
+
+def _datetime64(column):
+    """datetime 对象数组转为 datetime64[us]；带时区时先统一到 UTC（USE_TZ=True 时）。"""
+    if len(column) and column[0].tzinfo is not None:
+        column = _object_column((ts.astimezone(dt_timezone.utc).replace(tzinfo=None) for ts in column), len(column))
+    return column.astype("datetime64[us]")
+
+
+def _to_datetimes(stamps, tzinfo=None) -> list:
+    result = stamps.astype("datetime64[us]").astype(object).tolist()
+    if tzinfo is not None:
+        result = [ts.replace(tzinfo=dt_timezone.utc).astimezone(tzinfo) for ts in result]
+    return result
+
+
+def _numeric_convert(columns):
+    column = columns[0]
+    keep = _numeric_mask(column)
+    return keep, column[keep].astype(float)
+
+
+def _smoke_convert(columns):
+    # 与 schema.normalize_state 相同：smoke / alarm / value 任一为真即为告警
+    alarm = _truthy(columns[0]) | _truthy(columns[1]) | _truthy(columns[2])
+    return np.ones(len(alarm), dtype=bool), alarm.astype(float)
+
+
+def _field_series(device_id: int, field: str, start, end):
+    """设备在 [start, end] 内某字段的数值序列：(datetime64 数组, 数值数组)；非数值的上报被跳过。"""
+    qs = DeviceData.objects.filter(device_id=device_id, timestamp__gte=start, timestamp__lte=end, data__has_key=field)
+    stamps, values, _ = _read_pages(qs, (f"data__{field}",), _numeric_convert)
+    return stamps, values
+
+
+def _smoke_series(device_id: int, start, end):
+    """烟雾设备的告警序列（1.0 / 0.0），字段合并规则与 schema.normalize_state 相同。"""
+    qs = DeviceData.objects.filter(device_id=device_id, timestamp__gte=start, timestamp__lte=end).filter(
+        Q(data__has_key="smoke") | Q(data__has_key="alarm") | Q(data__has_key="value")
+    )
+    stamps, values, _ = _read_pages(qs, ("data__smoke", "data__alarm", "data__value"), _smoke_convert)
+    return stamps, values
+
+
+def _threshold_masks(rule: SceneRule, values):
+    """与网关 _threshold_match 等价的向量化版本，返回 (是否满足触发条件, 是否可重新布防) 两个布尔数组。"""
+    hysteresis = max(0.0, float(rule.hysteresis or 0.0))
+    trigger_value = rule.trigger_value
+    v = np.asarray(values, dtype=float)
+    if rule.trigger_type == SceneRule.TRIGGER_RANGE_OUT:
+        if not isinstance(trigger_value, dict):
+            return np.zeros(len(v), dtype=bool), np.zeros(len(v), dtype=bool)
+        low = float(trigger_value.get("min", 0))
+        high = float(trigger_value.get("max", 0))
+        return (v < low) | (v > high), (v >= low + hysteresis) & (v <= high - hysteresis)
+
+    threshold = float(trigger_value) if _is_number(trigger_value) else float(trigger_value.get("value", 0))
+    if rule.trigger_type == SceneRule.TRIGGER_THRESHOLD_ABOVE:
+        return v > threshold, v <= threshold - hysteresis
+    return v < threshold, v >= threshold + hysteresis
+
+
+def select_fires(times, triggered, rearm=None, debounce_seconds: float = 0.0):
+    """
+    从满足条件的点中选出实际触发的下标数组（times 为升序的 epoch 秒数组）：
+    与上次触发间隔不足 debounce_seconds 的点被防抖跳过；rearm 不为空时为边沿触发，
+    触发后需出现一个可重新布防的点，其后的点才可能再次触发。
+    每次跳转都是二分查找，循环次数等于触发次数；无防抖的电平触发直接返回全部候选点。
+    """
+    candidates = np.flatnonzero(triggered)
+    if rearm is None and debounce_seconds <= 0:
+        return candidates
+    candidate_times = times[candidates]
+    rearm_points = np.flatnonzero(rearm) if rearm is not None else None
+    fires = []
+    position = 0
+    last = None
+    while True:
+        k = int(np.searchsorted(candidates, position))
+        if last is not None:
+            k = max(k, int(np.searchsorted(candidate_times, last + debounce_seconds)))
+        if k >= len(candidates):
+            break
+        index = int(candidates[k])
+        fires.append(index)
+        last = times[index]
+        if rearm_points is None:
+            position = index + 1
+            continue
+        r = int(np.searchsorted(rearm_points, index, side="right"))
+        if r >= len(rearm_points):
+            break
+        # 网关在重新布防的那条上报上不会同时触发
+        position = int(rearm_points[r]) + 1
+    return np.asarray(fires, dtype=np.int64)
+
+
+def _result(start, end, samples: int, fire_times: list, fire_count: int = None) -> dict:
+    fire_count = len(fire_times) if fire_count is None else fire_count
+    return {
+        "start": start,
+        "end": end,
+        "samples": samples,
+        "fire_count": fire_count,
+        "fires": fire_times[:MAX_FIRE_TIMESTAMPS],
+        "truncated": fire_count > MAX_FIRE_TIMESTAMPS,
+    }
+
+
+def _series_result(start, end, stamps, fires) -> dict:
+    """数组形式的触发下标转换为结果；只把前 MAX_FIRE_TIMESTAMPS 个时间点转回 datetime。"""
+    tzinfo = start.tzinfo if timezone.is_aware(start) else None
+    fire_times = _to_datetimes(stamps[fires[:MAX_FIRE_TIMESTAMPS]], tzinfo)
+    return _result(start, end, len(stamps), fire_times, fire_count=len(fires))
+
+
+def _epoch(stamps):
+    """datetime64 数组转为 epoch 秒（只用于比较间隔）。"""
+    return stamps.astype("datetime64[us]").astype(np.int64) / 1e6
+
+
+def _backtest_threshold(rule: SceneRule, start, end) -> dict:
+    stamps, values = _field_series(rule.trigger_device_id, rule.trigger_field, start, end)
+    triggered, rearm = _threshold_masks(rule, values)
+    fires = select_fires(
+        _epoch(stamps),
+        triggered,
+        rearm if rule.trigger_mode == SceneRule.MODE_EDGE else None,
+        rule.debounce_seconds,
+    )
+    return _series_result(start, end, stamps, fires)
+
+
+def _state_history(device_id: int, key: str, start, end) -> tuple[list, list]:
+    """状态设备某字段在 start 之前的最后一个值与区间内的全部上报。"""
+    base = DeviceData.objects.filter(device_id=device_id, data__has_key=key)
+    before = base.filter(timestamp__lt=start).order_by("-timestamp", "-id").values_list("timestamp", f"data__{key}")[:1]
+    rows = list(before) + _capped_rows(
+        base.filter(timestamp__gte=start, timestamp__lte=end)
+        .order_by("timestamp", "id")
+        .values_list("timestamp", f"data__{key}")
+    )
+    return [ts for ts, _ in rows], [value for _, value in rows]
+
+
+def _backtest_time_state(rule: SceneRule, start, end) -> dict:
+    if not rule.trigger_time_start or not rule.trigger_time_end:
+        return _result(start, end, 0, [])
+
+    # 评估时刻：每日窗口打开，以及窗口内状态设备相关字段变化
+    points = set()
+    day = start.date()
+    while day <= end.date():
+        opened = datetime.combine(day, rule.trigger_time_start)
+        if timezone.is_aware(start):
+            opened = timezone.make_aware(opened, start.tzinfo)
+        if start <= opened <= end:
+            points.add(opened)
+        day += timedelta(days=1)
+
+    histories = {}
+    state_value = rule.trigger_state_value if isinstance(rule.trigger_state_value, dict) else {}
+    if rule.trigger_state_device_id and state_value:
+        for key in state_value:
+            stamps, values = _state_history(rule.trigger_state_device_id, key, start, end)
+            histories[key] = (stamps, values)
+            for i in range(len(stamps)):
+                if stamps[i] >= start and (i == 0 or values[i] != values[i - 1]):
+                    points.add(stamps[i])
+
+    fire_times = []
+    last = None
+    for point in sorted(points):
+        if not window_open(rule.trigger_time_start, rule.trigger_time_end, point.time()):
+            continue
+        matched = True
+        for key, (stamps, values) in histories.items():
+            i = bisect.bisect_right(stamps, point) - 1
+            if not state_value_matches(key, values[i] if i >= 0 else None, state_value[key]):
+                matched = False
+                break
+        if not matched:
+            continue
+        if last is not None and (point - last).total_seconds() < rule.debounce_seconds:
+            continue
+        fire_times.append(point)
+        last = point
+    return _result(start, end, len(points), fire_times)
+
+
+def _backtest_composite(rule: SceneRule, start, end) -> dict:
+    try:
+        leaves = validate_conditions(rule.conditions)
+    except ValueError:
+        return _result(start, end, 0, [])
+    matcher = IncrementalMatcher()
+    matcher.add_rule(rule.id, rule.conditions)
+    device_ids = {device_id for device_id, _ in leaves}
+
+    # 区间开始前各设备的最后一次上报作为初始状态
+    for device_id in device_ids:
+        previous = (
+            DeviceData.objects.filter(device_id=device_id, timestamp__lt=start)
+            .order_by("-timestamp", "-id")
+            .values_list("data", flat=True)
+            .first()
+        )
+        if isinstance(previous, dict):
+            matcher.update(device_id, previous)
+
+    rows = _capped_rows(
+        DeviceData.objects.filter(device_id__in=device_ids, timestamp__gte=start, timestamp__lte=end)
+        .order_by("timestamp", "id")
+        .values_list("device_id", "timestamp", "data")
+    )
+    samples = 0
+    fire_times = []
+    last = None
+    for device_id, ts, data in rows:
+        if not isinstance(data, dict):
+            continue
+        samples += 1
+        for _, matched, rising in matcher.update(device_id, data):
+            if not matched or (rule.trigger_mode == SceneRule.MODE_EDGE and not rising):
+                continue
+            if last is not None and (ts - last).total_seconds() < rule.debounce_seconds:
+                continue
+            fire_times.append(ts)
+            last = ts
+    return _result(start, end, samples, fire_times)
+
+
+def backtest_scene_rule(rule: SceneRule, start, end) -> dict:
+    """
+    在 [start, end] 内重放场景规则，返回 {samples, fire_count, fires, truncated, start, end}；
+    数据超过 MAX_SAMPLES 行时抛出 BacktestTooLarge。
+    """
+    if rule.trigger_type == SceneRule.TRIGGER_TIME_STATE:
+        return _backtest_time_state(rule, start, end)
+    if rule.trigger_type == SceneRule.TRIGGER_COMPOSITE:
+        return _backtest_composite(rule, start, end)
+    return _backtest_threshold(rule, start, end)
+
+
+def backtest_email_rule(rule, start, end) -> dict:
+    """在 [start, end] 内重放邮件告警规则（logs_app.EmailAlertRule）。"""
+    field = rule.trigger_field
+    threshold = rule.trigger_value
+    if field == "smoke":
+        if rule.trigger_device.type != DeviceType.SMOKE:
+            return _result(start, end, 0, [])
+        threshold = 1.0 if threshold is None else threshold
+    elif field not in EMAIL_NUMERIC_FIELDS or threshold is None:
+        return _result(start, end, 0, [])
+
+    if field == "smoke":
+        stamps, values = _smoke_series(rule.trigger_device_id, start, end)
+    else:
+        stamps, values = _field_series(rule.trigger_device_id, field, start, end)
+    threshold = float(threshold)
+    triggered = values >= threshold if rule.trigger_above else values <= threshold
+    return _series_result(start, end, stamps, np.flatnonzero(triggered))
@@ -0,0 +1,265 @@
+"""
+组合条件（COMPOSITE）场景规则：跨多个设备的 AND / OR 条件树，以及网关使用的增量匹配器。
+
+条件树格式（SceneRule.conditions）：
+  {"op": "AND", "children": [
+      {"device": 3, "field": "temp", "cmp": ">", "value": 28},
+      {"device": 5, "field": "motion", "cmp": "==", "value": true},
+      {"op": "OR", "children": [...]}
+  ]}
+
+增量匹配（Rete 风格）：
+  - 叶子条件按 (设备 ID, 字段) 建立 alpha 索引，缓存每个叶子的当前真值
+  - AND / OR 节点缓存「为真的子节点数」，叶子真值变化时只沿父链向上更新计数，
+    节点真值不变即停止传播
+  - 一条上报只评估依赖其字段的叶子，无需扫描全部规则与设备状态
+"""
+
+import operator
+import threading
+import time
+from typing import Any, Optional
+
+OP_AND = "AND"
+OP_OR = "OR"
+
+COMPARATORS = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+MAX_DEPTH = 4
+MAX_LEAVES = 16
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def compare(actual, cmp: str, expected) -> bool:
+    """叶子条件比较：数值按大小比较，布尔按真值比较；字段缺失视为不满足。"""
+    if actual is None:
+        return False
+    if isinstance(expected, bool):
+        if cmp not in ("==", "!="):
+            return False
+        return COMPARATORS[cmp](bool(actual), expected)
+    if _is_number(expected):
+        if not _is_number(actual):
+            return False
+        return COMPARATORS[cmp](float(actual), float(expected))
+    if cmp not in ("==", "!="):
+        return False
+    return COMPARATORS[cmp](actual, expected)
+
+
+def state_value_matches(key: str, actual, expected) -> bool:
+    """TIME_STATE 规则的状态条件：motion / pir 按真值比较，value 以大于 0 视为「已触发」，其余字段按值相等比较。"""
+    if key in ("motion", "pir"):
+        return bool(actual) == bool(expected)
+    if key == "value":
+        detected = actual is not None and (
+            actual is True or (isinstance(actual, (int, float)) and float(actual) > 0)
+        )
+        return detected == bool(expected)
+    return actual == expected
+
+
+def validate_conditions(tree: Any, depth: int = 1) -> list[tuple[int, str]]:
+    """校验条件树结构，返回全部叶子的 (设备 ID, 字段)；不合法时抛出 ValueError（中文说明）。"""
+    if not isinstance(tree, dict):
+        raise ValueError("条件节点必须是对象")
+    if depth > MAX_DEPTH:
+        raise ValueError(f"条件嵌套不能超过 {MAX_DEPTH} 层")
+    if "op" in tree:
+        op = str(tree.get("op", "")).upper()
+        children = tree.get("children")
+        if op not in (OP_AND, OP_OR):
+            raise ValueError("组合节点的 op 只能是 AND 或 OR")
+        if not isinstance(children, list) or not children:
+            raise ValueError("组合节点需要非空的 children 列表")
+        leaves = []
+        for child in children:
+            leaves.extend(validate_conditions(child, depth + 1))
+        if depth == 1 and len(leaves) > MAX_LEAVES:
+            raise ValueError(f"叶子条件不能超过 {MAX_LEAVES} 个")
+        return leaves
+
+    device_id = tree.get("device")
+    field = tree.get("field")
+    cmp = tree.get("cmp", "==")
+    if not isinstance(device_id, int) or isinstance(device_id, bool) or device_id <= 0:
+        raise ValueError("叶子条件需要有效的 device（设备 ID）")
+    if not isinstance(field, str) or not field:
+        raise ValueError("叶子条件需要 field（字段名）")
+    if cmp not in COMPARATORS:
+        raise ValueError(f"不支持的比较符: {cmp}")
+    if "value" not in tree:
+        raise ValueError("叶子条件需要 value")
+    value = tree["value"]
+    if cmp not in ("==", "!=") and not _is_number(value):
+        raise ValueError(f"比较符 {cmp} 需要数值 value")
+    return [(device_id, field)]
+
+
+class _Node:
+    __slots__ = ("parent", "rule_id", "op", "size", "true_count", "value", "leaf")
+
+    def __init__(self, parent, rule_id, op=None, leaf=None):
+        self.parent = parent
+        self.rule_id = rule_id
+        self.op = op
+        self.size = 0
+        self.true_count = 0
+        self.value = False
+        # 叶子：(字段, 比较符, 期望值)
+        self.leaf = leaf
+
+    def evaluate_inner(self) -> bool:
+        if self.op == OP_AND:
+            return self.true_count == self.size
+        return self.true_count > 0
+
+
+class IncrementalMatcher:
+    """
+    纯内存的增量匹配器。
+    add_rule() 编译条件树；update(device_id, state) 返回 [(rule_id, 根节点当前真值, 是否由假变真)]，
+    只包含本次上报涉及其叶子的规则。
+    """
+
+    def __init__(self):
+        # (device_id, field) -> [叶子节点]
+        self._alpha: dict[tuple[int, str], list[_Node]] = {}
+        self._roots: dict[int, _Node] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._roots)
+
+    def device_ids(self) -> set[int]:
+        return {device_id for device_id, _ in self._alpha}
+
+    def add_rule(self, rule_id: int, tree: dict) -> None:
+        root = self._compile(tree, None, rule_id)
+        with self._lock:
+            self._roots[rule_id] = root
+
+    def _compile(self, tree: dict, parent: Optional[_Node], rule_id: int) -> _Node:
+        if "op" in tree:
+            node = _Node(parent, rule_id, op=str(tree["op"]).upper())
+            for child in tree["children"]:
+                self._compile(child, node, rule_id)
+                node.size += 1
+            node.value = node.evaluate_inner()
+            return node
+        node = _Node(parent, rule_id, leaf=(tree["field"], tree.get("cmp", "=="), tree["value"]))
+        self._alpha.setdefault((tree["device"], tree["field"]), []).append(node)
+        return node
+
+    def is_true(self, rule_id: int) -> bool:
+        root = self._roots.get(rule_id)
+        return bool(root and root.value)
+
+    def update(self, device_id: int, state: dict) -> list[tuple[int, bool, bool]]:
+        touched: dict[int, bool] = {}
+        with self._lock:
+            for field, actual in state.items():
+                leaves = self._alpha.get((device_id, field))
+                if not leaves:
+                    continue
+                for leaf in leaves:
+                    root = self._roots.get(leaf.rule_id)
+                    if root is None:
+                        continue
+                    was_true = touched.get(leaf.rule_id, root.value)
+                    touched.setdefault(leaf.rule_id, was_true)
+                    _, cmp, expected = leaf.leaf
+                    self._set(leaf, compare(actual, cmp, expected))
+            return [
+                (rule_id, self._roots[rule_id].value, self._roots[rule_id].value and not was_true)
+                for rule_id, was_true in touched.items()
+            ]
+
+    @staticmethod
+    def _set(node: _Node, value: bool) -> None:
+        """更新节点真值并沿父链增量传播；父节点真值不变时停止。"""
+        while node is not None:
+            if node.value == value:
+                return
+            node.value = value
+            parent = node.parent
+            if parent is None:
+                return
+            parent.true_count += 1 if value else -1
+            node, value = parent, parent.evaluate_inner()
+
+
+class CompositeRuleMatcher:
+    """
+    网关使用的组合条件匹配器：首次使用时从数据库加载启用的 COMPOSITE 规则，
+    用相关设备的 current_state 初始化叶子真值；规则指纹 (数量, ID 之和, 最近更新时间) 变化时重新加载。
+    """
+
+    def __init__(self, reload_seconds: float = 30.0):
+        self.reload_seconds = float(reload_seconds)
+        self._matcher: Optional[IncrementalMatcher] = None
+        self._fingerprint = None
+        self._checked_at = 0.0
+        self._load_lock = threading.Lock()
+
+    def _current_fingerprint(self):
+        from django.db.models import Count, Max, Sum
+
+        from scenes.models import SceneRule
+
+        agg = SceneRule.objects.filter(
+            enabled=True, trigger_type=SceneRule.TRIGGER_COMPOSITE
+        ).aggregate(count=Count("id"), ids=Sum("id"), updated=Max("updated_at"))
+        # ID 之和：数量不变时，启用 / 禁用互换的两条规则也会改变指纹
+        return agg["count"], agg["ids"], agg["updated"]
+
+    def load(self) -> IncrementalMatcher:
+        from devices.models import Device
+        from scenes.models import SceneRule
+
+        matcher = IncrementalMatcher()
+        rows = SceneRule.objects.filter(
+            enabled=True, trigger_type=SceneRule.TRIGGER_COMPOSITE
+        ).values_list("id", "conditions")
+        for rule_id, tree in rows:
+            try:
+                validate_conditions(tree)
+            except ValueError:
+                continue
+            matcher.add_rule(rule_id, tree)
+        device_ids = matcher.device_ids()
+        if device_ids:
+            for device_id, state in Device.objects.filter(pk__in=device_ids).values_list("id", "current_state"):
+                if isinstance(state, dict):
+                    matcher.update(device_id, state)
+        self._fingerprint = self._current_fingerprint()
+        self._matcher = matcher
+        return matcher
+
+    def _ensure_loaded(self) -> IncrementalMatcher:
+        now = time.monotonic()
+        if self._matcher is not None and now - self._checked_at < self.reload_seconds:
+            return self._matcher
+        with self._load_lock:
+            if self._matcher is not None and now - self._checked_at < self.reload_seconds:
+                return self._matcher
+            self._checked_at = now
+            if self._matcher is None or self._current_fingerprint() != self._fingerprint:
+                self.load()
+        return self._matcher
+
+    def on_reading(self, device_id: int, state: dict) -> list[tuple[int, bool, bool]]:
+        """设备上报或状态变化后调用，返回受影响规则的 (rule_id, 当前是否满足, 是否刚由不满足变为满足)。"""
+        if not isinstance(state, dict):
+            return []
+        return self._ensure_loaded().update(device_id, state)
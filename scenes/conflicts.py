@@ -0,0 +1,58 @@
+"""
+场景规则冲突检测的区间索引。
+
+两条规则只有在触发设备、执行设备都相同，且触发区间（数值阈值或每日时间窗口）重叠时才可能冲突。
+ConflictIndex 按 (触发设备, 执行设备, 触发字段 / 时间窗口) 分桶，桶内按区间左端点排序后扫描，
+用按右端点排序的最小堆维护仍可能与后续区间重叠的区间，O(n log n + k) 求出全部候选重叠对（k 为重叠对数）。
+候选对再交给 SceneRuleSerializer 做状态条件与动作的精确判断。
+"""
+
+import heapq
+from typing import Hashable, Iterable, Iterator
+
+Interval = tuple[float, float]
+
+
+def overlapping_pairs(items: Iterable[tuple[float, float, Hashable]]) -> Iterator[tuple[Hashable, Hashable]]:
+    """
+    items 为 (low, high, key) 开区间，按扫描顺序产出重叠的 (key_a, key_b)。
+    重叠判定与 max(low) < min(high) 一致；同一对 key 可能因多段区间被产出多次，由调用方去重。
+    """
+    ordered = sorted(
+        ((low, high, seq, key) for seq, (low, high, key) in enumerate(items) if low < high),
+        key=lambda item: (item[0], item[2]),
+    )
+    active: list[tuple[float, int, Hashable]] = []
+    for low, high, seq, key in ordered:
+        # 右端点不超过当前左端点的区间不会再与任何后续区间重叠
+        while active and active[0][0] <= low:
+            heapq.heappop(active)
+        for _, _, other in active:
+            if other != key:
+                yield other, key
+        heapq.heappush(active, (high, seq, key))
+
+
+class ConflictIndex:
+    """按桶组织的区间索引：add() 登记规则的区间，pairs() 返回去重后的候选重叠对。"""
+
+    def __init__(self):
+        self._buckets: dict[Hashable, list[tuple[float, float, Hashable]]] = {}
+
+    def add(self, key: Hashable, bucket: Hashable, intervals: Iterable[Interval]) -> None:
+        entries = self._buckets.setdefault(bucket, [])
+        for low, high in intervals:
+            entries.append((float(low), float(high), key))
+
+    def pairs(self) -> list[tuple[Hashable, Hashable]]:
+        seen = set()
+        result = []
+        for entries in self._buckets.values():
+            if len(entries) < 2:
+                continue
+            for first, second in overlapping_pairs(entries):
+                marker = frozenset((first, second))
+                if marker not in seen:
+                    seen.add(marker)
+                    result.append((first, second))
+        return result
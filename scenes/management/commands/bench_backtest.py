@@ -0,0 +1,109 @@
+"""
+规则回测基准：30 天 1 Hz（2,592,000 点）的阈值规则判定耗时，以及经数据库读取的端到端耗时。
+用法：
+    python3 manage.py bench_backtest                       # 判定：电平 / 电平+防抖 / 边沿+回差
+    python3 manage.py bench_backtest --db-rows 200000      # 另外在事务中写入临时数据，测量读取 + 判定，测完回滚
+判定部分只依赖内存中的数组；端到端耗时主要在数据库读取与 JSON 解码，随行数线性增长。
+"""
+
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from devices.constants import DeviceType
+from devices.models import Device, DeviceData
+from scenes.backtest import _epoch, _threshold_masks, backtest_scene_rule, select_fires
+from scenes.models import SceneRule
+
+MONTH_1HZ = 30 * 86400
+
+
+class _Rollback(Exception):
+    pass
+
+
+def _temperature(n: int, rng) -> np.ndarray:
+    # 日周期 + 随机噪声，约一半时间高于 28 ℃
+    t = np.arange(n, dtype=float)
+    return 28 + 4 * np.sin(t * 2 * np.pi / 86400) + rng.normal(0, 0.5, n)
+
+
+class Command(BaseCommand):
+    help = "规则回测基准：30 天 1 Hz 数据的判定耗时与数据库端到端耗时"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--points", type=int, default=MONTH_1HZ, help="判定基准的点数（默认 30 天 1 Hz）")
+        parser.add_argument("--repeat", type=int, default=3, help="重复次数，取最优（默认 3）")
+        parser.add_argument("--db-rows", type=int, default=0, help="端到端基准写入的临时数据行数（默认不测）")
+        parser.add_argument("--seed", type=int, default=42)
+
+    def handle(self, *args, **options):
+        if options["points"] <= 0 or options["db_rows"] < 0:
+            raise CommandError("--points 必须为正整数，--db-rows 不能为负")
+        repeat = max(1, options["repeat"])
+        rng = np.random.default_rng(options["seed"])
+        n = options["points"]
+        start = datetime(2026, 1, 1)
+        stamps = np.datetime64(start, "us") + np.arange(n) * np.timedelta64(1, "s")
+        values = _temperature(n, rng)
+
+        cases = [
+            ("电平", dict(trigger_mode=SceneRule.MODE_LEVEL, debounce_seconds=0, hysteresis=0)),
+            ("电平+防抖 60s", dict(trigger_mode=SceneRule.MODE_LEVEL, debounce_seconds=60, hysteresis=0)),
+            ("边沿+回差 1.0", dict(trigger_mode=SceneRule.MODE_EDGE, debounce_seconds=0, hysteresis=1.0)),
+        ]
+        self.stdout.write(f"判定 {n} 点：")
+        for label, fields in cases:
+            rule = SceneRule(
+                trigger_type=SceneRule.TRIGGER_THRESHOLD_ABOVE, trigger_field="temp", trigger_value=28, **fields
+            )
+
+            def run():
+                triggered, rearm = _threshold_masks(rule, values)
+                return select_fires(
+                    _epoch(stamps), triggered, rearm if rule.trigger_mode == SceneRule.MODE_EDGE else None,
+                    rule.debounce_seconds,
+                )
+
+            fires = run()
+            self.stdout.write(f"  {label:<16} {self._best_ms(run, repeat):>9.1f} ms  触发 {len(fires)} 次")
+
+        if options["db_rows"]:
+            self._bench_db(options["db_rows"], start, rng, repeat)
+
+    def _bench_db(self, rows: int, start, rng, repeat: int) -> None:
+        values = _temperature(rows, rng)
+        try:
+            with transaction.atomic():
+                owner = get_user_model().objects.create_user(username="bench-backtest", password="bench-backtest")
+                sensor = Device.objects.create(name="bench-sensor", type=DeviceType.TEMPERATURE_HUMIDITY, owner=owner)
+                DeviceData.objects.bulk_create(
+                    (
+                        DeviceData(device=sensor, timestamp=start + timedelta(seconds=i), data={"temp": float(v)})
+                        for i, v in enumerate(values)
+                    ),
+                    batch_size=5000,
+                )
+                rule = SceneRule(
+                    owner=owner, trigger_type=SceneRule.TRIGGER_THRESHOLD_ABOVE, trigger_device=sensor,
+                    trigger_field="temp", trigger_value=28, debounce_seconds=60,
+                )
+                end = start + timedelta(seconds=rows)
+                ms = self._best_ms(lambda: backtest_scene_rule(rule, start, end), repeat)
+                self.stdout.write(f"数据库端到端 {rows} 行：{ms:.1f} ms（{ms * 1000 / rows:.2f} µs/行）")
+                raise _Rollback
+        except _Rollback:
+            pass
+
+    @staticmethod
+    def _best_ms(func, repeat: int) -> float:
+        best = float("inf")
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            best = min(best, time.perf_counter() - started)
+        return best * 1000
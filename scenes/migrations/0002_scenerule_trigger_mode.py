@@ -0,0 +1,23 @@
+# Generated by Django 5.2.11 on 2026-10-20 03:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scenes', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scenerule',
+            name='hysteresis',
+            field=models.FloatField(default=0.0, verbose_name='回差'),
+        ),
+        migrations.AddField(
+            model_name='scenerule',
+            name='trigger_mode',
+            field=models.CharField(choices=[('LEVEL', '持续触发'), ('EDGE', '越限触发一次')], default='LEVEL', max_length=16, verbose_name='触发模式'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.11 on 2026-10-20 03:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scenes', '0002_scenerule_trigger_mode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scenerule',
+            name='conditions',
+            field=models.JSONField(blank=True, null=True, verbose_name='组合条件'),
+        ),
+        migrations.AlterField(
+            model_name='scenerule',
+            name='trigger_type',
+            field=models.CharField(choices=[('THRESHOLD_ABOVE', '高于阈值'), ('THRESHOLD_BELOW', '低于阈值'), ('RANGE_OUT', '超出范围'), ('TIME_STATE', '时间+状态组合'), ('COMPOSITE', '组合条件')], max_length=32, verbose_name='触发类型'),
+        ),
+    ]
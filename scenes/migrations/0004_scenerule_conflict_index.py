@@ -0,0 +1,20 @@
+# Generated by Django 5.2.11 on 2026-10-20 03:44
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('devices', '0002_device_is_public'),
+        ('scenes', '0003_scenerule_conditions'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='scenerule',
+            index=models.Index(fields=['trigger_device', 'action_device'], name='scene_trigger_action_idx'),
+        ),
+    ]
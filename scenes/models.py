@@ -14,12 +14,14 @@ class SceneRule(models.Model):
     TRIGGER_THRESHOLD_BELOW = "THRESHOLD_BELOW"  # 阈值下限触发：值 < 阈值
     TRIGGER_RANGE_OUT = "RANGE_OUT"  # 区间外触发：值不在 [min, max] 范围内
     TRIGGER_TIME_STATE = "TIME_STATE"  # 时间+状态组合触发
+    TRIGGER_COMPOSITE = "COMPOSITE"  # 多设备 AND / OR 组合条件
 
     TRIGGER_CHOICES = (
         (TRIGGER_THRESHOLD_ABOVE, "高于阈值"),
         (TRIGGER_THRESHOLD_BELOW, "低于阈值"),
         (TRIGGER_RANGE_OUT, "超出范围"),
         (TRIGGER_TIME_STATE, "时间+状态组合"),
+        (TRIGGER_COMPOSITE, "组合条件"),
     )
 
     # 动作类型
@@ -37,6 +39,15 @@ class SceneRule(models.Model):
         (ACTION_TURN_OFF, "关闭设备"),
     )
 
+    # 触发模式（阈值类规则）
+    MODE_LEVEL = "LEVEL"  # 电平触发：条件持续满足时，每过防抖时间重复执行
+    MODE_EDGE = "EDGE"  # 边沿触发：越过阈值时执行一次，离开条件（含回差）后才重新布防
+
+    MODE_CHOICES = (
+        (MODE_LEVEL, "持续触发"),
+        (MODE_EDGE, "越限触发一次"),
+    )
+
     name = models.CharField("规则名称", max_length=100)
     enabled = models.BooleanField("是否启用", default=True)
     owner = models.ForeignKey(
@@ -75,6 +86,8 @@ class SceneRule(models.Model):
     trigger_state_value = models.JSONField(
         "状态值", null=True, blank=True, help_text="例如：{\"on\": true}"
     )
+    # 组合条件（用于 COMPOSITE 类型）：AND / OR 条件树，格式见 scenes/conditions.py
+    conditions = models.JSONField("组合条件", null=True, blank=True)
 
     # 执行动作
     action_device = models.ForeignKey(
@@ -93,6 +106,11 @@ class SceneRule(models.Model):
 
     # 防抖：避免频繁触发（秒）
     debounce_seconds = models.IntegerField("防抖时间（秒）", default=60)
+    trigger_mode = models.CharField(
+        "触发模式", max_length=16, choices=MODE_CHOICES, default=MODE_LEVEL
+    )
+    # 回差：边沿触发时，数值需回到阈值另一侧超过该幅度才重新布防，避免在阈值附近抖动反复触发
+    hysteresis = models.FloatField("回差", default=0.0)
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -102,6 +120,10 @@ class SceneRule(models.Model):
         verbose_name = "场景规则"
         verbose_name_plural = "场景规则"
         ordering = ["-created_at"]
+        indexes = [
+            # 冲突检测只比较触发设备、执行设备都相同的规则
+            models.Index(fields=["trigger_device", "action_device"], name="scene_trigger_action_idx"),
+        ]
 
     def __str__(self):
         return f"{self.name} ({self.get_trigger_type_display()})"
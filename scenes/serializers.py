@@ -3,7 +3,10 @@ from typing import Any
 
 from rest_framework import serializers
 
+from devices.models import Device
 from devices.serializers import DeviceSerializer
+from .conditions import validate_conditions
+from .conflicts import ConflictIndex
 from .models import SceneRule
 
 
@@ -37,16 +40,25 @@ class SceneRuleSerializer(serializers.ModelSerializer):
             "trigger_state_device",
             "trigger_state_device_detail",
             "trigger_state_value",
+            "conditions",
             "action_device",
             "action_device_detail",
             "action_type",
             "action_value",
             "debounce_seconds",
+            "trigger_mode",
+            "hysteresis",
             "created_at",
             "updated_at",
             "last_triggered_at",
         ]
         read_only_fields = ["id", "owner", "created_at", "updated_at", "last_triggered_at"]
+        # 组合条件规则可以不传触发设备 / 字段 / 值，由 validate() 补全
+        extra_kwargs = {
+            "trigger_device": {"required": False},
+            "trigger_field": {"required": False, "allow_blank": True},
+            "trigger_value": {"required": False},
+        }
 
     @staticmethod
     def _obj_pk(value: Any) -> int | None:
@@ -225,6 +237,9 @@ class SceneRuleSerializer(serializers.ModelSerializer):
     def _trigger_overlap(self, candidate: dict[str, Any], existing: SceneRule) -> bool:
         if candidate["trigger_device_id"] != existing.trigger_device_id:
             return False
+        # 组合条件跨多个设备，不参与单设备的触发区间冲突检测
+        if SceneRule.TRIGGER_COMPOSITE in (candidate["trigger_type"], existing.trigger_type):
+            return False
 
         candidate_type = candidate["trigger_type"]
         existing_type = existing.trigger_type
@@ -334,54 +349,179 @@ class SceneRuleSerializer(serializers.ModelSerializer):
 
         return None
 
-    def _find_conflicts(self, candidate: dict[str, Any]) -> list[dict[str, Any]]:
-        queryset = SceneRule.objects.select_related("action_device", "trigger_device")
-        if self.instance is not None:
-            queryset = queryset.exclude(pk=self.instance.pk)
+    @classmethod
+    def _index_entry(cls, rule: SceneRule) -> tuple[tuple, list[tuple[float, float]]] | None:
+        """规则在冲突索引中的 (分桶键, 区间)；组合条件或区间无效的规则不参与冲突检测。"""
+        if rule.trigger_type == SceneRule.TRIGGER_COMPOSITE:
+            return None
+        if rule.trigger_type == SceneRule.TRIGGER_TIME_STATE:
+            intervals = [
+                (float(low), float(high))
+                for low, high in cls._build_time_windows(rule.trigger_time_start, rule.trigger_time_end)
+            ]
+            bucket = (rule.trigger_device_id, rule.action_device_id, "@time")
+        else:
+            intervals = cls._build_numeric_intervals(rule.trigger_type, rule.trigger_value)
+            bucket = (rule.trigger_device_id, rule.action_device_id, rule.trigger_field)
+        if not intervals:
+            return None
+        return bucket, intervals
 
-        conflicts: list[dict[str, Any]] = []
+    @staticmethod
+    def _candidate_rule(candidate: dict[str, Any]) -> SceneRule:
+        """用候选规则构造未保存的 SceneRule，便于与已有规则统一比较。"""
+        rule = SceneRule(
+            name=candidate.get("name") or "",
+            trigger_type=candidate["trigger_type"],
+            trigger_device_id=candidate["trigger_device_id"],
+            trigger_field=candidate["trigger_field"],
+            trigger_value=candidate["trigger_value"],
+            trigger_time_start=candidate["trigger_time_start"],
+            trigger_time_end=candidate["trigger_time_end"],
+            trigger_state_device_id=candidate["trigger_state_device_id"],
+            trigger_state_value=candidate["trigger_state_value"],
+            action_device_id=candidate["action_device_id"],
+            action_type=candidate["action_type"],
+            action_value=candidate["action_value"],
+        )
+        if isinstance(candidate.get("action_device"), Device):
+            rule.action_device = candidate["action_device"]
+        return rule
+
+    def _conflict_entry(self, candidate: dict[str, Any], existing: SceneRule) -> dict[str, Any] | None:
+        if not self._trigger_overlap(candidate, existing):
+            return None
+        action_conflict = self._action_conflict(candidate, existing)
+        if not action_conflict:
+            return None
+
+        conflict_field, reason = action_conflict
+        if conflict_field == "action_type":
+            conflict_field_label = "动作类型"
+        elif conflict_field == "action_value":
+            conflict_field_label = "动作值"
+        elif conflict_field == "trigger_value":
+            conflict_field_label = "触发条件"
+        else:
+            conflict_field_label = "规则项"
+        action_device_name = getattr(candidate["action_device"], "name", f"设备#{candidate['action_device_id']}")
+        if conflict_field == "trigger_value":
+            message = (
+                f"与规则「{existing.name}」冲突：{conflict_field_label}冲突（{reason}）。"
+                f"执行设备「{action_device_name}」的动作一致："
+                f"{self._action_desc(candidate['action_type'], candidate['action_value'])}。"
+            )
+        else:
+            message = (
+                f"与规则「{existing.name}」冲突：在相同触发条件下，执行设备「{action_device_name}」"
+                f"的{conflict_field_label}冲突（{reason}）。"
+                f"本规则动作：{self._action_desc(candidate['action_type'], candidate['action_value'])}；"
+                f"冲突规则动作：{self._action_desc(existing.action_type, existing.action_value)}。"
+            )
+        return {
+            "rule_id": existing.id,
+            "rule_name": existing.name,
+            "conflict_field": conflict_field,
+            "conflict_field_label": conflict_field_label,
+            "action_device_id": existing.action_device_id,
+            "action_device_name": existing.action_device.name,
+            "message": message,
+        }
+
+    def _collect_conflicts(
+        self, candidates: list[dict[str, Any]], exclude_ids: set[int]
+    ) -> list[tuple[int, int | None, dict[str, Any]]]:
+        """
+        候选规则之间、以及候选规则与数据库中已有规则之间的冲突，返回 [(候选序号, 冲突候选序号或 None, 冲突信息)]。
+        已有规则只查询触发设备、执行设备都相同的规则，再用区间索引找出触发区间重叠的候选对。
+        """
+        index = ConflictIndex()
+        rules: dict[tuple, SceneRule] = {}
+        pairs_wanted = set()
+        for i, candidate in enumerate(candidates):
+            rule = self._candidate_rule(candidate)
+            entry = self._index_entry(rule)
+            if entry is None:
+                continue
+            rules[("new", i)] = rule
+            index.add(("new", i), *entry)
+            pairs_wanted.add((rule.trigger_device_id, rule.action_device_id))
+
+        if not pairs_wanted:
+            return []
+        queryset = (
+            SceneRule.objects.filter(
+                trigger_device_id__in={t for t, _ in pairs_wanted},
+                action_device_id__in={a for _, a in pairs_wanted},
+            )
+            .exclude(trigger_type=SceneRule.TRIGGER_COMPOSITE)
+            .exclude(pk__in=exclude_ids)
+            .select_related("action_device")
+            .order_by("-created_at", "-id")
+        )
         for existing in queryset:
-            if not self._trigger_overlap(candidate, existing):
+            if (existing.trigger_device_id, existing.action_device_id) not in pairs_wanted:
                 continue
-            action_conflict = self._action_conflict(candidate, existing)
-            if not action_conflict:
+            entry = self._index_entry(existing)
+            if entry is not None:
+                rules[("db", existing.id)] = existing
+                index.add(("db", existing.id), *entry)
+
+        results = []
+        for first, second in index.pairs():
+            if first[0] == "db" and second[0] == "db":
                 continue
+            # 候选与候选冲突时，记在序号较大的一条上
+            if second[0] == "db" or (first[0] == "new" and first[1] > second[1]):
+                first, second = second, first
+            entry = self._conflict_entry(candidates[second[1]], rules[first])
+            if entry is not None:
+                results.append((second[1], first[1] if first[0] == "new" else None, entry))
+        # 同一候选的冲突：先列已有规则（按创建时间倒序，与规则列表一致），再列批内候选
+        db_order = {key[1]: pos for pos, key in enumerate(k for k in rules if k[0] == "db")}
+        results.sort(
+            key=lambda item: (item[0], 0, db_order[item[2]["rule_id"]])
+            if item[1] is None
+            else (item[0], 1, item[1])
+        )
+        return results
 
-            conflict_field, reason = action_conflict
-            if conflict_field == "action_type":
-                conflict_field_label = "动作类型"
-            elif conflict_field == "action_value":
-                conflict_field_label = "动作值"
-            elif conflict_field == "trigger_value":
-                conflict_field_label = "触发条件"
-            else:
-                conflict_field_label = "规则项"
-            action_device_name = getattr(candidate["action_device"], "name", f"设备#{candidate['action_device_id']}")
-            if conflict_field == "trigger_value":
-                message = (
-                    f"与规则「{existing.name}」冲突：{conflict_field_label}冲突（{reason}）。"
-                    f"执行设备「{action_device_name}」的动作一致："
-                    f"{self._action_desc(candidate['action_type'], candidate['action_value'])}。"
-                )
-            else:
-                message = (
-                    f"与规则「{existing.name}」冲突：在相同触发条件下，执行设备「{action_device_name}」"
-                    f"的{conflict_field_label}冲突（{reason}）。"
-                    f"本规则动作：{self._action_desc(candidate['action_type'], candidate['action_value'])}；"
-                    f"冲突规则动作：{self._action_desc(existing.action_type, existing.action_value)}。"
-                )
-            conflicts.append(
-                {
-                    "rule_id": existing.id,
-                    "rule_name": existing.name,
-                    "conflict_field": conflict_field,
-                    "conflict_field_label": conflict_field_label,
-                    "action_device_id": existing.action_device_id,
-                    "action_device_name": existing.action_device.name,
-                    "message": message,
-                }
+    def _find_conflicts(self, candidate: dict[str, Any]) -> list[dict[str, Any]]:
+        exclude_ids = {self.instance.pk} if self.instance is not None else set()
+        return [entry for _, _, entry in self._collect_conflicts([candidate], exclude_ids)]
+
+    @classmethod
+    def validate_many(
+        cls, candidates: list[dict[str, Any]], exclude_ids: set[int] | None = None
+    ) -> list[dict[str, Any]]:
+        """
+        批量冲突检测：candidates 为各序列化器校验后的 conflict_candidate。
+        返回冲突列表，每项在单条检测结果的基础上增加 index（候选序号）与 other_index（与之冲突的候选序号，
+        与已有规则冲突时为 None，此时 rule_id 为已有规则 ID）。
+        """
+        serializer = cls()
+        return [
+            {**entry, "index": index, "other_index": other_index}
+            for index, other_index, entry in serializer._collect_conflicts(candidates, exclude_ids or set())
+        ]
+
+    def _validate_composite(self, attrs: dict[str, Any], trigger_device: Any) -> Any:
+        """校验组合条件树与其中引用的设备；未指定触发设备时取第一个叶子条件的设备。"""
+        conditions = self._effective_value(attrs, "conditions")
+        try:
+            leaves = validate_conditions(conditions)
+        except ValueError as e:
+            raise serializers.ValidationError({"conditions": str(e)})
+        device_ids = {device_id for device_id, _ in leaves}
+        existing_ids = set(Device.objects.filter(pk__in=device_ids).values_list("id", flat=True))
+        missing = sorted(device_ids - existing_ids)
+        if missing:
+            raise serializers.ValidationError(
+                {"conditions": f"条件中引用的设备不存在：{', '.join(map(str, missing))}"}
             )
-        return conflicts
+        if not self._obj_pk(trigger_device):
+            trigger_device = attrs["trigger_device"] = Device.objects.get(pk=leaves[0][0])
+        return trigger_device
 
     def validate(self, attrs):
         """验证规则逻辑的合理性。"""
@@ -397,6 +537,13 @@ class SceneRuleSerializer(serializers.ModelSerializer):
         action_type = self._effective_value(attrs, "action_type")
         action_value = self._effective_value(attrs, "action_value")
 
+        if trigger_type == SceneRule.TRIGGER_COMPOSITE:
+            trigger_device = self._validate_composite(attrs, trigger_device)
+            trigger_field = attrs["trigger_field"] = ""
+            trigger_value = attrs["trigger_value"] = {}
+        elif trigger_type == SceneRule.TRIGGER_TIME_STATE and trigger_value is None:
+            trigger_value = attrs["trigger_value"] = {}
+
         # 创建时传入的可能是 pk (int)，0 表示未选择
         tpk = self._obj_pk(trigger_device)
         if tpk is None or tpk == 0:
@@ -417,7 +564,18 @@ class SceneRuleSerializer(serializers.ModelSerializer):
             if threshold is None:
                 raise serializers.ValidationError({"trigger_value": "阈值触发类型需要 trigger_value 为数字。"})
 
-        if trigger_type == SceneRule.TRIGGER_TIME_STATE:
+        hysteresis = self._effective_value(attrs, "hysteresis", 0.0) or 0.0
+        if hysteresis < 0:
+            raise serializers.ValidationError({"hysteresis": "回差不能为负数。"})
+        if (
+            trigger_type == SceneRule.TRIGGER_RANGE_OUT
+            and hysteresis * 2 >= float(trigger_value["max"]) - float(trigger_value["min"])
+        ):
+            raise serializers.ValidationError({"hysteresis": "回差过大：区间两侧回差之和需小于区间宽度。"})
+
+        if trigger_type == SceneRule.TRIGGER_COMPOSITE:
+            pass
+        elif trigger_type == SceneRule.TRIGGER_TIME_STATE:
             if not trigger_time_start or not trigger_time_end:
                 raise serializers.ValidationError(
                     {"trigger_time_start": "时间+状态组合触发需要设置开始和结束时间"}
@@ -426,6 +584,7 @@ class SceneRuleSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError({"trigger_field": "请选择触发字段。"})
 
         candidate = {
+            "name": self._effective_value(attrs, "name"),
             "trigger_type": trigger_type,
             "trigger_device": trigger_device,
             "trigger_device_id": tpk,
@@ -442,6 +601,11 @@ class SceneRuleSerializer(serializers.ModelSerializer):
             "action_value": action_value,
         }
 
+        # 批量导入时跳过逐条检测，由调用方收集 conflict_candidate 后统一调用 validate_many()
+        self.conflict_candidate = candidate
+        if self.context.get("skip_conflicts"):
+            return attrs
+
         conflicts = self._find_conflicts(candidate)
         if conflicts:
             raise serializers.ValidationError(
@@ -1,8 +1,18 @@
+import json
+from datetime import timedelta
+from unittest.mock import patch
+
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
 
 from devices.constants import DeviceType
-from devices.models import Device
+from devices.models import Device, DeviceData
+from logs_app.models import EmailAlertRule
+from scenes.backtest import backtest_email_rule, backtest_scene_rule
+from scenes.conditions import IncrementalMatcher, validate_conditions
+from scenes.conflicts import overlapping_pairs
 from scenes.models import SceneRule
 from scenes.serializers import SceneRuleSerializer
 
@@ -122,3 +132,306 @@ class SceneRuleConflictValidationTests(TestCase):
         message = str(serializer.errors["non_field_errors"][0])
         self.assertIn(existing.name, message)
         self.assertIn("重复规则", message)
+
+    def test_hysteresis_must_fit_inside_range(self):
+        serializer = SceneRuleSerializer(
+            data={
+                "name": "温度超出舒适区间",
+                "trigger_type": SceneRule.TRIGGER_RANGE_OUT,
+                "trigger_device": self.trigger_device.id,
+                "trigger_field": "temp",
+                "trigger_value": {"min": 20, "max": 25},
+                "action_device": self.action_device.id,
+                "action_type": SceneRule.ACTION_TURN_ON,
+                "action_value": None,
+                "trigger_mode": SceneRule.MODE_EDGE,
+                "hysteresis": 3,
+            }
+        )
+
+        self.assertFalse(serializer.is_valid())
+        self.assertIn("hysteresis", serializer.errors)
+
+
+class CompositeConditionTests(TestCase):
+    def test_or_inside_and_propagates_incrementally(self):
+        matcher = IncrementalMatcher()
+        matcher.add_rule(1, {
+            "op": "AND",
+            "children": [
+                {"device": 1, "field": "temp", "cmp": ">=", "value": 28},
+                {"op": "OR", "children": [
+                    {"device": 2, "field": "motion", "cmp": "==", "value": True},
+                    {"device": 3, "field": "on", "cmp": "==", "value": True},
+                ]},
+            ],
+        })
+        self.assertEqual(matcher.update(1, {"temp": 28}), [(1, False, False)])
+        self.assertEqual(matcher.update(3, {"on": True}), [(1, True, True)])
+        # OR 的另一分支变化不改变结果
+        self.assertEqual(matcher.update(2, {"motion": True}), [(1, True, False)])
+        self.assertEqual(matcher.update(3, {"on": False}), [(1, True, False)])
+        self.assertEqual(matcher.update(1, {"temp": "bad"}), [(1, False, False)])
+        self.assertEqual(matcher.update(4, {"temp": 40}), [])
+
+    def test_validate_conditions_rejects_malformed_trees(self):
+        for tree in (
+            None,
+            {"op": "XOR", "children": [{"device": 1, "field": "temp", "value": 1}]},
+            {"op": "AND", "children": []},
+            {"device": 1, "field": "temp", "cmp": ">", "value": "hot"},
+            {"device": 0, "field": "temp", "value": 1},
+        ):
+            with self.assertRaises(ValueError):
+                validate_conditions(tree)
+
+
+class CompositeRuleSerializerTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="composite_api", password="pwd_123456")
+        self.sensor = Device.objects.create(name="温湿度", type=DeviceType.TEMPERATURE_HUMIDITY, owner=self.user)
+        self.lamp = Device.objects.create(name="台灯", type=DeviceType.LAMP_SWITCH, owner=self.user)
+
+    def test_trigger_device_defaults_to_first_leaf(self):
+        serializer = SceneRuleSerializer(
+            data={
+                "name": "潮湿开灯",
+                "trigger_type": SceneRule.TRIGGER_COMPOSITE,
+                "conditions": {"op": "OR", "children": [
+                    {"device": self.sensor.id, "field": "humi", "cmp": ">", "value": 80},
+                ]},
+                "action_device": self.lamp.id,
+                "action_type": SceneRule.ACTION_TURN_ON,
+            }
+        )
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        rule = serializer.save(owner=self.user)
+        self.assertEqual(rule.trigger_device_id, self.sensor.id)
+        self.assertEqual(rule.trigger_field, "")
+
+    def test_unknown_condition_device_rejected(self):
+        serializer = SceneRuleSerializer(
+            data={
+                "name": "无效条件",
+                "trigger_type": SceneRule.TRIGGER_COMPOSITE,
+                "conditions": {"device": 9999, "field": "temp", "cmp": ">", "value": 1},
+                "action_device": self.lamp.id,
+                "action_type": SceneRule.ACTION_TURN_ON,
+            }
+        )
+        self.assertFalse(serializer.is_valid())
+        self.assertIn("conditions", serializer.errors)
+
+
+class ConflictIndexTests(TestCase):
+    def test_overlapping_pairs_matches_brute_force(self):
+        import random
+
+        rng = random.Random(7)
+        items = []
+        for key in range(200):
+            low = rng.uniform(0, 100)
+            items.append((low, low + rng.uniform(0.1, 10), key))
+        expected = {
+            frozenset((a[2], b[2]))
+            for i, a in enumerate(items)
+            for b in items[i + 1:]
+            if max(a[0], b[0]) < min(a[1], b[1])
+        }
+        self.assertEqual({frozenset(pair) for pair in overlapping_pairs(items)}, expected)
+
+    def test_touching_and_infinite_intervals(self):
+        inf = float("inf")
+        pairs = {frozenset(p) for p in overlapping_pairs([(30, inf, "a"), (-inf, 30, "b"), (25, inf, "c")])}
+        self.assertEqual(pairs, {frozenset(("a", "c")), frozenset(("b", "c"))})
+
+
+class SceneRuleValidateManyTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="bulk_conflicts", password="pwd_123456")
+        self.sensor = Device.objects.create(name="温湿度", type=DeviceType.TEMPERATURE_HUMIDITY, owner=self.user)
+        self.ac = Device.objects.create(name="空调", type=DeviceType.AC_SWITCH, owner=self.user)
+        self.lamp = Device.objects.create(name="台灯", type=DeviceType.LAMP_SWITCH, owner=self.user)
+        self.existing = SceneRule.objects.create(
+            name="已有规则", owner=self.user, trigger_type=SceneRule.TRIGGER_THRESHOLD_ABOVE,
+            trigger_device=self.sensor, trigger_field="temp", trigger_value=30,
+            action_device=self.ac, action_type=SceneRule.ACTION_TURN_ON,
+        )
+
+    def _candidate(self, name, value, action_device, action_type):
+        serializer = SceneRuleSerializer(
+            data={
+                "name": name,
+                "trigger_type": SceneRule.TRIGGER_THRESHOLD_ABOVE,
+                "trigger_device": self.sensor.id,
+                "trigger_field": "temp",
+                "trigger_value": value,
+                "action_device": action_device.id,
+                "action_type": action_type,
+            },
+            context={"skip_conflicts": True},
+        )
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        return serializer.conflict_candidate
+
+    def test_reports_batch_and_existing_conflicts(self):
+        candidates = [
+            self._candidate("关空调", 35, self.ac, SceneRule.ACTION_TURN_OFF),
+            self._candidate("开灯", 20, self.lamp, SceneRule.ACTION_TURN_ON),
+            self._candidate("关灯", 25, self.lamp, SceneRule.ACTION_TURN_OFF),
+        ]
+        with self.assertNumQueries(1):
+            conflicts = SceneRuleSerializer.validate_many(candidates)
+        summary = [(c["index"], c["other_index"], c["rule_id"]) for c in conflicts]
+        self.assertEqual(summary, [(0, None, self.existing.id), (2, 1, None)])
+
+
+class SceneRuleBulkApiTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="bulk_api", password="pwd_123456")
+        self.sensor = Device.objects.create(name="温湿度", type=DeviceType.TEMPERATURE_HUMIDITY, owner=self.user)
+        self.lamp = Device.objects.create(name="台灯", type=DeviceType.LAMP_SWITCH, owner=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def _rule(self, name, value, action_type):
+        return {
+            "name": name,
+            "trigger_type": SceneRule.TRIGGER_THRESHOLD_BELOW,
+            "trigger_device": self.sensor.id,
+            "trigger_field": "light",
+            "trigger_value": value,
+            "action_device": self.lamp.id,
+            "action_type": action_type,
+        }
+
+    @staticmethod
+    def _lines(response):
+        return [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+
+    def test_ndjson_import_reports_per_item_results(self):
+        body = "\n".join(
+            json.dumps(item)
+            for item in (
+                self._rule("暗了开灯", 100, SceneRule.ACTION_TURN_ON),
+                {"name": "缺少字段"},
+                self._rule("暗了关灯", 50, SceneRule.ACTION_TURN_OFF),
+            )
+        )
+        response = self.client.post("/api/scenes/bulk/", body, content_type="application/x-ndjson")
+        self.assertEqual(response.status_code, 201)
+        lines = self._lines(response)
+        self.assertEqual([line.get("status") for line in lines[:3]], ["created", "invalid", "invalid"])
+        self.assertEqual(lines[2]["errors"]["conflicts"][0]["other_index"], 0)
+        self.assertEqual(lines[3]["summary"], {"total": 3, "created": 1, "invalid": 2})
+        self.assertEqual(SceneRule.objects.filter(owner=self.user).count(), 1)
+
+    def test_created_items_report_ids_without_bulk_returning(self):
+        from django.db import connection
+
+        payload = [self._rule("暗了开灯", 100, SceneRule.ACTION_TURN_ON), self._rule("亮了关灯", 10, SceneRule.ACTION_TURN_OFF)]
+        payload[1]["trigger_type"] = SceneRule.TRIGGER_THRESHOLD_ABOVE
+        payload[1]["trigger_value"] = 800
+        # 模拟 MySQL：bulk_create 不回填主键
+        with patch.object(type(connection.features), "can_return_rows_from_bulk_insert", False):
+            lines = self._lines(self.client.post("/api/scenes/bulk/", payload, format="json"))
+
+        ids = [line["id"] for line in lines[:2]]
+        self.assertNotIn(None, ids)
+        self.assertEqual(SceneRule.objects.get(pk=ids[0]).name, "暗了开灯")
+        self.assertEqual(SceneRule.objects.get(pk=ids[1]).name, "亮了关灯")
+
+    def test_atomic_import_creates_nothing_on_error_and_export_round_trips(self):
+        payload = [self._rule("暗了开灯", 100, SceneRule.ACTION_TURN_ON), {"name": "缺少字段"}]
+        response = self.client.post("/api/scenes/bulk/?atomic=true", payload, format="json")
+        self.assertEqual(self._lines(response)[0]["status"], "skipped")
+        self.assertFalse(SceneRule.objects.exists())
+
+        self.client.post("/api/scenes/bulk/", payload[:1], format="json")
+        exported = self._lines(self.client.get("/api/scenes/bulk/"))
+        self.assertEqual(len(exported), 1)
+        self.assertEqual(exported[0]["trigger_device"], self.sensor.id)
+        self.assertEqual(exported[0]["trigger_value"], 100)
+
+
+class RuleBacktestTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="backtest_user", password="pwd_123456")
+        self.sensor = Device.objects.create(name="温湿度", type=DeviceType.TEMPERATURE_HUMIDITY, owner=self.user)
+        self.ac = Device.objects.create(name="空调", type=DeviceType.AC_SWITCH, owner=self.user)
+        self.now = timezone.now().replace(microsecond=0)
+        self.start = self.now - timedelta(hours=1)
+        # 每 10 秒一个温度点
+        temps = [25, 29, 30, 27.5, 29, 26.5, 29, 31, 25]
+        DeviceData.objects.bulk_create(
+            DeviceData(device=self.sensor, timestamp=self.start + timedelta(seconds=10 * (i + 1)), data={"temp": t})
+            for i, t in enumerate(temps)
+        )
+
+    def _rule(self, **kwargs):
+        defaults = dict(
+            name="高温开空调", owner=self.user, trigger_type=SceneRule.TRIGGER_THRESHOLD_ABOVE,
+            trigger_device=self.sensor, trigger_field="temp", trigger_value=28,
+            action_device=self.ac, action_type=SceneRule.ACTION_TURN_ON, debounce_seconds=0,
+        )
+        defaults.update(kwargs)
+        return SceneRule.objects.create(**defaults)
+
+    def test_level_mode_with_debounce(self):
+        result = backtest_scene_rule(self._rule(debounce_seconds=25), self.start, self.now)
+        self.assertEqual(result["samples"], 9)
+        # 满足条件的点：20s 30s 50s 70s 80s；防抖 25s 后剩 20s 50s 80s
+        self.assertEqual(
+            result["fires"], [self.start + timedelta(seconds=s) for s in (20, 50, 80)]
+        )
+
+    def test_edge_mode_rearms_after_hysteresis(self):
+        rule = self._rule(trigger_mode=SceneRule.MODE_EDGE, hysteresis=1.0)
+        result = backtest_scene_rule(rule, self.start, self.now)
+        # 27.5 未越过回差，26.5 重新布防
+        self.assertEqual(result["fire_count"], 2)
+        self.assertEqual(result["fires"][1], self.start + timedelta(seconds=70))
+
+    def test_email_rule_backtest_and_api(self):
+        rule = EmailAlertRule.objects.create(
+            name="低温提醒", trigger_device=self.sensor, trigger_field="temp",
+            trigger_value=26, trigger_above=False, recipients=["a@example.com"],
+        )
+        self.assertEqual(backtest_email_rule(rule, self.start, self.now)["fire_count"], 2)
+
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.get(f"/api/scenes/{self._rule().id}/backtest/?range=24h")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["fire_count"], 5)
+        response = client.get(f"/api/scenes/{self._rule(trigger_field='humi').id}/backtest/?range=1y")
+        self.assertEqual(response.status_code, 400)
+
+    def test_smoke_backtest_merges_alarm_and_value(self):
+        smoke = Device.objects.create(name="烟雾", type=DeviceType.SMOKE, owner=self.user)
+        payloads = [{"smoke": False}, {"alarm": 1}, {"value": True}, {"smoke": False, "alarm": 0}, {"smoke": True}]
+        DeviceData.objects.bulk_create(
+            DeviceData(device=smoke, timestamp=self.start + timedelta(seconds=10 * (i + 1)), data=data)
+            for i, data in enumerate(payloads)
+        )
+        rule = EmailAlertRule.objects.create(
+            name="烟雾告警", trigger_device=smoke, trigger_field="smoke", recipients=["a@example.com"],
+        )
+        result = backtest_email_rule(rule, self.start, self.now)
+        self.assertEqual(result["samples"], 5)
+        self.assertEqual(result["fires"], [self.start + timedelta(seconds=s) for s in (20, 30, 50)])
+
+    @override_settings(SCENE_BACKTEST={"MAX_SAMPLES": 5})
+    def test_too_many_samples_returns_400(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.get(f"/api/scenes/{self._rule().id}/backtest/?range=24h")
+        self.assertEqual(response.status_code, 400)
+
+    def test_paged_read_skips_non_numeric_values(self):
+        DeviceData.objects.create(device=self.sensor, timestamp=self.start + timedelta(seconds=95), data={"temp": "hot"})
+        DeviceData.objects.create(device=self.sensor, timestamp=self.start + timedelta(seconds=96), data={"temp": True})
+        with patch("scenes.backtest.PAGE_ROWS", 2):
+            result = backtest_scene_rule(self._rule(debounce_seconds=25), self.start, self.now)
+        self.assertEqual(result["samples"], 9)
+        self.assertEqual(result["fires"], [self.start + timedelta(seconds=s) for s in (20, 50, 80)])
@@ -1,14 +1,93 @@
+import json
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.db.models import Max
+from django.http import StreamingHttpResponse
 from django.utils import timezone
-from rest_framework import viewsets
+from rest_framework import status, viewsets
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 
 from accounts.permissions import IsAdminUserRole
 from devices.permissions import IsDeviceOwnerOrAdmin
+from .backtest import backtest_scene_rule, parse_range
 from .models import SceneRule
 from .serializers import SceneRuleSerializer
 
+# 批量导入 / 导出的字段（与单条创建接口的可写字段一致）
+BULK_FIELDS = (
+    "name",
+    "enabled",
+    "trigger_type",
+    "trigger_device",
+    "trigger_field",
+    "trigger_value",
+    "trigger_time_start",
+    "trigger_time_end",
+    "trigger_state_device",
+    "trigger_state_value",
+    "conditions",
+    "action_device",
+    "action_type",
+    "action_value",
+    "debounce_seconds",
+    "trigger_mode",
+    "hysteresis",
+)
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+
+def _ndjson_line(obj) -> str:
+    return json.dumps(obj, ensure_ascii=False, cls=DjangoJSONEncoder) + "\n"
+
+
+def _parse_bulk_body(request) -> list:
+    """解析批量导入请求体：JSON 数组，或 NDJSON（每行一个 JSON 对象）。格式错误时抛出 ValueError。"""
+    body = request.body.decode("utf-8")
+    if request.content_type == NDJSON_CONTENT_TYPE:
+        items = []
+        for line_no, line in enumerate(body.splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                raise ValueError(f"第 {line_no} 行不是合法的 JSON")
+        return items
+    try:
+        items = json.loads(body or "null")
+    except ValueError:
+        raise ValueError("请求体不是合法的 JSON")
+    if not isinstance(items, list):
+        raise ValueError("请求体必须是 JSON 数组或 NDJSON")
+    return items
+
+
+def _bulk_create_with_ids(owner, rules: list) -> None:
+    """
+    批量写入规则并回填主键。MySQL 的 bulk_create 不返回主键：先锁定 owner 行（串行化同一用户的并发导入），
+    记录写入前该用户规则的最大 ID，写入后在同一事务内按 ID 顺序取回新行（同一条多行 INSERT 的自增 ID 递增）。
+    须在事务内调用。
+    """
+    if connection.features.can_return_rows_from_bulk_insert:
+        SceneRule.objects.bulk_create(rules)
+        return
+    get_user_model().objects.select_for_update().filter(pk=owner.pk).exists()
+    max_before = SceneRule.objects.filter(owner=owner).aggregate(last=Max("id"))["last"] or 0
+    SceneRule.objects.bulk_create(rules)
+    new_ids = list(
+        SceneRule.objects.filter(owner=owner, id__gt=max_before).order_by("id").values_list("id", flat=True)
+    )
+    if len(new_ids) != len(rules):
+        raise RuntimeError("批量导入后取回的规则数量与写入数量不一致")
+    for rule, pk in zip(rules, new_ids):
+        rule.pk = pk
+        rule._state.adding = False
+
 
 class SceneRuleViewSet(viewsets.ModelViewSet):
     """
@@ -46,10 +125,111 @@ class SceneRuleViewSet(viewsets.ModelViewSet):
             if obj.owner_id != request.user.id:
                 self.permission_denied(request, message="您只能管理自己的场景规则")
 
+    @action(detail=False, methods=["post"], url_path="bulk")
+    def bulk_import(self, request):
+        """
+        批量导入：POST /api/scenes/bulk/，请求体为 JSON 数组或 NDJSON（Content-Type: application/x-ndjson）。
+        一次性完成全部校验（含批内规则之间的冲突），合法条目在同一事务内 bulk_create；
+        ?atomic=true 时任一条目不合法则全部不导入。
+        响应为 NDJSON 流：每个条目一行 {"index", "status": "created" | "invalid" | "skipped", ...}，最后一行为汇总。
+        """
+        try:
+            items = _parse_bulk_body(request)
+        except ValueError as e:
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        max_items = int(getattr(settings, "SCENE_BULK", {}).get("MAX_ITEMS", 1000))
+        if len(items) > max_items:
+            return Response(
+                {"detail": f"单次最多导入 {max_items} 条规则"}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        errors: dict[int, dict] = {}
+        valid: list[tuple[int, SceneRuleSerializer]] = []
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                errors[index] = {"non_field_errors": ["条目必须是 JSON 对象"]}
+                continue
+            data = {key: item[key] for key in BULK_FIELDS if key in item}
+            serializer = self.get_serializer(data=data, context={**self.get_serializer_context(), "skip_conflicts": True})
+            if serializer.is_valid():
+                valid.append((index, serializer))
+            else:
+                errors[index] = serializer.errors
+
+        # 合法条目之间、以及与已有规则之间的冲突一次性检测
+        conflicts = SceneRuleSerializer.validate_many([serializer.conflict_candidate for _, serializer in valid])
+        for conflict in conflicts:
+            index = valid[conflict["index"]][0]
+            entry = errors.setdefault(index, {"non_field_errors": [], "conflicts": []})
+            entry["non_field_errors"].append(conflict["message"])
+            if conflict["other_index"] is not None:
+                conflict["other_index"] = valid[conflict["other_index"]][0]
+            entry["conflicts"].append({k: v for k, v in conflict.items() if k != "index"})
+
+        atomic = str(request.query_params.get("atomic", "")).lower() in ("1", "true", "yes")
+        to_create = [] if atomic and errors else [
+            (index, SceneRule(owner=request.user, **serializer.validated_data))
+            for index, serializer in valid
+            if index not in errors
+        ]
+        if to_create:
+            with transaction.atomic():
+                _bulk_create_with_ids(request.user, [rule for _, rule in to_create])
+        created = dict(to_create)
+
+        def result_stream():
+            for index in range(len(items)):
+                if index in created:
+                    yield _ndjson_line({"index": index, "status": "created", "id": created[index].pk})
+                elif index in errors:
+                    yield _ndjson_line({"index": index, "status": "invalid", "errors": errors[index]})
+                else:
+                    yield _ndjson_line({"index": index, "status": "skipped"})
+            yield _ndjson_line(
+                {"summary": {"total": len(items), "created": len(created), "invalid": len(errors)}}
+            )
+
+        return StreamingHttpResponse(
+            result_stream(),
+            content_type=f"{NDJSON_CONTENT_TYPE}; charset=utf-8",
+            status=status.HTTP_201_CREATED if created else status.HTTP_200_OK,
+        )
+
+    @bulk_import.mapping.get
+    def bulk_export(self, request):
+        """批量导出：GET /api/scenes/bulk/，以 NDJSON 流式输出当前用户可见的规则，格式可直接用于批量导入。"""
+        rows = self.get_queryset().order_by("id").values("id", *(
+            f"{name}_id" if name in ("trigger_device", "trigger_state_device", "action_device") else name
+            for name in BULK_FIELDS
+        ))
+
+        def export_stream():
+            for row in rows.iterator(chunk_size=500):
+                for name in ("trigger_device", "trigger_state_device", "action_device"):
+                    row[name] = row.pop(f"{name}_id")
+                yield _ndjson_line(row)
+
+        response = StreamingHttpResponse(export_stream(), content_type=f"{NDJSON_CONTENT_TYPE}; charset=utf-8")
+        response["Content-Disposition"] = 'attachment; filename="scene_rules.ndjson"'
+        return response
+
+    @action(detail=True, methods=["get"])
+    def backtest(self, request, pk=None):
+        """回测：GET /api/scenes/{id}/backtest/?range=7d，用触发设备的历史数据统计规则会触发的次数与时间。"""
+        rule = self.get_object()
+        try:
+            start, end = parse_range(request.query_params.get("range"))
+            result = backtest_scene_rule(rule, start, end)
+        except ValueError as e:
+            # 包括 BacktestTooLarge：区间内数据过多
+            return Response({"detail": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({"rule_id": rule.id, "range": request.query_params.get("range") or "7d", **result})
+
     @action(detail=True, methods=["post"])
     def toggle_enabled(self, request, pk=None):
         """切换规则的启用/禁用状态。"""
         rule = self.get_object()
         rule.enabled = not rule.enabled
-        rule.save(update_fields=["enabled"])
+        # 同时写入 updated_at：网关按规则指纹（含最近更新时间）判断是否需要重新加载
+        rule.save(update_fields=["enabled", "updated_at"])
         return Response({"enabled": rule.enabled})
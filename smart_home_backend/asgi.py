@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'smart_home_backend.settings')
+# 处理请求的进程：启动时预先连接 MQTT 发布服务（见 mqtt_gateway/apps.py）
+os.environ.setdefault('MQTT_PUBLISHER_PREWARM', '1')
 
 application = get_asgi_application()
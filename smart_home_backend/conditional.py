@@ -0,0 +1,55 @@
+"""
+条件 GET（ETag / 304）与大 JSON 响应压缩。
+
+- 读多写少的接口（设备列表、历史曲线、能耗分析、系统日志）用版本号片段计算 ETag：
+  设备的 max(updated_at) / state_version、DeviceData 最大 ID、SystemLog 最大 ID 等，
+  只需一次轻量聚合查询，不构建响应体；If-None-Match 匹配时直接返回 304
+- ETag 同时包含用户与完整查询串；依赖“当前时间”的相对区间接口另加 TIME_BUCKET_SECONDS 时间片，
+  时间窗口最多滞后一个时间片
+- JsonGZipMiddleware 只压缩不小于 GZIP_MIN_BYTES 的 JSON 响应，SSE 等流式响应保持原样，避免缓冲
+"""
+
+import hashlib
+import time
+from typing import Callable
+
+from django.conf import settings
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
+
+
+def conditional_config() -> dict:
+    return getattr(settings, "CONDITIONAL_GET", {})
+
+
+def time_bucket() -> int:
+    return int(time.time() // max(1, conditional_config().get("TIME_BUCKET_SECONDS", 60)))
+
+
+def make_etag(request, *parts) -> str:
+    user = request.user
+    raw = "|".join(str(part) for part in (user.pk, user.is_staff or user.is_superuser, request.get_full_path(), *parts))
+    return quote_etag(hashlib.blake2b(raw.encode("utf-8"), digest_size=12).hexdigest())
+
+
+def etag_response(request, parts, build: Callable):
+    """parts 匹配客户端 If-None-Match 时返回 304，否则调用 build() 生成响应并附加 ETag。"""
+    etag = make_etag(request, *parts)
+    response = get_conditional_response(request, etag=etag) or build()
+    if response.status_code in (200, 304):
+        response["ETag"] = etag
+        # 浏览器可缓存，但每次使用前须带 If-None-Match 重新校验
+        patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+class JsonGZipMiddleware(GZipMiddleware):
+    def process_response(self, request, response):
+        if response.streaming:
+            return response
+        if not response.get("Content-Type", "").startswith("application/json"):
+            return response
+        if len(response.content) < conditional_config().get("GZIP_MIN_BYTES", 1024):
+            return response
+        return super().process_response(request, response)
@@ -74,6 +74,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # 压缩需在最外层，处理其他中间件写入后的最终响应体
+    'smart_home_backend.conditional.JsonGZipMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -239,6 +241,148 @@ MQTT_CONFIG = {
     'CLIENT_ID_API': os.getenv('MQTT_CLIENT_ID_API') or None,
 }
 
+# 网关运行指标（Prometheus 文本格式）：PORT>0 时在本地端口暴露 /metrics，FILE 非空时定期写入文件
+MQTT_GATEWAY_METRICS = {
+    'PORT': _env_int('MQTT_GATEWAY_METRICS_PORT', 0),
+    'ADDR': os.getenv('MQTT_GATEWAY_METRICS_ADDR', '127.0.0.1'),
+    'FILE': os.getenv('MQTT_GATEWAY_METRICS_FILE') or None,
+    'FILE_INTERVAL_SECONDS': _env_int('MQTT_GATEWAY_METRICS_FILE_INTERVAL_SECONDS', 15),
+}
+
+# 网关优先级通道：告警（lwt/烟雾）、执行设备、传感器遥测分别由独立工作线程处理
+MQTT_GATEWAY_LANES = {
+    'ALARM_WORKERS': _env_int('MQTT_GATEWAY_ALARM_WORKERS', 1),
+    'CONTROL_WORKERS': _env_int('MQTT_GATEWAY_CONTROL_WORKERS', 1),
+    'TELEMETRY_WORKERS': _env_int('MQTT_GATEWAY_TELEMETRY_WORKERS', 2),
+    # 队列上限（0 表示不限）；遥测通道积压超过上限时丢弃新消息，告警通道始终不丢
+    'CONTROL_MAXSIZE': _env_int('MQTT_GATEWAY_CONTROL_MAXSIZE', 0),
+    'TELEMETRY_MAXSIZE': _env_int('MQTT_GATEWAY_TELEMETRY_MAXSIZE', 10000),
+    # 分类用的设备类型缓存最多保留的设备数（超出时淘汰最久未用的）
+    'DEVICE_TYPE_CACHE_SIZE': _env_int('MQTT_GATEWAY_DEVICE_TYPE_CACHE_SIZE', 50000),
+    # 后台刷新设备类型缓存的间隔（拾取新增设备与类型变更；条目本身不过期）
+    'DEVICE_TYPE_REFRESH_SECONDS': _env_int('MQTT_GATEWAY_DEVICE_TYPE_REFRESH_SECONDS', 300),
+}
+
+# 网关入口限流（每台设备一个令牌桶）：超速上报合并为最新值后再写库，并按窗口记录一次刷屏警告
+MQTT_GATEWAY_RATE_LIMIT = {
+    'ENABLED': _env_bool('MQTT_GATEWAY_RATE_LIMIT_ENABLED', True),
+    # 默认每台设备 2 条/秒，允许 10 条突发
+    'DEFAULT_RATE': float(os.getenv('MQTT_GATEWAY_RATE_LIMIT_DEFAULT_RATE', '2')),
+    'DEFAULT_BURST': _env_int('MQTT_GATEWAY_RATE_LIMIT_DEFAULT_BURST', 10),
+    # 按设备类型覆盖 (rate, burst)；None 表示不限流
+    'TYPE_LIMITS': {
+        'SMOKE': None,
+        'LAMP_SWITCH': (5.0, 20),
+        'AC_SWITCH': (5.0, 20),
+        'FAN_SWITCH': (5.0, 20),
+    },
+    # 数据库中不存在的设备 ID：(rate, burst)，None 表示不限流
+    'UNKNOWN_DEVICE_LIMIT': (1.0, 5),
+    'FLOOD_LOG_WINDOW_SECONDS': _env_int('MQTT_GATEWAY_FLOOD_LOG_WINDOW_SECONDS', 60),
+}
+
+# 批量补传 home/{id}/batch：单条消息最多条目数、解压后大小上限、允许的设备时钟超前偏差
+MQTT_GATEWAY_BATCH = {
+    'MAX_ITEMS': _env_int('MQTT_GATEWAY_BATCH_MAX_ITEMS', 5000),
+    'MAX_DECOMPRESSED_BYTES': _env_int('MQTT_GATEWAY_BATCH_MAX_DECOMPRESSED_BYTES', 16 * 1024 * 1024),
+    'MAX_FUTURE_SKEW_SECONDS': _env_int('MQTT_GATEWAY_BATCH_MAX_FUTURE_SKEW_SECONDS', 300),
+    # 最新读数距当前不超过该秒数时，视为实时数据参与告警与场景判断
+    'REALTIME_WINDOW_SECONDS': _env_int('MQTT_GATEWAY_BATCH_REALTIME_WINDOW_SECONDS', 60),
+}
+
+# MQTT payload 编解码：DEFAULT 为上报未显式指定时的解码器，COMMAND 为下发命令的编码器
+# 可选 json / cbor / msgpack（后两者需安装 cbor2 / msgpack）；JSON 安装 orjson 时自动使用
+MQTT_GATEWAY_CODECS = {
+    'DEFAULT': os.getenv('MQTT_GATEWAY_DEFAULT_CODEC', 'json'),
+    'COMMAND': os.getenv('MQTT_GATEWAY_COMMAND_CODEC', 'json'),
+}
+
+# TIME_STATE 场景规则调度器：按时间窗口边界与状态变化评估，定期检查规则是否被修改
+MQTT_GATEWAY_SCENE_SCHEDULER = {
+    'ENABLED': _env_bool('MQTT_GATEWAY_SCENE_SCHEDULER_ENABLED', True),
+    'TICK_SECONDS': 1.0,
+    'RELOAD_SECONDS': _env_int('MQTT_GATEWAY_SCENE_SCHEDULER_RELOAD_SECONDS', 30),
+}
+
+# 设备可见性缓存：每个用户的可见设备 ID 集合缓存 TTL_SECONDS 秒；设备归属 / 公开状态变化时立即失效
+DEVICE_VISIBILITY_CACHE = {
+    'TTL_SECONDS': _env_int('DEVICE_VISIBILITY_CACHE_TTL_SECONDS', 300),
+}
+
+# 批量控制 /api/devices/bulk_command/：单次请求最多命中的设备数
+DEVICE_BULK_COMMAND = {
+    'MAX_DEVICES': _env_int('DEVICE_BULK_COMMAND_MAX_DEVICES', 500),
+}
+
+# API 进程的 MQTT 发布服务：启动时预先连接（AUTOSTART），断线期间最多缓冲 BUFFER_SIZE 条命令，
+# 重连间隔在 RECONNECT_MIN_SECONDS ~ RECONNECT_MAX_SECONDS 之间指数退避
+MQTT_PUBLISHER = {
+    'AUTOSTART': _env_bool('MQTT_PUBLISHER_AUTOSTART', True),
+    'BUFFER_SIZE': _env_int('MQTT_PUBLISHER_BUFFER_SIZE', 1000),
+    'RECONNECT_MIN_SECONDS': _env_int('MQTT_PUBLISHER_RECONNECT_MIN_SECONDS', 1),
+    'RECONNECT_MAX_SECONDS': _env_int('MQTT_PUBLISHER_RECONNECT_MAX_SECONDS', 60),
+}
+
+# 离线命令队列：执行设备离线时命令合并写入数据库，设备 LWT 上线后下发；超过 MAX_AGE_SECONDS 的命令丢弃
+MQTT_COMMAND_OUTBOX = {
+    'ENABLED': _env_bool('MQTT_COMMAND_OUTBOX_ENABLED', True),
+    'MAX_AGE_SECONDS': _env_int('MQTT_COMMAND_OUTBOX_MAX_AGE_SECONDS', 86400),
+}
+
+# 设备命令确认：命令 payload 带 cmd_id，设备通过 home/{id}/ack 或状态回显确认；
+# 超过 TIMEOUT_SECONDS 未确认记为超时。API 控制接口可加 ?wait=秒 等待确认（上限 MAX_WAIT_SECONDS）
+MQTT_COMMAND_ACK = {
+    'ENABLED': _env_bool('MQTT_COMMAND_ACK_ENABLED', True),
+    'TIMEOUT_SECONDS': _env_int('MQTT_COMMAND_ACK_TIMEOUT_SECONDS', 10),
+    'MAX_WAIT_SECONDS': _env_int('MQTT_COMMAND_ACK_MAX_WAIT_SECONDS', 5),
+    'MAX_PENDING': _env_int('MQTT_COMMAND_ACK_MAX_PENDING', 10000),
+}
+
+# 网关链路追踪：最近 BUFFER_SIZE 条消息的各阶段耗时，每 FLUSH_SECONDS 秒写入 FILE，
+# 供 /api/mqtt/traces/（API 进程）读取；FILE 为空时只保留在网关进程内
+MQTT_GATEWAY_TRACING = {
+    'ENABLED': _env_bool('MQTT_GATEWAY_TRACING_ENABLED', True),
+    'BUFFER_SIZE': _env_int('MQTT_GATEWAY_TRACING_BUFFER_SIZE', 5000),
+    'FILE': os.getenv('MQTT_GATEWAY_TRACING_FILE', str(BASE_DIR / 'gateway_traces.json')),
+    'FLUSH_SECONDS': _env_int('MQTT_GATEWAY_TRACING_FLUSH_SECONDS', 10),
+}
+
+# 场景规则批量导入 /api/scenes/bulk/：单次请求最多条目数
+SCENE_BULK = {
+    'MAX_ITEMS': _env_int('SCENE_BULK_MAX_ITEMS', 1000),
+}
+
+# 系统日志列表 /api/logs/system/：未传 limit 时返回 DEFAULT_LIMIT 条，limit 上限 MAX_LIMIT
+SYSTEM_LOG_LIST = {
+    'DEFAULT_LIMIT': _env_int('SYSTEM_LOG_LIST_DEFAULT_LIMIT', 200),
+    'MAX_LIMIT': _env_int('SYSTEM_LOG_LIST_MAX_LIMIT', 500),
+}
+
+# 条件 GET：相对时间区间接口的 ETag 按 TIME_BUCKET_SECONDS 分片；不小于 GZIP_MIN_BYTES 的 JSON 响应 gzip 压缩
+CONDITIONAL_GET = {
+    'TIME_BUCKET_SECONDS': _env_int('CONDITIONAL_GET_TIME_BUCKET_SECONDS', 60),
+    'GZIP_MIN_BYTES': _env_int('CONDITIONAL_GET_GZIP_MIN_BYTES', 1024),
+}
+
+# 缓存：default 为进程内缓存；device_blobs 存放每台设备序列化后的 JSON（按设备 ID + state_version），
+# MAX_ENTRIES 需大于设备总数，否则列表接口会频繁重新序列化
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'device_blobs': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'device-blobs',
+        'TIMEOUT': _env_int('DEVICE_BLOB_CACHE_TIMEOUT_SECONDS', 3600),
+        'OPTIONS': {'MAX_ENTRIES': _env_int('DEVICE_BLOB_CACHE_MAX_ENTRIES', 50000)},
+    },
+}
+
+# 规则回测：单次回测最多读取的历史数据行数（默认覆盖 30 天 1 Hz 的 259.2 万行），超出时接口返回 400
+SCENE_BACKTEST = {
+    'MAX_SAMPLES': _env_int('SCENE_BACKTEST_MAX_SAMPLES', 3000000),
+}
+
 # ==== Email ====
 
 EMAIL_HOST = os.getenv('EMAIL_HOST')
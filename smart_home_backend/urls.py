@@ -28,7 +28,7 @@ from devices.views import (
     EnergyAnalysisView,
 )
 from logs_app.views import EmailAlertRuleViewSet, SystemLogViewSet
-from mqtt_gateway.views import mqtt_status, realtime_stream, realtime_stream_token
+from mqtt_gateway.views import gateway_traces, mqtt_status, realtime_stream, realtime_stream_token
 from scenes.views import SceneRuleViewSet
 
 router = routers.DefaultRouter()
@@ -67,6 +67,7 @@ urlpatterns = [
         name="energy-analysis-export-csv",
     ),
     path("api/mqtt/status/", mqtt_status, name="mqtt-status"),
+    path("api/mqtt/traces/", gateway_traces, name="mqtt-traces"),
     path("api/realtime/stream-token/", realtime_stream_token, name="realtime-stream-token"),
     path("api/realtime/stream/", realtime_stream, name="realtime-stream"),
 ]